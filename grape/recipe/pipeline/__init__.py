@@ -34,6 +34,9 @@ class Recipe(object):
 
     def update(self):
         """
-        Prepare the updated pipeline.
+        Prepare the updated pipeline, unless nothing has changed since the
+        last buildout run.
         """
+        if prepare.is_up_to_date(self.options, self.buildout):
+            return self.options['location']
         return self.install()
@@ -0,0 +1,116 @@
+"""
+Parsed accessions.
+
+The file related attributes of an accession have one line per read file:
+
+    file_location = /data/testA.r2.fastq.gz
+                    /data/testA.r1.fastq.gz
+    pair_id = testA
+              testA
+    mate_id = testA.2
+              testA.1
+    label = Test
+            Test
+
+These attributes are split only once, into one compact record per read
+file. All other attributes are looked up in the accession as before.
+"""
+
+FILE_ATTRIBUTES = ('file_location', 'pair_id', 'mate_id', 'label')
+
+LABEL_ATTRIBUTES = ('pair_id', 'mate_id', 'label')
+
+
+class ReadFile(object):
+    """
+    The location and labels of one read file of an accession.
+    """
+
+    __slots__ = ('location', 'pair_id', 'mate_id', 'label')
+
+    def __init__(self, location, pair_id, mate_id, label):
+        """Store the location and the labels of the read file"""
+        self.location = location
+        self.pair_id = pair_id
+        self.mate_id = mate_id
+        self.label = label
+
+    def get_labels(self):
+        """Return the labels as expected by readlist_labels"""
+        return {'pair_id': self.pair_id,
+                'mate_id': self.mate_id,
+                'label': self.label}
+
+
+class Accession(object):
+    """
+    An accession with the file related attributes split into lines once.
+    It can be used wherever the accession section was used before.
+    """
+
+    def __init__(self, accession, name=None):
+        """Split the file related attributes of the accession section"""
+        self.accession = accession
+        if name is None:
+            name = accession.get('accession', None)
+        self.name = name
+        self.lines = {}
+        for attribute in FILE_ATTRIBUTES:
+            if attribute in accession:
+                self.lines[attribute] = accession[attribute].split('\n')
+        self._reads = None
+
+    def __getitem__(self, key):
+        return self.accession[key]
+
+    def __contains__(self, key):
+        return key in self.accession
+
+    def get(self, key, default=None):
+        """Return the value of an attribute, or the default"""
+        return self.accession.get(key, default)
+
+    def items(self):
+        """Return the attributes and their values"""
+        return self.accession.items()
+
+    def get_lines(self, attribute):
+        """Return the lines of a file related attribute"""
+        return self.lines[attribute]
+
+    def get_reads(self):
+        """
+        Return one ReadFile per line of the file_location attribute. The
+        pair_id, mate_id and label attributes need to have as many lines.
+        """
+        if self._reads is not None:
+            return self._reads
+        locations = self.lines['file_location']
+        number_of_reads = len(locations)
+        for attribute in LABEL_ATTRIBUTES:
+            if not attribute in self.lines:
+                template = "Specify a %s attribute for accession %s"
+                raise AttributeError(template % (attribute, self.name))
+            if len(self.lines[attribute]) != number_of_reads:
+                message = ["%s needs to have exactly one line for each " %
+                           attribute,
+                           "file defined in file_locations in accession %s"]
+                raise AttributeError("".join(message) % self.name)
+        self._reads = [ReadFile(*values) for values in
+                       zip(locations,
+                           self.lines['pair_id'],
+                           self.lines['mate_id'],
+                           self.lines['label'])]
+        return self._reads
+
+    reads = property(get_reads)
+
+
+def parse_accession(accession, name=None):
+    """
+    Return the parsed accession, parsing the accession section only if this
+    has not been done before.
+    """
+    if isinstance(accession, Accession):
+        return accession
+    return Accession(accession, name)
@@ -0,0 +1,309 @@
+"""
+Compiled accession database.
+
+With thousands of accessions, parsing and keeping the accessions/*/db.cfg
+and profiles/*/db.cfg files in memory on every buildout run is slow. The
+sections of these files can be compiled into an indexed SQLite database:
+
+    [settings]
+    accession_db = ${buildout:directory}/../../var/accessions.db
+    accession_db_sources = ${buildout:directory}/../../accessions/*/db.cfg
+                           ${buildout:directory}/../../profiles/*/db.cfg
+
+The database is rebuilt only when one of the source files changes. The
+recipe then fetches single accessions and profiles by name. Values are
+stored as written in the source files, and references like
+${buildout:directory} are substituted when a section is fetched.
+
+The values are read like buildout reads them, except that the extension
+syntax of buildout (+=, -= and <=) is not supported in the source files.
+
+The database also knows which accessions use a read file. Locations below
+${buildout:directory} are found given the directory of the buildout:
+
+    bin/grape-accession-db -d var/accessions.db uses /data/testA.fastq.gz
+    bin/grape-accession-db -d var/accessions.db -b . uses src/testA.fastq.gz
+"""
+
+import os
+import re
+import sys
+import glob
+import json
+import sqlite3
+import optparse
+import ConfigParser
+
+from grape.recipe.pipeline import fingerprint
+
+SUBSTITUTION = re.compile(r'\$\{([^:}]+):([^}]+)\}')
+
+BUILDOUT_DIRECTORY = '${buildout:directory}'
+
+# Open databases by process and path, so that the freshness check is done
+# once per process, and forked processes do not share a connection
+DATABASES = {}
+
+
+def expand_sources(patterns):
+    """Return the source files matching the whitespace separated patterns"""
+    sources = []
+    for pattern in patterns.split():
+        for source in sorted(glob.glob(pattern)):
+            source = os.path.abspath(source)
+            if not source in sources:
+                sources.append(source)
+    return sources
+
+
+def parse_source(source):
+    """
+    Return the sections of a buildout configuration file as a list of
+    (name, options) tuples.
+    """
+    parser = ConfigParser.RawConfigParser()
+    # Option names are case sensitive in buildout, as in readType
+    parser.optionxform = str
+    parser.read(source)
+    sections = []
+    for name in parser.sections():
+        options = {}
+        for key, value in parser.items(name):
+            # The parser reads "key += value" as the option "key +"
+            if key == '<' or key.endswith(('+', '-')):
+                template = "%s= in [%s] of %s is not supported in the " \
+                           "accession database"
+                raise AttributeError(template % (key, name, source))
+            # Like buildout, a value starting on the next line does not
+            # start with an empty line
+            options[key] = value.strip()
+        sections.append((name, options))
+    return sections
+
+
+def location_key(location, directory=None):
+    """
+    Return the location as it is kept in the files table, where references
+    to ${buildout:directory} are normalized. Given the buildout directory,
+    return the location as a reference to it.
+    """
+    if directory is not None:
+        location = os.path.join(BUILDOUT_DIRECTORY,
+                                os.path.relpath(location, directory))
+    if location.startswith(BUILDOUT_DIRECTORY + '/'):
+        relative = location[len(BUILDOUT_DIRECTORY) + 1:]
+        return os.path.join(BUILDOUT_DIRECTORY, os.path.normpath(relative))
+    return location
+
+
+def compile_database(path, sources):
+    """
+    Compile the sections of the source files into a new database, which
+    replaces the database at the path in one atomic rename.
+    """
+    folder = os.path.dirname(path)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+    temporary = "%s.%s.tmp" % (path, os.getpid())
+    if os.path.exists(temporary):
+        os.remove(temporary)
+    connection = sqlite3.connect(temporary)
+    try:
+        connection.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, "
+                           "value TEXT)")
+        connection.execute("CREATE TABLE sections (name TEXT, "
+                           "position INTEGER, source TEXT, data TEXT)")
+        connection.execute("CREATE TABLE files (location TEXT, name TEXT, "
+                           "source TEXT)")
+        for position, source in enumerate(sources):
+            for name, options in parse_source(source):
+                connection.execute("INSERT INTO sections VALUES (?, ?, ?, ?)",
+                                   (name, position, source,
+                                    json.dumps(options)))
+                for location in options.get('file_location', '').split():
+                    connection.execute("INSERT INTO files VALUES (?, ?, ?)",
+                                       (location_key(location), name,
+                                        source))
+        connection.execute("CREATE INDEX sections_name ON sections (name)")
+        connection.execute("CREATE INDEX files_location ON files (location)")
+        connection.execute("INSERT INTO meta VALUES (?, ?)",
+                           ('sources', sources_fingerprint(sources)))
+        connection.commit()
+    finally:
+        connection.close()
+    os.rename(temporary, path)
+
+
+def sources_fingerprint(sources):
+    """Fingerprint of the list of source files and their identities"""
+    return fingerprint.paths_fingerprint(sources)
+
+
+class AccessionDatabase(object):
+    """
+    Indexed lookup of the sections compiled from the source files.
+    """
+
+    def __init__(self, path, sources=None):
+        """
+        Open the database. If the source files are given, the database is
+        compiled first if it is missing or out of date.
+        """
+        self.path = path
+        if sources is not None and not self.is_fresh(sources):
+            compile_database(path, sources)
+        if not os.path.exists(path):
+            raise AttributeError("Accession database not found: %s" % path)
+        self.connection = sqlite3.connect(path, timeout=300)
+
+    def is_fresh(self, sources):
+        """Check whether the database was compiled from these sources"""
+        if not os.path.exists(self.path):
+            return False
+        connection = sqlite3.connect(self.path, timeout=300)
+        try:
+            try:
+                row = connection.execute("SELECT value FROM meta "
+                                         "WHERE key = 'sources'").fetchone()
+            except sqlite3.DatabaseError:
+                return False
+        finally:
+            connection.close()
+        return row is not None and row[0] == sources_fingerprint(sources)
+
+    def get(self, name):
+        """Return the options of the section, or None if it is not there"""
+        row = self.connection.execute("SELECT data FROM sections "
+                                      "WHERE name = ? "
+                                      "ORDER BY position LIMIT 1",
+                                      (name,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def names(self):
+        """Return the names of all the sections"""
+        rows = self.connection.execute("SELECT DISTINCT name FROM sections "
+                                       "ORDER BY name")
+        return [row[0] for row in rows]
+
+    def accessions_using_file(self, location, directory=None):
+        """
+        Return the (name, source) tuples of accessions using the file. With
+        the buildout directory, accessions referring to the file through
+        ${buildout:directory} are found as well.
+        """
+        locations = [location]
+        if directory is not None:
+            directory = os.path.abspath(directory)
+            location = os.path.join(directory, location)
+            locations = [os.path.normpath(location),
+                         location_key(location, directory)]
+        rows = self.connection.execute("SELECT DISTINCT name, source "
+                                       "FROM files WHERE location IN (?, ?) "
+                                       "ORDER BY source, name",
+                                       (locations[0], locations[-1]))
+        return [tuple(row) for row in rows]
+
+    def close(self):
+        """Close the database"""
+        self.connection.close()
+
+
+def substitute(options, buildout):
+    """
+    Substitute ${section:option} references with the values from the
+    buildout, like buildout does when it reads the configuration. The
+    values are UTF-8 encoded strings, like the values of buildout.
+    """
+    def replace(match):
+        """Look up one reference"""
+        section, option = match.groups()
+        try:
+            return buildout[section][option]
+        except KeyError:
+            return match.group(0)
+
+    return dict([(key.encode('utf-8'),
+                  SUBSTITUTION.sub(replace, value.encode('utf-8')))
+                 for key, value in options.items()])
+
+
+def get_database(buildout):
+    """
+    Return the accession database configured in the settings section, or
+    None if there is none.
+    """
+    settings = buildout['settings']
+    if not settings.get('accession_db', ''):
+        return None
+    key = (os.getpid(), settings['accession_db'])
+    if not key in DATABASES:
+        sources = None
+        if settings.get('accession_db_sources', ''):
+            sources = expand_sources(settings['accession_db_sources'])
+        DATABASES[key] = AccessionDatabase(settings['accession_db'], sources)
+    return DATABASES[key]
+
+
+def get_section(buildout, name):
+    """
+    Return a section from the buildout, or else from the accession database.
+    Raises a KeyError if the section is in neither.
+    """
+    try:
+        return buildout[name]
+    except KeyError:
+        database = get_database(buildout)
+        if database is None:
+            raise
+    options = database.get(name)
+    if options is None:
+        raise KeyError(name)
+    return substitute(options, buildout)
+
+
+def main(args=None):
+    """
+    Entry point of the grape-accession-db console script.
+    """
+    usage = ("%prog -d DATABASE compile SOURCE...\n"
+             "       %prog -d DATABASE show NAME\n"
+             "       %prog -d DATABASE uses FILE")
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option('-d', '--database', dest='database',
+                      help="The accession database")
+    parser.add_option('-b', '--buildout-directory', dest='directory',
+                      help="The buildout directory for the uses command")
+    options, args = parser.parse_args(args)
+    if options.database is None or len(args) < 2:
+        parser.error("Give the database, a command and its arguments")
+    command = args[0]
+    if command == 'compile':
+        sources = expand_sources(' '.join(args[1:]))
+        compile_database(options.database, sources)
+        print "Compiled %s sources" % len(sources)
+        return 0
+    database = AccessionDatabase(options.database)
+    try:
+        if command == 'show':
+            section = database.get(args[1])
+            if section is None:
+                print "Section not found", args[1]
+                return 1
+            print "[%s]" % args[1]
+            for key, value in sorted(section.items()):
+                print "%s = %s" % (key, value.replace('\n', '\n    '))
+        elif command == 'uses':
+            for name, source in database.accessions_using_file(
+                    args[1], options.directory):
+                print "%s\t%s" % (name, source)
+        else:
+            parser.error("Unknown command: %s" % command)
+    finally:
+        database.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
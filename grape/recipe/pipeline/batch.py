@@ -0,0 +1,180 @@
+"""
+Prepare many pipeline parts at once.
+
+Buildout installs the parts one after the other. Once the shared folders in
+var/pipeline have been installed, the preparation of each part is
+independent of the others, so this module prepares all the parts listed in
+the runs section over a pool of processes:
+
+    bin/grape-prepare-parts -c buildout.cfg -j 16
+
+The shared folders are installed once up front, in the calling process.
+"""
+
+import os
+import sys
+import optparse
+import multiprocessing
+
+from grape.recipe.pipeline import prepare
+from grape.recipe.pipeline import timing
+from grape.recipe.pipeline import gemindex
+from grape.recipe.pipeline import staging
+from grape.recipe.pipeline import shard
+from grape.recipe.pipeline.accession import parse_accession
+from grape.recipe.pipeline.accessiondb import get_section
+
+
+def get_part_names(buildout):
+    """Return the names of the parts listed in the runs section"""
+    return buildout['runs']['parts'].split()
+
+
+def get_part_options(buildout, name):
+    """
+    Return the options of a part, including its location in the parts
+    directory like the recipe sets it.
+    """
+    options = dict(buildout[name].items())
+    parts_directory = buildout['buildout']['parts-directory']
+    options['location'] = os.path.join(parts_directory, name)
+    return options
+
+
+def get_part_buildout(buildout, options):
+    """
+    Return a plain copy of the buildout sections needed for preparing the
+    part, so that it can be sent to a worker process.
+    """
+    names = ['buildout', 'settings', 'pipeline', options['accession']]
+    if 'pipeline' in options:
+        names.append(options['pipeline'])
+    part_buildout = {}
+    for name in names:
+        # Accessions and profiles may come from the accession database
+        try:
+            part_buildout[name] = dict(get_section(buildout, name).items())
+        except KeyError:
+            pass
+    return part_buildout
+
+
+def prepare_worker(job):
+    """
+    Prepare one part in a worker process. The shared folders have already
+    been installed by the calling process.
+    """
+    options, buildout, dry_run = job
+    accession = buildout[options['accession']]
+    prepare.collapse_accession(accession)
+    accession = parse_accession(accession, options['accession'])
+    options['experiment_id'] = os.path.split(options['location'])[-1]
+    timer = timing.start(options)
+    try:
+        prepare.prepare_part(options, buildout, accession, dry_run)
+    finally:
+        timing.stop(timer)
+    report = None
+    if timer is not None:
+        report = timer.report()
+        timing.save_part_report(options['location'], report)
+    return options['location'], report
+
+
+def prepare_parts(buildout, names=None, processes=None, dry_run=False):
+    """
+    Prepare the given parts, or all the parts of the runs section, over a
+    pool of processes. By default, there is one process per CPU. Parts that
+    are up to date are skipped. With dry_run, the plans of the parts are
+    printed, and nothing is installed.
+
+    Returns the locations of the parts that have been prepared.
+    """
+    if names is None:
+        names = get_part_names(buildout)
+    jobs = []
+    fingerprints = {}
+    for name in names:
+        options = get_part_options(buildout, name)
+        try:
+            get_section(buildout, options['accession'])
+        except KeyError:
+            print "Accession not found", options['accession']
+            continue
+        if prepare.is_up_to_date(options, buildout):
+            continue
+        if not dry_run and not os.path.exists(options['location']):
+            os.mkdir(options['location'])
+        fingerprints[options['location']] = prepare.part_fingerprint(options,
+                                                                     buildout)
+        jobs.append((options, get_part_buildout(buildout, options), dry_run))
+
+    if not dry_run:
+        prepare.install_shared_folders(buildout)
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = max(1, min(processes, len(jobs)))
+    if processes == 1:
+        results = [prepare_worker(job) for job in jobs]
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(prepare_worker, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    locations = [location for location, _ in results]
+    if dry_run:
+        return locations
+    settings = buildout['settings']
+    if settings.get('gemindices_registry', '') and \
+            settings.get('gemindices_budget', ''):
+        gemindex.evict_once(buildout)
+    if settings.get('shard_budget', ''):
+        shard.evict_once(buildout)
+    if settings.get('staging_cache', '') and \
+            settings.get('staging_budget', ''):
+        staging.evict_once(buildout, shard.sharded_sources(buildout))
+    for location, report in results:
+        prepare.INSTALLATION_STATE.set_fingerprint(location,
+                                                   fingerprints[location])
+        if report is not None:
+            timing.add_to_summary(location, report)
+    prepare.INSTALLATION_STATE.save()
+    if timing.RUN_SUMMARY['parts']:
+        timing.save_summary(buildout)
+    return locations
+
+
+def load_buildout(config_file):
+    """Load the buildout configuration like bin/buildout does"""
+    from zc.buildout.buildout import Buildout
+    return Buildout(os.path.abspath(config_file), [])
+
+
+def main(args=None):
+    """
+    Entry point of the grape-prepare-parts console script.
+    """
+    parser = optparse.OptionParser(usage="%prog [options] [part ...]")
+    parser.add_option('-c', '--config', dest='config',
+                      default='buildout.cfg',
+                      help="The buildout configuration file")
+    parser.add_option('-j', '--processes', dest='processes', type='int',
+                      default=None,
+                      help="Number of worker processes (default: CPUs)")
+    parser.add_option('-n', '--dry-run', dest='dry_run', action='store_true',
+                      default=False,
+                      help="Only print what would be changed in the parts")
+    options, names = parser.parse_args(args)
+    buildout = load_buildout(options.config)
+    locations = prepare_parts(buildout, names or None, options.processes,
+                              options.dry_run)
+    print "Prepared %s parts" % len(locations)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,446 @@
+"""
+Benchmarks of preparing parts at scale.
+
+The tests only prepare one part with four read files. This module generates
+synthetic buildouts with many parts and read files, big src/pipeline/bin and
+src/pipeline/lib trees and the dependency folders, and times the
+preparation of all the parts:
+
+    bin/grape-benchmark -p 200 -f 8 -s 2000 -l 500 -o benchmarks.json
+
+The scenarios are:
+
+    install     Installing every part for the first time
+    update      Updating every part when nothing has changed
+    reinstall   Installing every part again over the installed parts
+    quick       Quick mode in a folder with read files, genome and
+                annotation
+
+For every scenario, the wall time, the number of calls of the wrapped os
+functions, the bytes copied and the peak memory are recorded, as well as
+the time and os calls of every step of the preparation. Every scenario
+runs in its own process, so that the peak memory is its own.
+
+The results are appended to the output file together with the version of
+the recipe, and compared with the last results of another version. The
+script exits with an error if a scenario got slower than the threshold:
+
+    bin/grape-benchmark -o benchmarks.json --threshold 1.25
+"""
+
+import os
+import sys
+import gzip
+import json
+import time
+import shutil
+import platform
+import optparse
+import tempfile
+import resource
+import multiprocessing
+from StringIO import StringIO
+
+from grape.recipe.pipeline import Recipe
+from grape.recipe.pipeline import batch
+from grape.recipe.pipeline import prepare
+from grape.recipe.pipeline import timing
+from grape.recipe.pipeline.jsonfile import write_json
+
+SCENARIOS = ('install', 'update', 'reinstall', 'quick')
+
+GEM_BINARIES = ('gem-indexer', 'gem-mapper', 'gem-2-sam', 'gem-info')
+
+QUICK_ANNOTATION = 'gencode.v7.annotation.ok.gtf'
+
+QUICK_GENOME = 'H.sapiens.genome.hg19.main.fa'
+
+FASTQ_RECORD = "@read%%s/1\n%s\n+\n%s\n" % ('ACGT' * 19, 'I' * 76)
+
+
+def write_file(path, content='', mode=None):
+    """Write a file, making its folder if needed"""
+    folder = os.path.dirname(path)
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    output = open(path, 'w')
+    output.write(content)
+    output.close()
+    if mode is not None:
+        os.chmod(path, mode)
+
+
+def write_reads(path, records=100):
+    """Write a small gzipped fastq file"""
+    folder = os.path.dirname(path)
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    output = gzip.open(path, 'wb')
+    for index in range(records):
+        output.write(FASTQ_RECORD % index)
+    output.close()
+
+
+def make_sources(folder, scripts, libs):
+    """
+    Write the pipeline sources and the dependencies into the src folder of
+    the buildout, and return the settings pointing to them.
+    """
+    src = os.path.join(folder, 'src')
+    for index in range(scripts):
+        # A few scripts per folder, like the real pipeline
+        path = os.path.join(src, 'pipeline/bin/group%s/script%s.pl' %
+                            (index // 100, index))
+        write_file(path, "#!/usr/bin/perl\nuse strict;\nprint %s;\n" % index,
+                   0755)
+    for index in range(libs):
+        path = os.path.join(src, 'pipeline/lib/group%s/Module%s.pm' %
+                            (index // 100, index))
+        write_file(path, "package Module%s;\n1;\n" % index)
+    write_file(os.path.join(src, 'pipeline/template3.0.txt'))
+    write_file(os.path.join(src, 'flux/bin/flux'), '', 0755)
+    write_file(os.path.join(src, 'overlap/overlap'), '', 0755)
+    for name in GEM_BINARIES:
+        write_file(os.path.join(src, 'gem', name), '', 0755)
+        write_file(os.path.join(src, 'nextgem', name), '', 0755)
+    for name in prepare.CUFFLINKS_BINARIES:
+        write_file(os.path.join(src, 'cufflinks', name), '', 0755)
+    write_file(os.path.join(src, 'fastqc/fastqc'),
+               "#!/usr/bin/perl\nuse warnings;\n", 0755)
+    return {'perl': '/usr/bin/perl',
+            'overlap': os.path.join(src, 'overlap/overlap'),
+            'gem_folder': os.path.join(src, 'gem'),
+            'nextgem_folder': os.path.join(src, 'nextgem')}
+
+
+def make_accession(file_locations):
+    """Return a paired end accession for the read files"""
+    pair_ids = []
+    mate_ids = []
+    for index in range(len(file_locations)):
+        pair_ids.append('pair%s' % (index // 2))
+        mate_ids.append('pair%s.%s' % (index // 2, index % 2 + 1))
+    return {'file_location': '\n'.join(file_locations),
+            'species': 'Homo sapiens',
+            'readType': '2x76',
+            'cell': 'Unknown',
+            'rnaExtract': 'LONGPOLYA',
+            'localization': 'CELL',
+            'qualities': 'phred',
+            'pair_id': '\n'.join(pair_ids),
+            'mate_id': '\n'.join(mate_ids),
+            'label': '\n'.join(['Benchmark'] * len(file_locations)),
+            'paired': '1',
+            'type': 'fastq',
+            'replicate': '1'}
+
+
+def make_buildout(folder, parts=10, files=4, scripts=500, libs=200):
+    """
+    Write a synthetic buildout with the given number of parts, read files
+    per part, and scripts and modules in src/pipeline, and return the
+    buildout sections.
+    """
+    settings = make_sources(folder, scripts, libs)
+    os.makedirs(os.path.join(folder, 'parts'))
+    os.makedirs(os.path.join(folder, 'var'))
+    buildout = {'buildout': {'directory': folder,
+                             'parts-directory': os.path.join(folder,
+                                                             'parts')},
+                'settings': settings,
+                'pipeline': {'TEMPLATE': os.path.join(
+                                 folder, 'src/pipeline/template3.0.txt'),
+                             'PROJECTID': 'Benchmark',
+                             'THREADS': '2',
+                             'DB': 'Benchmark_RNAseqPipeline',
+                             'COMMONDB': 'Benchmark_RNAseqPipelineCommon',
+                             'MAPPER': 'GEM',
+                             'MISMATCHES': '2',
+                             'GENOMESEQ': os.path.join(folder, QUICK_GENOME),
+                             'ANNOTATION': os.path.join(folder,
+                                                        QUICK_ANNOTATION),
+                             'FLUXMEM': '16G'}}
+    names = []
+    for part in range(parts):
+        name = 'Run%04d' % part
+        names.append(name)
+        file_locations = []
+        for index in range(files):
+            path = os.path.join(folder, 'reads/%s_%s.fastq.gz' % (name,
+                                                                  index))
+            write_reads(path)
+            file_locations.append(path)
+        buildout[name] = {'recipe': 'grape.recipe.pipeline',
+                          'accession': name + 'Accession'}
+        buildout[name + 'Accession'] = make_accession(file_locations)
+    buildout['runs'] = {'parts': '\n'.join(names)}
+    return buildout
+
+
+def make_quick_buildout(folder, files=4, scripts=500, libs=200):
+    """
+    Write a synthetic buildout for quick mode, with the genome and the
+    annotation in the buildout folder, and the lanes of one paired sample
+    in a subfolder.
+    """
+    buildout = make_buildout(folder, 0, 0, scripts, libs)
+    # The lanes of one sample in a folder of the delivery
+    for index in range(files):
+        write_reads(os.path.join(folder, 'delivery/Sample_S1_L%03d_R%s_001'
+                                 '.fastq.gz' % (index // 2 + 1,
+                                                index % 2 + 1)))
+    write_file(os.path.join(folder, QUICK_ANNOTATION))
+    write_file(os.path.join(folder, QUICK_GENOME))
+    # Quick mode is used when the accession of the Run part is missing
+    buildout['Run'] = {'recipe': 'grape.recipe.pipeline',
+                       'accession': 'Quick'}
+    buildout['runs'] = {'parts': 'Run'}
+    return buildout
+
+
+def get_recipes(buildout):
+    """Return the recipes of all the parts of the runs section"""
+    recipes = []
+    for name in batch.get_part_names(buildout):
+        recipes.append(Recipe(buildout, name, dict(buildout[name].items())))
+    return recipes
+
+
+def install_parts(buildout):
+    """Install all the parts, like buildout does for new parts"""
+    for recipe in get_recipes(buildout):
+        recipe.install()
+
+
+def update_parts(buildout):
+    """Update all the parts, like buildout does for unchanged parts"""
+    for recipe in get_recipes(buildout):
+        recipe.update()
+
+
+def quick_part(buildout):
+    """Install the quick mode part in the buildout folder"""
+    cwd = os.getcwd()
+    os.chdir(buildout['buildout']['directory'])
+    try:
+        install_parts(buildout)
+    finally:
+        os.chdir(cwd)
+
+
+SCENARIO_FUNCTIONS = {'install': install_parts,
+                      'update': update_parts,
+                      'reinstall': install_parts,
+                      'quick': quick_part}
+
+
+def peak_memory():
+    """Return the peak resident memory of this process in megabytes"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # Bytes instead of kilobytes
+        peak = peak // 1024
+    return peak / 1024.0
+
+
+def step_totals(steps):
+    """Return the total time and os calls per step name"""
+    totals = {}
+    for record in steps:
+        total = totals.setdefault(record['name'], {'count': 0,
+                                                   'seconds': 0.0,
+                                                   'os_calls': 0})
+        total['count'] += 1
+        total['seconds'] += record['seconds']
+        total['os_calls'] += record['operations']
+    return totals
+
+
+def run_scenario(job):
+    """
+    Run a scenario on the buildout, in a worker process of its own, and
+    return its results.
+    """
+    name, buildout = job
+    # Every scenario starts like a new buildout run
+    prepare.INSTALLATION_STATE.__init__()
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    timer = timing.start({'timing': 'true'})
+    try:
+        SCENARIO_FUNCTIONS[name](buildout)
+    finally:
+        timing.stop(timer)
+        sys.stdout = stdout
+    report = timer.report()
+    return {'seconds': report['seconds'],
+            'os_calls': report['operations'],
+            'bytes_copied': report['bytes_copied'],
+            'peak_memory_mb': peak_memory(),
+            'steps': step_totals(report['steps'])}
+
+
+def measure(name, buildout):
+    """Run the scenario in a fresh process"""
+    pool = multiprocessing.Pool(1)
+    try:
+        return pool.apply(run_scenario, ((name, buildout),))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def get_version():
+    """Return the version of the installed recipe"""
+    try:
+        import pkg_resources
+        return pkg_resources.get_distribution('grape.recipe.pipeline').version
+    except Exception:  # pylint: disable=W0703
+        return 'unknown'
+
+
+def run_benchmark(folder, parts=10, files=4, scripts=500, libs=200,
+                  scenarios=SCENARIOS):
+    """
+    Generate the synthetic buildouts in the folder and run the scenarios.
+
+    Returns the results of the benchmark run.
+    """
+    parameters = {'parts': parts, 'files': files, 'scripts': scripts,
+                  'libs': libs}
+    results = {'version': get_version(),
+               'started': time.time(),
+               'python': platform.python_version(),
+               'parameters': parameters,
+               'scenarios': {}}
+    buildout = make_buildout(os.path.join(folder, 'parts'), parts, files,
+                             scripts, libs)
+    for name in ['install', 'update', 'reinstall']:
+        if name in scenarios:
+            results['scenarios'][name] = measure(name, buildout)
+        elif name == 'install':
+            # The other scenarios need the installed parts
+            install_parts(buildout)
+    if 'quick' in scenarios:
+        buildout = make_quick_buildout(os.path.join(folder, 'quick'), files,
+                                       scripts, libs)
+        results['scenarios']['quick'] = measure('quick', buildout)
+    return results
+
+
+def load_results(path):
+    """Return the benchmark runs stored in the file"""
+    if not os.path.exists(path):
+        return []
+    results_file = open(path)
+    try:
+        return json.load(results_file)
+    finally:
+        results_file.close()
+
+
+def save_results(path, results):
+    """Append the results of a benchmark run to the file"""
+    runs = load_results(path)
+    runs.append(results)
+    write_json(path, runs)
+
+
+def find_baseline(runs, results):
+    """
+    Return the last run of another version with the same parameters, or
+    else the last run with the same parameters, or None.
+    """
+    same = [run for run in runs
+            if run['parameters'] == results['parameters']]
+    other = [run for run in same if run['version'] != results['version']]
+    if other:
+        return other[-1]
+    if same:
+        return same[-1]
+    return None
+
+
+def compare_results(baseline, results, threshold=1.25):
+    """
+    Compare the scenarios with the baseline. Returns the lines of the
+    comparison, and the names of the scenarios that are slower than the
+    threshold.
+    """
+    lines = []
+    regressions = []
+    for name in SCENARIOS:
+        if not name in results['scenarios'] or \
+                not name in baseline['scenarios']:
+            continue
+        old = baseline['scenarios'][name]
+        new = results['scenarios'][name]
+        ratio = new['seconds'] / max(old['seconds'], 0.001)
+        lines.append("%-10s %8.2fs -> %8.2fs (x%.2f)  %8s -> %8s os calls  "
+                     "%6.1fM -> %6.1fM" % (name, old['seconds'],
+                                           new['seconds'], ratio,
+                                           old['os_calls'],
+                                           new['os_calls'],
+                                           old['peak_memory_mb'],
+                                           new['peak_memory_mb']))
+        if ratio > threshold:
+            regressions.append(name)
+    return lines, regressions
+
+
+def main(args=None):
+    """
+    Entry point of the grape-benchmark console script.
+    """
+    parser = optparse.OptionParser(usage="%prog [options] [scenario ...]")
+    parser.add_option('-p', '--parts', dest='parts', type='int', default=10,
+                      help="Number of parts")
+    parser.add_option('-f', '--files', dest='files', type='int', default=4,
+                      help="Number of read files per part")
+    parser.add_option('-s', '--scripts', dest='scripts', type='int',
+                      default=500,
+                      help="Number of scripts in src/pipeline/bin")
+    parser.add_option('-l', '--libs', dest='libs', type='int', default=200,
+                      help="Number of modules in src/pipeline/lib")
+    parser.add_option('-o', '--output', dest='output',
+                      default='benchmarks.json',
+                      help="File the results are appended to")
+    parser.add_option('-t', '--threshold', dest='threshold', type='float',
+                      default=1.25,
+                      help="Slowdown compared to the baseline that fails")
+    parser.add_option('-d', '--directory', dest='directory', default=None,
+                      help="Folder for the synthetic buildouts")
+    options, scenarios = parser.parse_args(args)
+    for name in scenarios:
+        if not name in SCENARIOS:
+            parser.error("Unknown scenario: %s" % name)
+    folder = tempfile.mkdtemp('grapeBenchmark', dir=options.directory)
+    try:
+        results = run_benchmark(folder, options.parts, options.files,
+                                options.scripts, options.libs,
+                                scenarios or SCENARIOS)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    for name in SCENARIOS:
+        if name in results['scenarios']:
+            scenario = results['scenarios'][name]
+            print "%-10s %8.2fs %8s os calls %10s bytes %6.1fM" % (
+                name, scenario['seconds'], scenario['os_calls'],
+                scenario['bytes_copied'], scenario['peak_memory_mb'])
+    baseline = find_baseline(load_results(options.output), results)
+    save_results(options.output, results)
+    if baseline is None:
+        return 0
+    print "Compared with %s:" % baseline['version']
+    lines, regressions = compare_results(baseline, results,
+                                         options.threshold)
+    for line in lines:
+        print line
+    if regressions:
+        print "Slower than the threshold: %s" % ", ".join(regressions)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
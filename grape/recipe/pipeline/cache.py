@@ -0,0 +1,145 @@
+"""
+Sidecar database for results computed from read files.
+
+Checking or sampling a read file is expensive, so the results are kept in a
+SQLite database next to the buildout, or in a place shared by many projects.
+The results are keyed by the identity of the files (device, inode, size and
+modification time), so they stay valid until a file is replaced or changed,
+no matter how many parts or projects refer to it.
+
+Checks of read files use check_cached, which only runs the checks that have
+no result in the cache, over a pool of worker threads.
+"""
+
+import os
+import json
+import sqlite3
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+from grape.recipe.pipeline.fingerprint import file_identity
+
+
+def identity_key(*paths):
+    """
+    Return the key for the identities of the given files, or None if one of
+    them does not exist.
+    """
+    identities = []
+    for path in paths:
+        identity = file_identity(path)
+        if identity is None:
+            return None
+        identities.append(identity)
+    return json.dumps(identities)
+
+
+class FileCache(object):
+    """
+    Results per file identity and kind of result, stored as JSON.
+    """
+
+    def __init__(self, path):
+        """Open the database, creating it if needed"""
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            try:
+                os.makedirs(folder)
+            except OSError:
+                # Another process made it in the meantime
+                if not os.path.isdir(folder):
+                    raise
+        # Many processes may use the database at the same time
+        self.connection = sqlite3.connect(path, timeout=300)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS results "
+                                "(key TEXT, kind TEXT, path TEXT, "
+                                "result TEXT, PRIMARY KEY (key, kind))")
+        self.connection.commit()
+
+    def get(self, key, kind):
+        """Return the result stored for the key, or None"""
+        if key is None:
+            return None
+        row = self.connection.execute("SELECT result FROM results "
+                                      "WHERE key = ? AND kind = ?",
+                                      (key, kind)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def set(self, key, kind, path, result):
+        """Store the result for the key"""
+        if key is None:
+            return
+        self.connection.execute("INSERT OR REPLACE INTO results "
+                                "(key, kind, path, result) "
+                                "VALUES (?, ?, ?, ?)",
+                                (key, kind, path, json.dumps(result)))
+        self.connection.commit()
+
+    def close(self):
+        """Close the database"""
+        self.connection.close()
+
+
+def get_cache_path(buildout, name):
+    """
+    Return the path of a sidecar database, configured in the settings
+    section or in var/pipeline by default.
+    """
+    settings = buildout['settings']
+    if name in settings:
+        return settings[name]
+    buildout_directory = buildout['buildout']['directory']
+    return os.path.join(buildout_directory, 'var/pipeline/%s.db' % name)
+
+
+def check_cached(cache_path, jobs, check, kinds, workers=None):
+    """
+    Run the check for every job, given as a tuple of paths, over a pool of
+    worker threads, unless the cache has a result of one of the kinds for
+    the files. The check returns the error message or None, and whether the
+    result can be cached. New results are cached as the first kind.
+
+    Returns a list of (job, error message) tuples for the failed jobs.
+    """
+    cache = FileCache(cache_path)
+    try:
+        errors = []
+        pending = []
+        keys = {}
+        for job in jobs:
+            key = identity_key(*job)
+            keys[job] = key
+            cached = None
+            for kind in kinds:
+                cached = cache.get(key, kind)
+                if cached is not None:
+                    break
+            if cached is None:
+                pending.append(job)
+            elif cached['error'] is not None:
+                errors.append((job, cached['error']))
+
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        workers = max(1, min(workers, len(pending)))
+        if workers == 1:
+            results = [check(job) for job in pending]
+        else:
+            pool = ThreadPool(workers)
+            try:
+                results = pool.map(check, pending, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+
+        for job, (error, cacheable) in zip(pending, results):
+            if cacheable:
+                cache.set(keys[job], kinds[0], ' '.join(job),
+                          {'error': error})
+            if error is not None:
+                errors.append((job, error))
+    finally:
+        cache.close()
+    return errors
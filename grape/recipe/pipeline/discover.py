@@ -0,0 +1,160 @@
+"""
+Discovery of the read files, genome and annotation for quick mode.
+
+Sequencing deliveries come as nested folders with many lane files. The
+folder of the buildout is searched recursively, without following links to
+folders, and without going into the folders of buildout itself. The
+directory entries are listed with scandir if it is installed, which saves a
+stat for every file, or else with os.listdir.
+
+The two mates of a pair are recognized by their file names, which only
+differ in the mate number:
+
+    SampleA_S1_L001_R1_001.fastq.gz     SampleA_S1_L001_R2_001.fastq.gz
+    SampleA.R1.fastq.gz                 SampleA.R2.fastq.gz
+    SampleA_1.fastq.gz                  SampleA_2.fastq.gz
+
+The files are grouped by sample, which is the file name before the sample
+number, lane, mate and chunk, so that all the lanes of a sample go into
+the same run.
+"""
+
+import os
+import re
+import stat
+
+try:
+    from os import scandir  # pylint: disable=E0611
+except ImportError:
+    try:
+        from scandir import scandir  # pylint: disable=F0401
+    except ImportError:
+        scandir = None
+
+READ_SUFFIXES = ('.fastq.gz', '.fq.gz')
+
+# Folders of buildout that never hold the input of quick mode
+SKIPPED_FOLDERS = ('bin', 'develop-eggs', 'downloads', 'eggs', 'parts',
+                   'src', 'var')
+
+READ_PATTERN = re.compile(r'^(?P<sample>.+?)'
+                          r'(?P<number>_S\d+)?'
+                          r'(?P<lane>_L\d{3})?'
+                          r'(?P<mate>[._](?:R)?[12])'
+                          r'(?P<chunk>_\d{3})?'
+                          r'(?P<suffix>\.f(?:ast)?q\.gz)$')
+
+
+def list_folder(folder):
+    """
+    Return the names of the files and of the folders in the folder. Links
+    to folders are not returned as folders.
+    """
+    files = []
+    folders = []
+    if scandir is not None:
+        for entry in scandir(folder):
+            if entry.is_dir(follow_symlinks=False):
+                folders.append(entry.name)
+            else:
+                files.append(entry.name)
+        return files, folders
+    for name in os.listdir(folder):
+        if stat.S_ISDIR(os.lstat(os.path.join(folder, name)).st_mode):
+            folders.append(name)
+        else:
+            files.append(name)
+    return files, folders
+
+
+def walk_files(top, suffixes, skipped=SKIPPED_FOLDERS):
+    """
+    Generate the paths of the files below the top folder with one of the
+    suffixes, in sorted order. Hidden folders and the skipped folders at
+    the top are not searched.
+    """
+    stack = [top]
+    while stack:
+        folder = stack.pop()
+        files, folders = list_folder(folder)
+        for name in sorted(files):
+            if name.endswith(suffixes):
+                yield os.path.join(folder, name)
+        for name in sorted(folders, reverse=True):
+            if name.startswith('.'):
+                continue
+            if folder == top and name in skipped:
+                continue
+            stack.append(os.path.join(folder, name))
+
+
+def find_file(paths, suffixes, description):
+    """Return the one file of the paths with one of the suffixes"""
+    found = [path for path in paths if path.endswith(suffixes)]
+    if len(found) != 1:
+        template = "Please provide just one %s file. Found: %s"
+        raise AttributeError(template % (description, found))
+    return found[0]
+
+
+def parse_read_name(path):
+    """
+    Return the sample, the name of the pair without the mate number, and
+    the mate number of a read file. Files without a mate number are their
+    own pair, with mate None.
+    """
+    name = os.path.basename(path)
+    match = READ_PATTERN.match(name)
+    if match is None:
+        for suffix in READ_SUFFIXES:
+            if name.endswith(suffix):
+                name = name[:-len(suffix)]
+        return name, os.path.join(os.path.dirname(path), name), None
+    mate = match.group('mate')[-1]
+    unit = name[:match.start('mate')] + name[match.end('mate'):]
+    return (match.group('sample'), os.path.join(os.path.dirname(path), unit),
+            mate)
+
+
+def sample_name(name):
+    """Return the sample name made safe for the name of a part"""
+    return re.sub(r'[^A-Za-z0-9_.-]', '_', name)
+
+
+def group_reads(paths):
+    """
+    Group the read files by sample, and pair their mates. Returns a
+    dictionary from the sample to whether it is paired, and its reads as a
+    list of pair id, mate id and path. A sample is only paired if all its
+    files have a mate.
+    """
+    units = {}
+    for path in paths:
+        sample, unit, mate = parse_read_name(path)
+        units.setdefault(sample_name(sample), {}).setdefault(
+            unit, []).append((mate, path))
+    samples = {}
+    for sample, sample_units in units.items():
+        paired = True
+        for unit_mates in sample_units.values():
+            if sorted([number for number, _ in unit_mates]) != ['1', '2']:
+                paired = False
+        reads = []
+        for index, unit in enumerate(sorted(sample_units)):
+            for mate, path in sorted(sample_units[unit]):
+                if paired:
+                    pair_id = "%s_%s" % (sample, index + 1)
+                    reads.append((pair_id, "%s.%s" % (pair_id, mate), path))
+                else:
+                    pair_id = "%s_%s" % (sample, len(reads) + 1)
+                    reads.append((pair_id, pair_id, path))
+        samples[sample] = {'paired': paired, 'reads': reads}
+    return samples
+
+
+def discover_samples(top):
+    """Return the samples of the read files below the top folder"""
+    samples = group_reads(walk_files(top, READ_SUFFIXES))
+    if not samples:
+        raise AttributeError("Please drop *.fastq.gz files into this folder")
+    return samples
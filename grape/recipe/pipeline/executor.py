@@ -0,0 +1,209 @@
+"""
+Run the pipelines of many parts on one machine.
+
+On machines with many cores and much memory, the pipelines can run without
+a cluster. This module runs the start.sh and execute.sh scripts of all the
+prepared parts of the runs section, as many at a time as fit into the cores
+and memory of the machine, given the THREADS and FLUXMEM pipeline options of
+every part:
+
+    bin/grape-run-parts -c buildout.cfg
+
+The output of every pipeline, which also goes to its pipeline.log, is
+printed with the name of the part in front of every line, and the
+throughput is reported whenever a part finishes.
+"""
+
+import os
+import sys
+import time
+import optparse
+import threading
+import subprocess
+import multiprocessing
+
+from grape.recipe.pipeline import batch
+from grape.recipe.pipeline import jobarray
+from grape.recipe.pipeline.sizing import machine_memory
+
+COMMAND = "./start.sh && ./execute.sh"
+
+
+class Job(object):
+    """
+    The pipeline of one part, with the cores and memory it needs.
+    """
+
+    def __init__(self, location, threads, memory):
+        """The memory is in gigabytes"""
+        self.location = location
+        self.name = os.path.basename(location)
+        self.threads = threads
+        self.memory = memory or 0
+        self.process = None
+        self.reader = None
+        self.started = None
+        self.finished = None
+
+    def fit(self, cores, memory):
+        """Limit the job to the whole machine, so it can run on its own"""
+        if self.threads > cores or (memory and self.memory > memory):
+            print "Warning! %s needs more than the machine has" % self.name
+        self.threads = min(self.threads, cores)
+        if memory:
+            self.memory = min(self.memory, memory)
+
+
+def get_jobs(buildout, names=None):
+    """Return the jobs of the prepared parts in the order of the runs"""
+    if names is None:
+        names = batch.get_part_names(buildout)
+    jobs = []
+    groups = jobarray.group_parts(buildout, names)
+    for (threads, fluxmem, _), locations in groups.items():
+        for location in locations:
+            jobs.append(Job(location, threads, fluxmem))
+    # The part name is the last part of the location
+    jobs.sort(key=lambda job: names.index(job.name))
+    return jobs
+
+
+def pick_jobs(waiting, cores, memory):
+    """
+    Return the waiting jobs that fit into the free cores and memory, taking
+    them in order and letting smaller jobs fill the gaps.
+    """
+    picked = []
+    for job in waiting:
+        if job.threads <= cores and (memory is None or job.memory <= memory):
+            picked.append(job)
+            cores -= job.threads
+            if memory is not None:
+                memory -= job.memory
+    return picked
+
+
+def stream_output(job, output, lock):
+    """Print the output of the job, line by line"""
+    for line in iter(job.process.stdout.readline, ''):
+        lock.acquire()
+        try:
+            output.write("[%s] %s" % (job.name, line))
+            output.flush()
+        finally:
+            lock.release()
+    job.process.stdout.close()
+
+
+def start_job(job, command, output, lock):
+    """Start the pipeline of the job in its part"""
+    job.started = time.time()
+    job.process = subprocess.Popen(['/bin/bash', '-c', command],
+                                   cwd=job.location,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT)
+    job.reader = threading.Thread(target=stream_output,
+                                  args=(job, output, lock))
+    job.reader.daemon = True
+    job.reader.start()
+
+
+def report_throughput(job, done, total, started, output, lock):
+    """Print the throughput when a job has finished"""
+    elapsed = time.time() - started
+    rate = done * 3600.0 / max(elapsed, 0.001)
+    lock.acquire()
+    try:
+        template = ("Finished %s with exit code %s in %.1fs, "
+                    "%s/%s parts done, %.1f parts/hour\n")
+        output.write(template % (job.name, job.process.returncode,
+                                 job.finished - job.started, done, total,
+                                 rate))
+        output.flush()
+    finally:
+        lock.release()
+
+
+def run_jobs(jobs, cores=None, memory=None, command=COMMAND,
+             output=sys.stdout, interval=0.5):
+    """
+    Run the jobs, as many at a time as fit into the cores and the memory in
+    gigabytes. By default, these are the cores and memory of the machine.
+
+    Returns a summary with the exit code of every part.
+    """
+    if cores is None:
+        cores = multiprocessing.cpu_count()
+    if memory is None:
+        memory = machine_memory()
+    for job in jobs:
+        job.fit(cores, memory)
+    lock = threading.Lock()
+    started = time.time()
+    waiting = list(jobs)
+    running = []
+    finished = []
+    busy_seconds = 0.0
+    while waiting or running:
+        for job in list(running):
+            if job.process.poll() is None:
+                continue
+            job.finished = time.time()
+            job.reader.join()
+            running.remove(job)
+            finished.append(job)
+            busy_seconds += job.threads * (job.finished - job.started)
+            report_throughput(job, len(finished), len(jobs), started,
+                              output, lock)
+        free_cores = cores - sum([job.threads for job in running])
+        free_memory = None
+        if memory is not None:
+            free_memory = memory - sum([job.memory for job in running])
+        for job in pick_jobs(waiting, free_cores, free_memory):
+            waiting.remove(job)
+            running.append(job)
+            start_job(job, command, output, lock)
+        if running:
+            time.sleep(interval)
+    elapsed = time.time() - started
+    summary = {'seconds': elapsed,
+               'parts': len(finished),
+               'parts_per_hour': len(finished) * 3600.0 / max(elapsed, 0.001),
+               'core_usage': busy_seconds / max(cores * elapsed, 0.001),
+               'exit_codes': dict([(job.location, job.process.returncode)
+                                   for job in finished])}
+    return summary
+
+
+def main(args=None):
+    """
+    Entry point of the grape-run-parts console script.
+    """
+    parser = optparse.OptionParser(usage="%prog [options] [part ...]")
+    parser.add_option('-c', '--config', dest='config',
+                      default='buildout.cfg',
+                      help="The buildout configuration file")
+    parser.add_option('-j', '--cores', dest='cores', type='int',
+                      default=None,
+                      help="Number of cores to use (default: all)")
+    parser.add_option('-m', '--memory', dest='memory', type='int',
+                      default=None,
+                      help="Gigabytes of memory to use (default: all)")
+    options, names = parser.parse_args(args)
+    buildout = batch.load_buildout(options.config)
+    jobs = get_jobs(buildout, names or None)
+    summary = run_jobs(jobs, options.cores, options.memory)
+    failed = [location for location, code in summary['exit_codes'].items()
+              if code != 0]
+    print "Ran %s parts in %.1fs, %.1f parts/hour, %.0f%% of the cores used" \
+        % (summary['parts'], summary['seconds'], summary['parts_per_hour'],
+           summary['core_usage'] * 100)
+    for location in sorted(failed):
+        print "Failed:", location
+    if failed:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,63 @@
+"""
+Cheap fingerprints of files, folders and buildout sections.
+
+The fingerprints are based on file metadata only (no content is read), so
+that they can be computed on every buildout run to find out whether
+anything has changed since the last installation.
+"""
+
+import os
+import hashlib
+
+
+def file_identity(path):
+    """
+    Return the identity of a file as a list of device, inode, size and
+    modification time, or None if the file does not exist.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime]
+
+
+def digest(values):
+    """Return an md5 hex digest of the repr of the values"""
+    return hashlib.md5(repr(values)).hexdigest()
+
+
+def tree_fingerprint(folder):
+    """
+    Fingerprint of a folder tree, based on the relative paths, sizes and
+    modification times of all the files and folders in it.
+    """
+    if not os.path.isdir(folder):
+        return None
+    values = []
+    for dirpath, dirnames, filenames in os.walk(folder, followlinks=True):
+        dirnames.sort()
+        relative = os.path.relpath(dirpath, folder)
+        for filename in sorted(filenames):
+            stat = os.stat(os.path.join(dirpath, filename))
+            values.append((os.path.join(relative, filename),
+                           stat.st_size,
+                           stat.st_mtime))
+    return digest(values)
+
+
+def section_fingerprint(section, ignore=()):
+    """
+    Fingerprint of a buildout section, or of any other mapping, based on its
+    keys and values. Keys given in ignore are left out.
+    """
+    if section is None:
+        return None
+    values = [(key, value) for key, value in sorted(section.items())
+              if not key in ignore]
+    return digest(values)
+
+
+def paths_fingerprint(paths):
+    """Fingerprint of the identities of a list of paths"""
+    return digest([(path, file_identity(path)) for path in paths])
@@ -0,0 +1,248 @@
+"""
+Registry of GEM indices shared by all parts and projects.
+
+By default every part links to the var/GEMIndices folder of its buildout,
+which knows nothing about the genomes the indices were built from. With a
+registry, every index gets its own folder, keyed by the content of the
+GENOMESEQ file and the version of the mapper:
+
+    [settings]
+    gemindices_registry = /data/gemindices
+    gem_index_command = gem-indexer -i %(genome)s -o %(folder)s/%(name)s
+
+The GEMIndices link of every part points to the folder of its index in the
+registry:
+
+    /data/gemindices/GEM-0123456789abcdef/
+        index.json
+        .lock
+
+The index.json file records the genome, the mapper, the parts using the
+index and when it was last used. When a gem_index_command is given, the index
+is built once when the first part is prepared. Parts prepared at the same
+time wait for the lock of the builder instead of building the same index
+again.
+
+With the gemindices_budget setting, or with the grape-gemindices script, the
+least recently used indices are removed when the registry is over its size
+budget. Indices that parts still link to are never removed:
+
+    bin/grape-gemindices -r /data/gemindices evict -b 500G
+"""
+
+import os
+import sys
+import json
+import time
+import optparse
+import subprocess
+
+from grape.recipe.pipeline import lru
+from grape.recipe.pipeline import fingerprint
+from grape.recipe.pipeline.sync import file_hash
+from grape.recipe.pipeline.cache import FileCache
+from grape.recipe.pipeline.cache import identity_key
+from grape.recipe.pipeline.lock import lock_folder
+from grape.recipe.pipeline.jsonfile import write_json
+
+
+def content_hash(path, cache_path):
+    """
+    Return the md5 hex digest of the content of a file. Genomes are big, so
+    the digest is cached by file identity.
+    """
+    cache = FileCache(cache_path)
+    try:
+        key = identity_key(path)
+        result = cache.get(key, 'md5')
+        if result is None:
+            result = file_hash(path)
+            cache.set(key, 'md5', path, result)
+    finally:
+        cache.close()
+    # The cache returns unicode, which would change the keys made from it
+    return str(result)
+
+
+def mapper_version(buildout, mapper, cache_path):
+    """
+    Return the version of the mapper: the gem_version setting, or else the
+    content hash of the gem-indexer binary.
+    """
+    settings = buildout['settings']
+    if settings.get('gem_version', ''):
+        return settings['gem_version']
+    folder_key = 'gem_folder'
+    if mapper.lower().startswith('next'):
+        folder_key = 'nextgem_folder'
+    indexer = os.path.join(settings.get(folder_key, ''), 'gem-indexer')
+    if os.path.exists(indexer):
+        return content_hash(indexer, cache_path)
+    return 'unknown'
+
+
+def index_name(mapper, key):
+    """
+    Return the name of the folder of an index in the registry. The same
+    genome may have different file names, so the name only depends on the
+    key.
+    """
+    return "%s-%s" % (mapper, key[:16])
+
+
+def read_metadata(folder):
+    """Return the metadata of an index, or None if there is none"""
+    path = os.path.join(folder, 'index.json')
+    if not os.path.exists(path):
+        return None
+    metadata_file = open(path)
+    try:
+        return json.load(metadata_file)
+    finally:
+        metadata_file.close()
+
+
+def write_metadata(folder, metadata):
+    """Write the metadata of an index, replacing it in one rename"""
+    write_json(os.path.join(folder, 'index.json'), metadata)
+
+
+def build_index(folder, metadata, command):
+    """Run the index command in the folder of the index"""
+    values = {'genome': metadata['genome'],
+              'folder': folder,
+              'name': metadata['name']}
+    print "Building GEM index %s" % metadata['name']
+    started = time.time()
+    code = subprocess.call(command % values, shell=True, cwd=folder)
+    if code != 0:
+        raise AttributeError("Building the GEM index %s failed with exit "
+                             "code %s" % (metadata['name'], code))
+    metadata['status'] = 'complete'
+    metadata['build_seconds'] = time.time() - started
+
+
+def register_index(buildout, pipeline, location, build=True):
+    """
+    Return the folder of the index of the part in the registry. The folder
+    and its metadata are made if needed, and with the gem_index_command
+    setting, the index is built unless build is False.
+    """
+    settings = buildout['settings']
+    registry = settings['gemindices_registry']
+    genome = pipeline.get('GENOMESEQ', '')
+    if not os.path.exists(genome):
+        raise AttributeError("Genome not found for the GEM index: %s" %
+                             genome)
+    mapper = pipeline.get('MAPPER', 'GEM')
+    cache_path = os.path.join(registry, 'fingerprints.db')
+    genome_hash = content_hash(genome, cache_path)
+    version = mapper_version(buildout, mapper, cache_path)
+    key = fingerprint.digest([genome_hash, mapper, version])
+    name = index_name(mapper, key)
+    folder = os.path.join(registry, name)
+    if not build:
+        return folder
+    lock = lock_folder(folder)
+    try:
+        metadata = read_metadata(folder)
+        if metadata is None:
+            metadata = {'name': name,
+                        'genome': os.path.abspath(genome),
+                        'genome_md5': genome_hash,
+                        'mapper': mapper,
+                        'mapper_version': version,
+                        'status': 'registered',
+                        'parts': []}
+        command = settings.get('gem_index_command', '')
+        if command and metadata['status'] != 'complete':
+            build_index(folder, metadata, command)
+        if not location in metadata['parts']:
+            metadata['parts'].append(location)
+            metadata['parts'].sort()
+        metadata['last_used'] = time.time()
+        write_metadata(folder, metadata)
+    finally:
+        lock.release()
+    return folder
+
+
+def live_parts(folder, metadata):
+    """Return the parts whose GEMIndices link still points to the index"""
+    parts = []
+    for location in metadata.get('parts', []):
+        link = os.path.join(location, 'GEMIndices')
+        try:
+            if os.readlink(link) == folder:
+                parts.append(location)
+        except OSError:
+            pass
+    return parts
+
+
+def evict_indices(registry, budget, dry_run=False):
+    """
+    Remove the least recently used indices until the registry is within the
+    budget in bytes. Indices that parts link to, or that are being built,
+    are never removed. The parts that no longer link to an index are
+    dropped from its metadata.
+
+    Returns the entries of the removed indices.
+    """
+    return lru.evict_folders(registry, budget, read_metadata, write_metadata,
+                             live_parts, dry_run)
+
+
+def evict_once(buildout):
+    """
+    Keep the registry within the gemindices_budget setting. This is done
+    once per buildout run.
+    """
+    settings = buildout['settings']
+    return lru.evict_once(settings['gemindices_registry'],
+                          settings['gemindices_budget'], evict_indices,
+                          'GEM index')
+
+
+def main(args=None):
+    """
+    Entry point of the grape-gemindices console script.
+    """
+    usage = ("%prog -r REGISTRY list\n"
+             "       %prog -r REGISTRY evict -b BUDGET [-n]")
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option('-r', '--registry', dest='registry',
+                      help="The folder of the GEM index registry")
+    parser.add_option('-b', '--budget', dest='budget', default=None,
+                      help="Size budget of the registry, like 500G")
+    parser.add_option('-n', '--dry-run', dest='dry_run', action='store_true',
+                      default=False,
+                      help="Only print what would be removed")
+    options, args = parser.parse_args(args)
+    if options.registry is None or len(args) != 1:
+        parser.error("Give the registry and a command")
+    if args[0] == 'list':
+        for folder in lru.locked_folders(options.registry):
+            metadata = read_metadata(folder) or {}
+            last_used = time.strftime('%Y-%m-%d %H:%M', time.localtime(
+                metadata.get('last_used', 0)))
+            print "%s\t%s\t%s\t%s parts\t%s" % (
+                os.path.basename(folder),
+                lru.format_size(lru.path_size(folder)), last_used,
+                len(live_parts(folder, metadata)), metadata.get('genome'))
+    elif args[0] == 'evict':
+        if options.budget is None:
+            parser.error("Give the size budget")
+        evictions = evict_indices(options.registry,
+                                  lru.parse_size(options.budget),
+                                  options.dry_run)
+        for entry in evictions:
+            print "Removed %s (%s)" % (entry.path,
+                                       lru.format_size(entry.size))
+    else:
+        parser.error("Unknown command: %s" % args[0])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,202 @@
+"""
+Job array submission scripts for all the parts of a buildout.
+
+Instead of submitting the start.sh and execute.sh scripts of every part as
+separate jobs, the parts of the runs section are grouped by their THREADS,
+FLUXMEM and CLUSTER pipeline options, and every group becomes one job array
+for SGE or Slurm:
+
+    bin/grape-job-array -c buildout.cfg -s slurm
+    var/pipeline/jobs/submit.slurm.sh
+
+Each task of an array runs the start.sh and execute.sh scripts of the part
+on the line of the task in the tasks file of the group.
+"""
+
+import os
+import re
+import sys
+import optparse
+
+from grape.recipe.pipeline import batch
+from grape.recipe.pipeline import prepare
+from grape.recipe.pipeline import sizing
+from grape.recipe.pipeline.accessiondb import get_section
+
+SCHEDULERS = ('sge', 'slurm')
+
+SGE_TEMPLATE = """#!/bin/bash
+#$ -N %(name)s
+#$ -t 1-%(tasks)s
+#$ -S /bin/bash
+#$ -o %(logs)s
+#$ -e %(logs)s
+%(resources)s
+PART=$(sed -n "${SGE_TASK_ID}p" %(task_file)s)
+cd "$PART" && ./start.sh && ./execute.sh
+"""
+
+SLURM_TEMPLATE = """#!/bin/bash
+#SBATCH --job-name=%(name)s
+#SBATCH --array=1-%(tasks)s
+#SBATCH --output=%(logs)s/%%x_%%A_%%a.log
+%(resources)s
+PART=$(sed -n "${SLURM_ARRAY_TASK_ID}p" %(task_file)s)
+cd "$PART" && ./start.sh && ./execute.sh
+"""
+
+SUBMIT_COMMANDS = {'sge': 'qsub', 'slurm': 'sbatch'}
+
+
+def get_resources(options, buildout):
+    """
+    Return the (threads, fluxmem, cluster) resources of a part, taken from
+    its pipeline options, or from its start.sh script when they are auto.
+    The memory is in gigabytes, and it is None, like the cluster, when it
+    is not given.
+    """
+    pipeline = prepare.get_pipeline(options, buildout)
+    if sizing.is_auto(pipeline):
+        # The values estimated for the part are in its start.sh script
+        estimated = sizing.read_sizing(options['location'])
+        for key in ['FLUXMEM', 'THREADS']:
+            if pipeline.get(key, '') != sizing.AUTO:
+                continue
+            if not key in estimated:
+                raise AttributeError("%s is auto, but %s has not been sized"
+                                     % (key, options['location']))
+            pipeline[key] = str(estimated[key])
+    threads = int(prepare.parse_integer(str(pipeline.get('THREADS', '1'))))
+    fluxmem = None
+    if pipeline.get('FLUXMEM', ''):
+        fluxmem = int(prepare.parse_flux_mem(pipeline['FLUXMEM']))
+    cluster = pipeline.get('CLUSTER', '') or None
+    return threads, fluxmem, cluster
+
+
+def group_name(resources):
+    """Return a file name for the group of parts with these resources"""
+    threads, fluxmem, cluster = resources
+    name = 't%s' % threads
+    if fluxmem is not None:
+        name += '_m%sG' % fluxmem
+    if cluster is not None:
+        name += '_%s' % re.sub(r'[^A-Za-z0-9_.-]', '_', cluster)
+    return name
+
+
+def group_parts(buildout, names=None):
+    """
+    Return the locations of the prepared parts, keyed by their resources.
+    """
+    if names is None:
+        names = batch.get_part_names(buildout)
+    groups = {}
+    for name in names:
+        options = batch.get_part_options(buildout, name)
+        try:
+            get_section(buildout, options['accession'])
+        except KeyError:
+            print "Accession not found", options['accession']
+            continue
+        execute = os.path.join(options['location'], 'execute.sh')
+        if not os.path.exists(execute):
+            print "Part not prepared", name
+            continue
+        resources = get_resources(options, buildout)
+        groups.setdefault(resources, []).append(options['location'])
+    return groups
+
+
+def resource_lines(scheduler, resources):
+    """Return the resource requests of a task in the script header"""
+    threads, fluxmem, cluster = resources
+    lines = []
+    if scheduler == 'sge':
+        lines.append("#$ -pe smp %s" % threads)
+        if fluxmem is not None:
+            # h_vmem is requested per slot
+            memory = (fluxmem + threads - 1) // threads
+            lines.append("#$ -l h_vmem=%sG" % memory)
+        if cluster is not None:
+            lines.append("#$ -q %s" % cluster)
+    else:
+        lines.append("#SBATCH --cpus-per-task=%s" % threads)
+        if fluxmem is not None:
+            lines.append("#SBATCH --mem=%sG" % fluxmem)
+        if cluster is not None:
+            lines.append("#SBATCH --partition=%s" % cluster)
+    return lines
+
+
+def write_script(path, content):
+    """Write an executable script"""
+    script = open(path, 'w')
+    script.write(content)
+    script.close()
+    os.chmod(path, 0755)
+
+
+def write_job_arrays(buildout, scheduler, names=None, folder=None):
+    """
+    Write one job array script per group of parts with the same resources,
+    the tasks file of every group, and a script submitting all the arrays.
+    By default, the scripts are written to var/pipeline/jobs.
+
+    Returns the path of the submit script.
+    """
+    if not scheduler in SCHEDULERS:
+        raise AttributeError("Unknown scheduler: %s" % scheduler)
+    if folder is None:
+        buildout_directory = buildout['buildout']['directory']
+        folder = os.path.join(buildout_directory, 'var/pipeline/jobs')
+    logs = os.path.join(folder, 'logs')
+    if not os.path.exists(logs):
+        os.makedirs(logs)
+    template = {'sge': SGE_TEMPLATE, 'slurm': SLURM_TEMPLATE}[scheduler]
+    submit = ["#!/bin/bash"]
+    groups = group_parts(buildout, names)
+    for resources in sorted(groups.keys()):
+        locations = groups[resources]
+        name = group_name(resources)
+        task_file = os.path.join(folder, '%s.tasks' % name)
+        tasks = open(task_file, 'w')
+        tasks.write(''.join(["%s\n" % location for location in locations]))
+        tasks.close()
+        script = os.path.join(folder, '%s.%s.sh' % (name, scheduler))
+        values = {'name': 'grape_%s' % name,
+                  'tasks': len(locations),
+                  'logs': logs,
+                  'resources': '\n'.join(resource_lines(scheduler,
+                                                        resources)),
+                  'task_file': task_file}
+        write_script(script, template % values)
+        submit.append("%s %s" % (SUBMIT_COMMANDS[scheduler], script))
+    submit_script = os.path.join(folder, 'submit.%s.sh' % scheduler)
+    write_script(submit_script, '\n'.join(submit) + '\n')
+    return submit_script
+
+
+def main(args=None):
+    """
+    Entry point of the grape-job-array console script.
+    """
+    parser = optparse.OptionParser(usage="%prog [options] [part ...]")
+    parser.add_option('-c', '--config', dest='config',
+                      default='buildout.cfg',
+                      help="The buildout configuration file")
+    parser.add_option('-s', '--scheduler', dest='scheduler', default='sge',
+                      help="sge or slurm (default: sge)")
+    parser.add_option('-o', '--output', dest='folder', default=None,
+                      help="Folder of the scripts "
+                           "(default: var/pipeline/jobs)")
+    options, names = parser.parse_args(args)
+    buildout = batch.load_buildout(options.config)
+    submit_script = write_job_arrays(buildout, options.scheduler,
+                                     names or None, options.folder)
+    print "Submit the job arrays with %s" % submit_script
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,24 @@
+"""
+Atomic writes of the JSON files of the recipe.
+
+Manifests, cache entries, registries and reports may be read by other
+processes while they are written, so they are written to a temporary file
+first, and moved into place in one rename.
+"""
+
+import os
+import json
+
+
+def write_json(path, content):
+    """Write the content as JSON, replacing the file in one rename"""
+    folder = os.path.dirname(path)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+    temporary = "%s.%s.tmp" % (path, os.getpid())
+    output = open(temporary, 'w')
+    try:
+        json.dump(content, output, indent=1, sort_keys=True)
+    finally:
+        output.close()
+    os.rename(temporary, path)
@@ -0,0 +1,80 @@
+"""
+Locks on folders shared by many processes and machines.
+
+The locks are fcntl locks on a .lock file in the folder, which also work on
+NFS. They are held per process, so the threads of one process do not
+exclude each other.
+"""
+
+import os
+import errno
+import shutil
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class FolderLock(object):
+    """
+    An exclusive lock on a folder.
+    """
+
+    def __init__(self, folder, wait=True):
+        """
+        Wait until the lock is ours. Without waiting, an IOError is raised
+        if another process holds the lock.
+        """
+        if fcntl is None:
+            raise AttributeError("Folder locks need fcntl")
+        self.lock_file = open(os.path.join(folder, '.lock'), 'a')
+        operation = fcntl.LOCK_EX
+        if not wait:
+            operation |= fcntl.LOCK_NB
+        try:
+            fcntl.lockf(self.lock_file, operation)
+        except IOError:
+            self.lock_file.close()
+            raise
+
+    def release(self):
+        """Let the next process in"""
+        fcntl.lockf(self.lock_file, fcntl.LOCK_UN)
+        self.lock_file.close()
+
+
+def lock_folder(folder):
+    """
+    Make the folder if needed and lock it. If the folder is removed before
+    the lock file is opened, or while waiting for the lock, it is made and
+    locked again.
+    """
+    while True:
+        if not os.path.exists(folder):
+            try:
+                os.makedirs(folder)
+            except OSError:
+                # Another process made it in the meantime
+                if not os.path.isdir(folder):
+                    raise
+        try:
+            lock = FolderLock(folder)
+        except IOError as error:
+            # An evictor removed the folder after it was made
+            if error.errno == errno.ENOENT:
+                continue
+            raise
+        if os.path.exists(os.path.join(folder, '.lock')):
+            return lock
+        lock.release()
+
+
+def remove_folder(folder):
+    """
+    Remove a locked folder. It is renamed first, so that nobody finds it
+    half removed.
+    """
+    parent, name = os.path.split(folder)
+    removed = os.path.join(parent, '.removed-%s-%s' % (name, os.getpid()))
+    os.rename(folder, removed)
+    shutil.rmtree(removed)
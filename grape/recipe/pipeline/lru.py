@@ -0,0 +1,158 @@
+"""
+Least recently used eviction for shared folders with a size budget.
+
+Shared caches, like the GEM index registry, keep one entry per folder or
+file. Every entry has a size, a last use time, and may be referenced by
+parts that still need it. When the total size is over the budget, the
+least recently used entries that are not referenced are removed first.
+
+The caches made of locked folders, like the GEM index registry, the staging
+cache and the shard cache, are evicted with evict_folders. Every folder has
+a .lock file and metadata with the parts using it and its last use, and a
+folder is referenced while one of those parts still links to it.
+"""
+
+import os
+import re
+import time
+
+from grape.recipe.pipeline.lock import FolderLock
+from grape.recipe.pipeline.lock import remove_folder
+
+SIZE_UNITS = {'': 1,
+              'K': 1024,
+              'M': 1024 ** 2,
+              'G': 1024 ** 3,
+              'T': 1024 ** 4}
+
+# The caches evicted by this process
+EVICTED = set()
+
+
+def parse_size(value):
+    """Parse a size like 500G into a number of bytes"""
+    match = re.match(r'^\s*(\d+)\s*([KMGT]?)B?\s*$', value.upper())
+    if match is None:
+        raise AttributeError("Not a size: %s" % value)
+    return int(match.group(1)) * SIZE_UNITS[match.group(2)]
+
+
+def format_size(size):
+    """Format a number of bytes for people"""
+    for unit in ['T', 'G', 'M', 'K']:
+        if size >= SIZE_UNITS[unit]:
+            return "%.1f%s" % (float(size) / SIZE_UNITS[unit], unit)
+    return "%s" % size
+
+
+def path_size(path):
+    """Return the size of a file, or of all the files in a folder"""
+    if not os.path.isdir(path) or os.path.islink(path):
+        return os.lstat(path).st_size
+    size = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            size += os.lstat(os.path.join(dirpath, filename)).st_size
+    return size
+
+
+class Entry(object):
+    """
+    One entry of a shared cache.
+    """
+
+    def __init__(self, path, size, last_used, referenced=False):
+        """The last use is a time stamp"""
+        self.path = path
+        self.size = size
+        self.last_used = last_used
+        self.referenced = referenced
+
+
+def select_evictions(entries, budget):
+    """
+    Return the entries to remove so that the total size gets within the
+    budget, least recently used first. Referenced entries are never
+    selected, so the total may stay over the budget.
+    """
+    total = sum([entry.size for entry in entries])
+    evictions = []
+    candidates = [entry for entry in entries if not entry.referenced]
+    candidates.sort(key=lambda entry: entry.last_used)
+    for entry in candidates:
+        if total <= budget:
+            break
+        evictions.append(entry)
+        total -= entry.size
+    return evictions
+
+
+def locked_folders(cache):
+    """Return the folders of a cache made of locked folders"""
+    if not os.path.isdir(cache):
+        return []
+    folders = []
+    for name in sorted(os.listdir(cache)):
+        folder = os.path.join(cache, name)
+        if os.path.exists(os.path.join(folder, '.lock')):
+            folders.append(folder)
+    return folders
+
+
+def evict_folders(cache, budget, read_metadata, write_metadata, live_parts,
+                  dry_run=False, in_use=None):
+    """
+    Remove the least recently used folders of the cache until it is within
+    the budget in bytes. Folders that are locked, that live parts link to,
+    or for which in_use(folder, metadata) is true, are never removed. The
+    parts that no longer link to a folder are dropped from its metadata.
+
+    The metadata is read with read_metadata(folder), written with
+    write_metadata(folder, metadata), and live_parts(folder, metadata)
+    returns the parts that still link to the folder.
+
+    Returns the entries of the removed folders.
+    """
+    entries = []
+    locks = {}
+    try:
+        for folder in locked_folders(cache):
+            try:
+                locks[folder] = FolderLock(folder, wait=False)
+            except IOError:
+                # Being filled right now
+                entries.append(Entry(folder, path_size(folder), time.time(),
+                                     True))
+                continue
+            metadata = read_metadata(folder) or {}
+            parts = live_parts(folder, metadata)
+            if metadata and parts != metadata.get('parts') and not dry_run:
+                metadata['parts'] = parts
+                write_metadata(folder, metadata)
+            referenced = bool(parts) or (in_use is not None and
+                                         in_use(folder, metadata))
+            entries.append(Entry(folder, path_size(folder),
+                                 metadata.get('last_used', 0), referenced))
+        evictions = select_evictions(entries, budget)
+        if not dry_run:
+            for entry in evictions:
+                remove_folder(entry.path)
+    finally:
+        for lock in locks.values():
+            lock.release()
+    return evictions
+
+
+def evict_once(cache, budget, evict, description):
+    """
+    Keep the cache within the budget setting with evict(cache, budget), and
+    print the removed entries. This is done once per buildout run.
+    """
+    if cache in EVICTED:
+        return []
+    EVICTED.add(cache)
+    evictions = evict(cache, parse_size(budget))
+    for entry in evictions:
+        print "Removed %s %s (%s)" % (description, entry.path,
+                                      format_size(entry.size))
+    return evictions
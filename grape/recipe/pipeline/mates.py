@@ -0,0 +1,102 @@
+"""
+Verification that the two mates of a pair belong together.
+
+The pair_id and mate_id attributes of an accession only say which read files
+are mates. If the wrong files are paired, this is only noticed after a full
+mapping run. With the verify_mates setting, both gzipped fastq files of
+every pair are streamed in lockstep, and every record of the first mate
+needs to have a record with the same read name in the second mate:
+
+    @HWI-ST227:1:1101:1234:2000#0/1     @HWI-ST227:1:1101:1234:2000 1:N:0
+    @HWI-ST227:1:1101:1234:2000#0/2     @HWI-ST227:1:1101:1234:2000 2:N:0
+
+Only the stem of the name, without the /1 and /2 suffixes and without the
+comment after the first space, is compared. Both files need to have the same
+number of records.
+
+The pairs are verified over a pool of worker threads, and the results are
+cached by the identity of both files, so that every pair is only verified
+once.
+"""
+
+import io
+import gzip
+import zlib
+import struct
+from itertools import izip
+
+from grape.recipe.pipeline.cache import check_cached
+
+MATE_SUFFIXES = ('/1', '/2')
+
+
+def read_stem(header):
+    """Return the read name of a fastq header without the mate suffix"""
+    name = header[1:].split(None, 1)
+    if not name:
+        return ''
+    name = name[0]
+    if name.endswith(MATE_SUFFIXES):
+        name = name[:-2]
+    return name
+
+
+def open_reads(path):
+    """Open a gzipped fastq file for fast reading of lines"""
+    return io.BufferedReader(gzip.open(path, 'rb'), 1024 * 1024)
+
+
+def compare_mates(first, second):
+    """
+    Stream the two mates in lockstep. Returns an error message, or None if
+    the mates belong together.
+    """
+    first_file = open_reads(first)
+    second_file = open_reads(second)
+    try:
+        records = 0
+        lines = izip(first_file, second_file)
+        for line_number, (first_line, second_line) in enumerate(lines):
+            if line_number % 4 != 0:
+                continue
+            first_stem = read_stem(first_line)
+            second_stem = read_stem(second_line)
+            if first_stem != second_stem:
+                template = "Record %s is %s in %s, but %s in %s"
+                return template % (records + 1, first_stem, first,
+                                   second_stem, second)
+            records += 1
+        # One of the files has ended, the other one should have too
+        for path, read_file in [(first, first_file), (second, second_file)]:
+            if read_file.readline():
+                template = "%s has more than the %s records of its mate"
+                return template % (path, records)
+    finally:
+        first_file.close()
+        second_file.close()
+    return None
+
+
+def verify_pair(pair):
+    """
+    Verify one pair, returning the error message and whether the result can
+    be cached. Pairs that can not be read are not cached.
+    """
+    first, second = pair
+    try:
+        return compare_mates(first, second), True
+    except (IOError, EOFError, struct.error, zlib.error) as error:
+        return "Can not read the mates: %s" % error, False
+
+
+def verify_pairs(pairs, cache_path, workers=None):
+    """
+    Verify that the mates of every pair, given as tuples of two paths,
+    belong together. Pairs that have been verified before are looked up in
+    the cache.
+
+    Returns a list of (pair, error message) tuples for the pairs that do not
+    belong together.
+    """
+    return check_cached(cache_path, [tuple(pair) for pair in pairs],
+                        verify_pair, ['mates'], workers)
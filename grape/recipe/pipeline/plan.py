@@ -0,0 +1,221 @@
+"""
+Plan of the files of a part.
+
+Instead of removing and making again all the links and scripts of a part,
+the desired state of the part is first collected in a plan:
+
+    plan = Plan()
+    plan.folder('parts/TestRun/readData')
+    plan.only('parts/TestRun/readData')
+    plan.symlink('parts/TestRun/readData/a.fastq.gz', '/data/a.fastq.gz')
+    plan.write('parts/TestRun/start.sh', command, 0755)
+
+The plan is then compared with what is on disk, which only needs an lstat
+or readlink for every link and file, and only the differences are applied.
+Links are replaced atomically, so running pipelines never see them missing.
+With the dry_run option of a part, the differences are printed instead.
+"""
+
+import os
+import stat
+import shutil
+
+TRUE_VALUES = ('1', 'true', 'yes', 'on')
+
+
+def is_dry_run(options):
+    """Check whether the part should only print its plan"""
+    if options.get('dry_run', '').lower() in TRUE_VALUES:
+        return True
+    return os.environ.get('GRAPE_DRY_RUN', '').lower() in TRUE_VALUES
+
+
+def remove_path(path):
+    """Remove a file, a link or a folder"""
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+
+
+def is_link_to(path, source):
+    """Check whether the path is a symbolic link to the source"""
+    try:
+        return os.readlink(path) == source
+    except OSError:
+        return False
+
+
+def swap_symlink(path, source):
+    """
+    Make the path a symbolic link to the source. A link that is already
+    there is replaced in one rename, so the path never goes missing.
+    """
+    temporary = os.path.join(os.path.dirname(path),
+                             '.%s.%s.tmp' % (os.path.basename(path),
+                                             os.getpid()))
+    if os.path.lexists(temporary):
+        os.remove(temporary)
+    os.symlink(source, temporary)
+    # A link can not replace a real folder
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    os.rename(temporary, path)
+
+
+def reconcile_symlink(path, source):
+    """
+    Make the path a symbolic link to the source, unless it already is.
+    Returns whether the link has been changed.
+    """
+    if is_link_to(path, source):
+        return False
+    swap_symlink(path, source)
+    return True
+
+
+def has_content(path, content, mode):
+    """Check whether the path is a file with the content and mode"""
+    try:
+        info = os.lstat(path)
+    except OSError:
+        return False
+    if not stat.S_ISREG(info.st_mode) or info.st_size != len(content):
+        return False
+    if mode is not None and stat.S_IMODE(info.st_mode) != mode:
+        return False
+    existing = open(path, 'rb')
+    try:
+        return existing.read() == content
+    finally:
+        existing.close()
+
+
+def make_folder(path):
+    """Make the folder, replacing a file or a broken link at the path"""
+    if os.path.lexists(path) and not os.path.isdir(path):
+        os.remove(path)
+    try:
+        os.mkdir(path)
+    except OSError:
+        # Another part may have made a shared folder in the meantime
+        if not os.path.isdir(path):
+            raise
+
+
+def write_file(path, content, mode):
+    """Write the file through a temporary file, replacing it in one rename"""
+    temporary = os.path.join(os.path.dirname(path),
+                             '.%s.%s.tmp' % (os.path.basename(path),
+                                             os.getpid()))
+    output = open(temporary, 'wb')
+    try:
+        output.write(content)
+    finally:
+        output.close()
+    if mode is not None:
+        os.chmod(temporary, mode)
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    os.rename(temporary, path)
+
+
+class Plan(object):
+    """
+    The desired folders, links and files of a part, in the order in which
+    they have to be made.
+    """
+
+    def __init__(self):
+        """Start with an empty plan"""
+        self.actions = []
+
+    def folder(self, path):
+        """The folder has to exist"""
+        self.actions.append(('folder', path, None))
+
+    def only(self, path):
+        """The folder may only contain what is planned in it"""
+        self.actions.append(('only', path, None))
+
+    def symlink(self, path, source, check=True):
+        """
+        The path has to be a symbolic link to the source. If check is set,
+        the source has to exist.
+        """
+        self.actions.append(('symlink', path, (source, check)))
+
+    def write(self, path, content, mode=None):
+        """The path has to be a file with the content and mode"""
+        self.actions.append(('write', path, (content, mode)))
+
+    def planned_names(self):
+        """Return the names planned in every folder"""
+        names = {}
+        for kind, path, _ in self.actions:
+            if kind in ['folder', 'symlink', 'write']:
+                folder, name = os.path.split(path)
+                names.setdefault(folder, set()).add(name)
+        return names
+
+    def changes(self):
+        """
+        Compare the plan with the disk, and return the actions needed to get
+        there. Entries that are not planned in the folders that may only
+        contain the planned entries are removed.
+        """
+        names = self.planned_names()
+        changes = []
+        for action in self.actions:
+            kind, path, value = action
+            if kind == 'folder':
+                if not os.path.isdir(path):
+                    changes.append(action)
+            elif kind == 'only':
+                if not os.path.isdir(path):
+                    continue
+                planned = names.get(path, set())
+                for name in sorted(os.listdir(path)):
+                    if not name in planned:
+                        changes.append(('remove', os.path.join(path, name),
+                                        None))
+            elif kind == 'symlink':
+                if not is_link_to(path, value[0]):
+                    changes.append(action)
+            elif kind == 'write':
+                if not has_content(path, value[0], value[1]):
+                    changes.append(action)
+        return changes
+
+    def apply(self, changes=None):
+        """Apply the changes, by default the changes of the whole plan"""
+        if changes is None:
+            changes = self.changes()
+        for kind, path, value in changes:
+            if kind == 'folder':
+                make_folder(path)
+            elif kind == 'remove':
+                remove_path(path)
+            elif kind == 'symlink':
+                source, check = value
+                swap_symlink(path, source)
+                if check and not os.path.exists(path):
+                    raise AttributeError(path)
+            elif kind == 'write':
+                write_file(path, value[0], value[1])
+        return changes
+
+
+def describe(changes):
+    """Return the changes as lines of text"""
+    lines = []
+    for kind, path, value in changes:
+        if kind == 'folder':
+            lines.append("mkdir %s" % path)
+        elif kind == 'remove':
+            lines.append("remove %s" % path)
+        elif kind == 'symlink':
+            lines.append("symlink %s -> %s" % (path, value[0]))
+        elif kind == 'write':
+            lines.append("write %s (%s bytes)" % (path, len(value[0])))
+    return lines
@@ -13,8 +13,31 @@ The pipeline attribute specifies the section defining the pipeline options.
 """
 
 import os
+import stat
 import shutil
 import glob
+import json
+import time
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+from grape.recipe.pipeline import sync
+from grape.recipe.pipeline import validate
+from grape.recipe.pipeline import mates
+from grape.recipe.pipeline import discover
+from grape.recipe.pipeline import sample
+from grape.recipe.pipeline import timing
+from grape.recipe.pipeline import plan
+from grape.recipe.pipeline import gemindex
+from grape.recipe.pipeline import staging
+from grape.recipe.pipeline import sizing
+from grape.recipe.pipeline import shard
+from grape.recipe.pipeline.cache import get_cache_path
+from grape.recipe.pipeline.accession import parse_accession
+from grape.recipe.pipeline.accessiondb import get_section
+from grape.recipe.pipeline.species import detect_species
+from grape.recipe.pipeline import fingerprint
+from grape.recipe.pipeline.jsonfile import write_json
 
 CUFFLINKS_BINARIES = ('cuffcompare',
                       'cuffdiff',
@@ -29,6 +52,10 @@ class InstallationState:
     The var/pipeline/bin and var/pipeline/var folders have to be reinstalled
     only once for the first part that gets installed. All of the following
     parts do not have to reinstall the contents of these folders.
+
+    The fingerprints of what has been installed are persisted in
+    var/pipeline/installation.json, so that the next buildout run can skip
+    the installation of everything that has not changed.
     """
 
     state = {}
@@ -36,6 +63,9 @@ class InstallationState:
     def __init__(self):
         """Reset the installation state"""
         self.state = {}
+        self.path = None
+        self.fingerprints = {}
+        self.current = {}
 
     def set_reinstall(self, path):
         """Call when the path has been reinstalled"""
@@ -45,45 +75,242 @@ class InstallationState:
         """Call when you need to know whether the path has been reinstalled."""
         return self.state.get(path, False)
 
+    def load(self, path):
+        """Load the persisted fingerprints, once per state file"""
+        if self.path == path:
+            return
+        self.path = path
+        self.fingerprints = {}
+        if not os.path.exists(path):
+            return
+        try:
+            state_file = open(path, 'r')
+            try:
+                self.fingerprints = json.load(state_file)
+            finally:
+                state_file.close()
+        except (IOError, ValueError):
+            self.fingerprints = {}
+
+    def save(self):
+        """Persist the fingerprints atomically"""
+        write_json(self.path, self.fingerprints)
+
+    def set_fingerprint(self, key, fingerprint):
+        """Remember the fingerprint of what has been installed for the key"""
+        self.fingerprints[key] = fingerprint
+
+    def get_fingerprint(self, key):
+        """Return the fingerprint persisted for the key"""
+        return self.fingerprints.get(key, None)
+
 INSTALLATION_STATE = InstallationState()
 
 
-def install_bin_folder(options, buildout, bin_folder):
+class ProfileCache:
+    """
+    Values computed once per pipeline profile of a buildout, by the name of
+    the profile. The buildout is kept with every value, so that another
+    buildout at the same address does not get them. Only the most recently
+    used values are kept.
+    """
+
+    def __init__(self, size):
+        """Make an empty cache for the given number of values"""
+        self.size = size
+        self.values = OrderedDict()
+
+    def get(self, buildout, key):
+        """Return the value of the key for the buildout, or None"""
+        entry = self.values.pop((id(buildout), key), None)
+        if entry is None or entry[0] is not buildout:
+            return None
+        self.values[(id(buildout), key)] = entry
+        return entry[1]
+
+    def set(self, buildout, key, value):
+        """Keep the value of the key, dropping the least recently used"""
+        self.values.pop((id(buildout), key), None)
+        self.values[(id(buildout), key)] = (buildout, value)
+        while len(self.values) > self.size:
+            self.values.popitem(last=False)
+
+
+# The merged pipeline profiles, by the name of the profile
+PROFILES = ProfileCache(64)
+
+# The compiled command templates, by the name of the profile and the
+# options set for the part. Auto sizing gives every part its own FLUXMEM and
+# THREADS, so there may be many of them.
+COMMAND_TEMPLATES = ProfileCache(256)
+
+# The options of the pipeline profile that are set for the part
+PART_OPTIONS = ('TEMPLATE', 'FLUXMEM', 'THREADS')
+
+# The files quick mode searches the buildout folder for
+QUICK_SUFFIXES = discover.READ_SUFFIXES + ('.gtf', '.fa')
+
+
+def state_file_path(buildout):
+    """Return the path of the persisted installation state"""
+    buildout_directory = buildout['buildout']['directory']
+    return os.path.join(buildout_directory, 'var/pipeline/installation.json')
+
+
+def dependency_sources(buildout):
+    """
+    Return the paths of the dependencies that are linked into
+    var/pipeline/bin
+    """
+    return [source for _, source in resolve_dependencies(buildout)]
+
+
+def shared_fingerprint(buildout):
+    """
+    Fingerprint of everything that goes into the shared var/pipeline/bin and
+    var/pipeline/lib folders. It is only computed once per buildout run.
+    """
+    if 'shared' in INSTALLATION_STATE.current:
+        return INSTALLATION_STATE.current['shared']
+    buildout_directory = buildout['buildout']['directory']
+    bin_folder = os.path.join(buildout_directory, 'src/pipeline/bin')
+    lib_folder = os.path.join(buildout_directory, 'src/pipeline/lib')
+    shared = fingerprint.digest(
+        [fingerprint.tree_fingerprint(bin_folder),
+         fingerprint.tree_fingerprint(lib_folder),
+         fingerprint.section_fingerprint(buildout['settings']),
+         fingerprint.paths_fingerprint(dependency_sources(buildout))])
+    INSTALLATION_STATE.current['shared'] = shared
+    return shared
+
+
+def part_fingerprint(options, buildout):
+    """
+    Fingerprint of everything that goes into a part: the part options, the
+    accession, the pipeline profile and the read files. Returns None if the
+    accession is not in the buildout.
+    """
+    try:
+        accession = get_section(buildout, options['accession'])
+    except KeyError:
+        return None
+    sections = [options, accession, buildout.get('pipeline')]
+    if 'pipeline' in options:
+        try:
+            sections.append(get_section(buildout, options['pipeline']))
+        except KeyError:
+            sections.append(None)
+    values = [fingerprint.section_fingerprint(section, ['experiment_id'])
+              for section in sections]
+    file_locations = accession.get('file_location', '').split('\n')
+    values.append(fingerprint.paths_fingerprint(
+        [file_location.strip() for file_location in file_locations]))
+    return fingerprint.digest(values)
+
+
+def is_up_to_date(options, buildout):
+    """
+    Check whether the part has already been prepared by an earlier buildout
+    run, and nothing that goes into it has changed since.
     """
-    The bin folder from src/pipeline/bin is copied to var/pipeline/bin
-    Then each part gets a soft link.
+    if not os.path.isdir(options['location']):
+        return False
+    INSTALLATION_STATE.load(state_file_path(buildout))
+    installed = INSTALLATION_STATE.get_fingerprint(options['location'])
+    if installed is None:
+        return False
+    if INSTALLATION_STATE.get_fingerprint('shared') != \
+            shared_fingerprint(buildout):
+        return False
+    return installed == part_fingerprint(options, buildout)
+
+
+def install_bin_folder(options, bin_folder, part_plan):
+    """
+    The bin folder from src/pipeline/bin has been copied to var/pipeline/bin
+    by install_shared_folders. Each part gets a soft link.
 
     The bin folder is made available globally to all pipelines
     in var/pipeline/bin
-    The shebang of all contained scripts has to be changed to use the Perl
-    version defined in buildout.cfg
-    """
-    # Start with a fresh installation once
-    if not INSTALLATION_STATE.get_reinstall(bin_folder):
-        shutil.rmtree(bin_folder, ignore_errors=True)
-        # The original code comes from the SVN
-        buildout_directory = buildout['buildout']['directory']
-        svn_folder = 'src/pipeline/bin'
-        pipeline_bin_folder = os.path.join(buildout_directory, svn_folder)
-        # The bin folder is populated from the SVN version of the bin folder
-        shutil.copytree(pipeline_bin_folder, bin_folder)
-
+    """
     # The bin folder of the current part should point to the global bin folder
     target = os.path.join(options['location'], 'bin')
-    if os.path.exists(target):
-        os.remove(target)
-    # Make a symbolic link to the global bin folder in var/pipeline in the
-    # part
-    os.symlink(bin_folder, target)
-    if not os.path.exists(target):
-        raise AttributeError(target)
-
-    if not INSTALLATION_STATE.get_reinstall(bin_folder):
-        # Use the same shebang for all perl scripts
-        perlscripts = os.path.join(bin_folder, '*.pl')
-        for perl_script in glob.glob(perlscripts):
-            perl_script_path = os.path.join(bin_folder, perl_script)
-            patch_perl_script(buildout, perl_script_path)
+    part_plan.symlink(target, bin_folder)
+
+
+def install_bin_files(buildout, bin_folder):
+    """
+    Install the contents of src/pipeline/bin in var/pipeline/bin, and patch
+    the shebangs of the Perl scripts.
+    """
+    bin_sync = buildout['settings'].get('bin_sync', 'copy')
+    if not bin_sync in ['copy', 'manifest']:
+        raise AttributeError("Unknown bin_sync setting: %s" % bin_sync)
+    # The original code comes from the SVN
+    buildout_directory = buildout['buildout']['directory']
+    svn_folder = 'src/pipeline/bin'
+    pipeline_bin_folder = os.path.join(buildout_directory, svn_folder)
+    if bin_sync == 'manifest':
+        # Only copy and patch what changed since the last installation
+        return sync_bin_folder(buildout, pipeline_bin_folder, bin_folder)
+    shutil.rmtree(bin_folder, ignore_errors=True)
+    # The bin folder is populated from the SVN version of the bin folder.
+    # The Perl scripts get their own copy, because they are patched.
+    sync.copy_tree(pipeline_bin_folder,
+                   bin_folder,
+                   get_copy_mode(buildout),
+                   is_perl_script)
+    # Use the same shebang for all perl scripts
+    perlscripts = os.path.join(bin_folder, '*.pl')
+    return patch_perl_scripts(buildout, glob.glob(perlscripts))
+
+
+def sync_bin_folder(buildout, pipeline_bin_folder, bin_folder):
+    """
+    Bring var/pipeline/bin up to date with src/pipeline/bin using the
+    manifest kept in var/pipeline/bin.manifest. Only the Perl scripts that
+    have been copied again get their shebang patched.
+    """
+    def patch(copied):
+        """Patch the Perl scripts at the top level of the bin folder"""
+        perl_scripts = [target_path for relative_path, target_path in copied
+                        if is_perl_script(relative_path)]
+        patch_perl_scripts(buildout, perl_scripts)
+
+    stamp = buildout['settings']['perl']
+    return sync.sync_folder(pipeline_bin_folder,
+                            bin_folder,
+                            stamp,
+                            patch,
+                            get_copy_mode(buildout),
+                            is_perl_script)
+
+
+def is_perl_script(relative_path):
+    """
+    Check whether the file is one of the Perl scripts at the top level of the
+    bin folder that get their shebang patched.
+    """
+    return not os.sep in relative_path and relative_path.endswith('.pl')
+
+
+def get_copy_mode(buildout):
+    """
+    Return how the files of src/pipeline are installed in var/pipeline:
+    copy, hardlink or reflink.
+    """
+    copy_mode = buildout['settings'].get('copy_mode', 'copy')
+    if not copy_mode in sync.COPY_MODES:
+        raise AttributeError("Unknown copy_mode setting: %s" % copy_mode)
+    return copy_mode
+
+
+def make_symlink(source, target):
+    """
+    Make a symbolic link, replacing whatever was at the target before in one
+    rename. Nothing is done if the link is already there.
+    """
+    plan.reconcile_symlink(target, source)
 
 
 def patch_perl_script(buildout, perl_script_path):
@@ -92,115 +319,182 @@ def patch_perl_script(buildout, perl_script_path):
     configured in the settings section of the buildout.
     """
     custom_shebang = "#!%s\n" % buildout['settings']['perl']
+    action = rewrite_shebang(perl_script_path, custom_shebang)
+    if action == 'error':
+        raise AttributeError(perl_script_path)
+
+
+def rewrite_shebang(perl_script_path, custom_shebang):
+    """
+    Replace the shebang of a Perl script, returning 'patched' or 'skipped',
+    or 'error' if the script does not start with a Perl shebang.
+
+    Only the first line is read to find out whether there is anything to do.
+    The new script is streamed into a temporary file next to the script that
+    then replaces the script in one atomic rename, so that the pipeline
+    never sees a half written script. Symbolic links are resolved first, so
+    that the link is kept and the script it points to gets patched.
+    """
+    perl_script_path = os.path.realpath(perl_script_path)
     perl_file = open(perl_script_path, 'r')
-    # Just the read the first line, which is expected to be the shebang
-    shebang = perl_file.readline().strip()
-    # The shebang is already ok, so just return
-    if shebang == custom_shebang:
+    try:
+        # Just the read the first line, which is expected to be the shebang
+        shebang = perl_file.readline().strip()
+        # The shebang is already ok, so just return
+        if shebang == custom_shebang.strip():
+            return 'skipped'
+        # Make sure the shebang is as expected
+        if (not shebang.startswith('#!')) or (not 'perl' in shebang):
+            print "Expected script to start with #! and include the " \
+                  "string 'perl'"
+            print "This one (%s) starts with %s" % (perl_script_path, shebang)
+            return 'error'
+        folder, filename = os.path.split(perl_script_path)
+        temporary = os.path.join(folder,
+                                 '.%s.%s.tmp' % (filename, os.getpid()))
+        temporary_file = open(temporary, 'w')
+        try:
+            # Write the new shebang using our own perl version as defined in
+            # the buildout.cfg
+            temporary_file.write(custom_shebang)
+            # Stream the rest of the content, omitting the shebang
+            shutil.copyfileobj(perl_file, temporary_file)
+        finally:
+            temporary_file.close()
+    finally:
         perl_file.close()
-        return
-    # Make sure the shebang is as expected
-    if (not shebang.startswith('#!')) or (not 'perl' in shebang):
-        print "Expected script to start with #! and include the string 'perl'"
-        print "This one (%s) starts with %s" % (perl_script_path, shebang)
-        raise AttributeError
-    # Read the rest of the file only, omitting the shebang
-    content = perl_file.read()
-    perl_file.close()
-    # Open the file again, this time for writing
-    perl_file = open(perl_script_path, 'w')
-    # Write the new shebang using our own perl version as defined in
-    # the buildout.cfg
-    perl_file.write(custom_shebang)
-    # Write the rest of the content
-    perl_file.write(content)
-    perl_file.close()
-
-
-def install_lib_folder(options, buildout, lib_folder):
-    """
-    The lib folder from src/pipeline/lib is copied to var/pipeline/lib
-    Then each part gets a soft link.
+    shutil.copymode(perl_script_path, temporary)
+    os.rename(temporary, perl_script_path)
+    return 'patched'
+
+
+def patch_perl_scripts(buildout, perl_script_paths):
     """
-    buildout_directory = buildout['buildout']['directory']
-    # Remove the old lib folder in var/pipeline
+    Patch the shebangs of many Perl scripts at once. The work is I/O bound,
+    so it is spread over a pool of patch_threads threads (8 by default).
+
+    Returns a report with one (path, action, seconds) tuple per script,
+    where the action is 'patched' or 'skipped'. All the scripts without a
+    Perl shebang are reported together in one AttributeError.
+    """
+    custom_shebang = "#!%s\n" % buildout['settings']['perl']
+
+    def patch(perl_script_path):
+        """Patch one script and time it"""
+        start = time.time()
+        action = rewrite_shebang(perl_script_path, custom_shebang)
+        return (perl_script_path, action, time.time() - start)
+
+    threads = parse_integer(buildout['settings'].get('patch_threads', '8'))
+    threads = min(int(threads), len(perl_script_paths))
+    if threads > 1:
+        pool = ThreadPool(threads)
+        try:
+            report = pool.map(patch, perl_script_paths)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        report = [patch(path) for path in perl_script_paths]
+    errors = [path for path, action, seconds in report if action == 'error']
+    if errors:
+        template = "Scripts without a Perl shebang: %s"
+        raise AttributeError(template % ", ".join(errors))
+    return report
 
-    if not INSTALLATION_STATE.get_reinstall(lib_folder):
-        shutil.rmtree(lib_folder, ignore_errors=True)
-        # The original lib folder is taken from the SVN
-        svn_folder = 'src/pipeline/lib'
-        pipeline_lib_folder = os.path.join(buildout_directory, svn_folder)
-        # Copy the lib folder over to var/pipeline
-        shutil.copytree(pipeline_lib_folder, lib_folder)
 
+def install_lib_folder(options, lib_folder, part_plan):
+    """
+    The lib folder from src/pipeline/lib has been copied to var/pipeline/lib
+    by install_shared_folders. Each part gets a soft link.
+    """
     # Make a symbolic link in the part to the lib folder in var/pipeline
     target = os.path.join(options['location'], 'lib')
-    # Remove the old link
-    if os.path.exists(target):
-        os.remove(target)
-    # And put in the new link
-    os.symlink(lib_folder, target)
-    if not os.path.exists(target):
-        raise AttributeError(target)
+    part_plan.symlink(target, lib_folder)
+
+
+def install_lib_files(buildout, lib_folder):
+    """
+    Install the contents of src/pipeline/lib in var/pipeline/lib
+    """
+    buildout_directory = buildout['buildout']['directory']
+    # Remove the old lib folder in var/pipeline
+    shutil.rmtree(lib_folder, ignore_errors=True)
+    # The original lib folder is taken from the SVN
+    svn_folder = 'src/pipeline/lib'
+    pipeline_lib_folder = os.path.join(buildout_directory, svn_folder)
+    # Copy the lib folder over to var/pipeline
+    sync.copy_tree(pipeline_lib_folder, lib_folder, get_copy_mode(buildout))
 
 
-def install_results_folder(options, results_folder):
+def install_shared_folders(buildout):
+    """
+    Install the var/pipeline/bin folder with the dependencies and the
+    var/pipeline/lib folder shared by all parts. This is done only once per
+    buildout run, and only if an earlier buildout run has not installed them
+    from the same sources already.
+    """
+    buildout_directory = buildout['buildout']['directory']
+    bin_folder = os.path.join(buildout_directory, 'var/pipeline/bin')
+    lib_folder = os.path.join(buildout_directory, 'var/pipeline/lib')
+    INSTALLATION_STATE.load(state_file_path(buildout))
+    if INSTALLATION_STATE.get_reinstall(bin_folder):
+        return
+    installed = INSTALLATION_STATE.get_fingerprint('shared')
+    if not (installed == shared_fingerprint(buildout) and
+            os.path.isdir(bin_folder) and os.path.isdir(lib_folder)):
+        timing.step('bin', install_bin_files, buildout, bin_folder)
+        timing.step('lib', install_lib_files, buildout, lib_folder)
+        timing.step('dependencies', install_dependencies, buildout,
+                    bin_folder)
+        # Installing the dependencies patches fastqc, so the fingerprint is
+        # taken again now that everything has been installed
+        del INSTALLATION_STATE.current['shared']
+        INSTALLATION_STATE.set_fingerprint('shared',
+                                           shared_fingerprint(buildout))
+    INSTALLATION_STATE.set_reinstall(bin_folder)
+    INSTALLATION_STATE.set_reinstall(lib_folder)
+
+
+def install_results_folder(options, results_folder, part_plan):
     """
     Create a results folder in var for keeping the results of a pipeline run,
     and make a soft link to it in each part.
     """
-    if os.path.exists(results_folder):
-        pass
-    else:
-        os.mkdir(results_folder)
+    part_plan.folder(results_folder)
     target = os.path.join(options['location'], 'results')
-    # Remove the old link
-    if os.path.exists(target):
-        os.remove(target)
-    # And put in the new link
-    os.symlink(results_folder, target)
-    if not os.path.exists(target):
-        raise AttributeError(target)
+    part_plan.symlink(target, results_folder)
 
 
-def install_gemindices_folder(options, gemindices_folder):
+def install_gemindices_folder(options, gemindices_folder, part_plan):
     """
     Create a GEMIndices folder for sharing the GEM Indices
     """
-    if os.path.exists(gemindices_folder):
-        pass
-    else:
-        os.mkdir(gemindices_folder)
+    part_plan.folder(gemindices_folder)
     target = os.path.join(options['location'], 'GEMIndices')
-    # Remove the old link
-    if os.path.exists(target):
-        os.remove(target)
-    # And put in the new link
-    os.symlink(gemindices_folder, target)
-    if not os.path.exists(target):
-        raise AttributeError(target)
+    part_plan.symlink(target, gemindices_folder)
 
 
-def install_read_folder(options, accession):
+def install_read_folder(options, accession, part_plan):
     """
     Create a read folder with soft links to the read files
     """
 
     # Create the read folder in the parts folder
     read_folder = os.path.join(options['location'], 'readData')
-    # There are only soft links in this folder, so the whole folder is deleted
-    # every time.
-    shutil.rmtree(read_folder, ignore_errors=True)
-    # Now create the read folder
-    os.mkdir(read_folder)
-    number_of_reads = len(accession['file_location'].split('\n'))
-    for number in range(0, number_of_reads):
+    part_plan.folder(read_folder)
+    # There are only soft links to the read files in this folder, so any
+    # other link is removed
+    part_plan.only(read_folder)
+    filenames = set()
+    accession = parse_accession(accession)
+    for file_location in accession.get_lines('file_location'):
         # Get the file location from the accession
-        file_location = accession['file_location'].split('\n')[number].strip()
-        # Try to recognize the url
-        if file_location.startswith("http://"):
-            # Unrecognized
-            raise AttributeError
+        file_location = file_location.strip()
+        # Files on http servers are only linked to once they are staged
+        if staging.is_remote(file_location):
+            template = "Set the staging_cache setting to download %s"
+            raise AttributeError(template % file_location)
         # Only accept a path if it is inside of the path we expect.
         # This is so that tricks like ../ don't work
         if not os.path.exists(file_location):
@@ -211,18 +505,45 @@ def install_read_folder(options, accession):
         filename = os.path.split(file_location)[1]
         # Combine the read folder with the filename to get the target
         target = os.path.join(read_folder, filename)
-        if os.path.exists(target):
+        if filename in filenames:
             template = "Duplicated read files: \n%s"
             raise AttributeError(template % accession['file_location'])
-        os.symlink(file_location, target)
-        if not os.path.exists(target):
-            raise AttributeError(target)
+        filenames.add(filename)
+        part_plan.symlink(target, file_location)
+
+
+def validate_read_files(buildout, accession):
+    """
+    Check the integrity of the read files if the validate_reads setting is
+    given, using the eof or full check.
+    """
+    settings = buildout['settings']
+    if not settings.get('validate_reads', ''):
+        return
+    accession = parse_accession(accession)
+    file_locations = [file_location.strip() for file_location
+                      in accession.get_lines('file_location')]
+    # Missing files have been reported when the read folder was installed
+    file_locations = [file_location for file_location in file_locations
+                      if os.path.exists(file_location)]
+    workers = None
+    if 'validation_workers' in settings:
+        workers = int(parse_integer(settings['validation_workers']))
+    errors = validate.validate_files(file_locations,
+                                     settings['validate_reads'],
+                                     get_cache_path(buildout,
+                                                    'validation_cache'),
+                                     workers)
+    if errors:
+        lines = ["%s: %s" % error for error in errors]
+        raise AttributeError("Broken read files:\n%s" % "\n".join(lines))
 
 
 def check_read_labels(accession, experiment_id):
     """
     Make sure the labels are consistent with the paired information
     """
+    accession = parse_accession(accession)
     if not 'paired' in accession:
         msg = "Experiment %s is missing the paired attribute."
         raise AttributeError(msg % experiment_id)
@@ -245,56 +566,78 @@ def check_read_labels(accession, experiment_id):
         # pair id there can not be more that two values that are the same
         # e.g. three testA
         # For paired there are always 2 values that must be the same
-        all_pairs = set(accession['pair_id'].split('\n'))
-        if not len(all_pairs) * 2 == len(accession['pair_id'].split('\n')):
+        pair_ids = accession.get_lines('pair_id')
+        if not len(set(pair_ids)) * 2 == len(pair_ids):
             # mate_id should all be different for paired and not paired
             msg = "The same pair_id must be used for exactly two lines: %s"
             raise AttributeError(msg % experiment_id)
 
-    all_labels = set(accession['label'].split('\n'))
+    all_labels = set(accession.get_lines('label'))
     if not len(all_labels) == 1:
         # Label should always be the same and should not be mixed
         # One line for the label is also possible
         msg = "All labels in the label attribute should be the same: %s"
         raise AttributeError(msg % experiment_id)
 
-    all_mates = set(accession['mate_id'].split('\n'))
-    if not len(all_mates) == len(accession['mate_id'].split('\n')):
+    mate_ids = accession.get_lines('mate_id')
+    if not len(set(mate_ids)) == len(mate_ids):
         # mate_id should all be different for paired and not paired
         msg = "All mate ids need to be different: %s"
         raise AttributeError(msg % experiment_id)
 
 
-def install_read_list(options, accession):
+def verify_read_mates(buildout, accession):
+    """
+    Stream the mates of every pair of a paired end accession in lockstep if
+    the verify_mates setting is given, and check that their read names
+    match. With verify_mates = warn, problems are printed, with
+    verify_mates = fail, they are an error.
+    """
+    settings = buildout['settings']
+    verify_mates = settings.get('verify_mates', '')
+    if not verify_mates:
+        return
+    if not verify_mates in ['warn', 'fail']:
+        raise AttributeError("Unknown verify_mates setting: %s" %
+                             verify_mates)
+    accession = parse_accession(accession)
+    if accession.get('paired') != '1' or accession.get('type') == 'bam':
+        return
+    pairs = {}
+    for read in accession.reads:
+        location = read.location.strip()
+        # Missing files have been reported when the read folder was installed
+        if os.path.exists(location):
+            pairs.setdefault(read.pair_id, []).append(location)
+    pairs = [tuple(sorted(locations)) for _, locations in sorted(pairs.items())
+             if len(locations) == 2]
+    workers = None
+    if 'mate_workers' in settings:
+        workers = int(parse_integer(settings['mate_workers']))
+    errors = mates.verify_pairs(pairs, get_cache_path(buildout, 'mate_cache'),
+                                workers)
+    if errors:
+        lines = [error for _, error in errors]
+        message = "Mates of accession %s do not match:\n%s"
+        message = message % (accession.name, "\n".join(lines))
+        if verify_mates == 'fail':
+            raise AttributeError(message)
+        print "Warning! %s" % message
+
+
+def install_read_list(options, accession, part_plan):
     """
     Add a read.list.txt in the part that will be used by the pipeline.
     """
+    accession = parse_accession(accession, options['accession'])
+    # Check the labels before writing anything
+    reads = accession.reads
     target = os.path.join(options['location'], 'read.list.txt')
-    read_file = open(target, 'w')
-    number_of_reads = len(accession['file_location'].split('\n'))
-    for number in range(0, number_of_reads):
-        labels = {}
-        file_location = accession['file_location'].split('\n')[number]
-        for attribute in ['pair_id', 'mate_id', 'label']:
-            if attribute in accession:
-                check_attribute(attribute, accession, number_of_reads)
-                labels[attribute] = accession[attribute].split('\n')[number]
-            else:
-                template = "Specify a %s attribute for accession %s"
-                message = template % (attribute, options['accession'])
-                raise AttributeError(message)
-        labels = readlist_labels(file_location, labels)
-        read_file.write('\t'.join(labels))
-        read_file.write('\n')
-    read_file.close()
-
-
-def check_attribute(attribute, accession, number_of_reads):
-    """The attribute needs to have as many items as number of reads"""
-    if len(accession[attribute].split('\n')) != number_of_reads:
-        message = ["%s needs to have exactly one line for each " % attribute,
-                   "file defined in file_locations in accession %s"]
-        raise AttributeError("".join(message) % accession['accession'])
+    lines = []
+    for read in reads:
+        labels = readlist_labels(read.location, read.get_labels())
+        lines.append('\t'.join(labels) + '\n')
+    part_plan.write(target, ''.join(lines))
 
 
 def readlist_labels(file_location, labels):
@@ -326,91 +669,107 @@ def install_dependencies(buildout, bin_folder):
     # Do nothing if the dependencies have been installed already
     if INSTALLATION_STATE.get_reinstall(dependencies_bin):
         return
-    install_dependency_flux(buildout, bin_folder)
-    install_dependency_overlap(buildout, bin_folder)
-    install_dependency_gem(buildout, bin_folder)
-    install_dependency_nextgem(buildout, bin_folder)
-    install_dependency_cufflinks(buildout, bin_folder)
-    install_dependency_fastqc(buildout, bin_folder)
+    dependencies = timing.step('resolve', resolve_dependencies, buildout)
+    timing.step('links', link_dependencies, buildout, bin_folder,
+                dependencies)
     # Mark dependencies as installed
     INSTALLATION_STATE.set_reinstall(dependencies_bin)
 
 
-def install_dependency_flux(buildout, bin_folder):
-    """Make symbolic links to the Flux"""
-    buildout_directory = buildout['buildout']['directory']
-    target = os.path.join(bin_folder, 'flux')
-    if os.path.exists(target):
-        os.remove(target)
-    if os.path.exists(target):
-        raise AttributeError
-    buildout_directory = buildout['buildout']['directory']
-    # The flux gets install inside the var/pipeline/bin folder
-    pipeline_bin = os.path.join(buildout_directory, 'src/flux/bin')
-    os.symlink(os.path.join(pipeline_bin, 'flux'), target)
-    if not os.path.exists(target):
-        raise AttributeError("Flux shell script not found", target)
-
-
-def install_dependency_overlap(buildout, bin_folder):
-    """Make symbolic links to overlap"""
-    target = os.path.join(bin_folder, 'overlap')
-    os.symlink(buildout['settings']['overlap'], target)
-    if not os.path.exists(target):
-        raise AttributeError("Overlap binary not found: %s" % target)
-
-
-def install_dependency_gem(buildout, bin_folder):
-    """Make symbolic links to the gem binaries"""
-    gem_binary_glob = os.path.join(buildout['settings']['gem_folder'], 'gem-*')
-    for source in glob.glob(gem_binary_glob):
-        gem_binary = os.path.split(source)[-1]
-        target = os.path.join(bin_folder, gem_binary)
-        os.symlink(source, target)
-        if not os.path.exists(target):
-            raise AttributeError("Gem binary not found: %s" % target)
-
-
-def install_dependency_nextgem(buildout, bin_folder):
-    """Make symbolic links to the nextgem binaries"""
-    folder = buildout['settings']['nextgem_folder']
-    nextgem_binary_glob = os.path.join(folder, 'gem-*')
-    for source in glob.glob(nextgem_binary_glob):
-        if source.endswith('.man'):
-            continue
-        nextgem_binary = os.path.split(source)[-1]
-        target = os.path.join(bin_folder, 'next%s' % nextgem_binary)
-        os.symlink(source, target)
-        if not os.path.exists(target):
-            raise AttributeError("Gem binary not found: %s" % target)
-
-
-def install_dependency_cufflinks(buildout, bin_folder):
-    """Make symbolic links to Cufflinks"""
+def resolve_dependencies(buildout):
+    """
+    Return the dependencies that are linked into var/pipeline/bin, as pairs
+    of the name of the link and the path of the binary.
+    """
     buildout_directory = buildout['buildout']['directory']
+    settings = buildout['settings']
+    dependencies = [('flux', os.path.join(buildout_directory,
+                                          'src/flux/bin/flux')),
+                    ('overlap', settings.get('overlap', ''))]
+    if 'gem_folder' in settings:
+        pattern = os.path.join(settings['gem_folder'], 'gem-*')
+        for source in sorted(glob.glob(pattern)):
+            dependencies.append((os.path.basename(source), source))
+    if 'nextgem_folder' in settings:
+        pattern = os.path.join(settings['nextgem_folder'], 'gem-*')
+        for source in sorted(glob.glob(pattern)):
+            if source.endswith('.man'):
+                continue
+            dependencies.append(('next%s' % os.path.basename(source),
+                                 source))
     cufflinks_folder = os.path.join(buildout_directory, 'src/cufflinks')
     for cufflinks_binary in CUFFLINKS_BINARIES:
-        source = os.path.join(cufflinks_folder, cufflinks_binary)
-        target = os.path.join(bin_folder, cufflinks_binary)
-        os.symlink(source, target)
-        if not os.path.exists(target):
-            raise AttributeError("Cufflinks binary not found: %s" % target)
+        dependencies.append((cufflinks_binary,
+                             os.path.join(cufflinks_folder,
+                                          cufflinks_binary)))
+    dependencies.append(('fastqc', os.path.join(buildout_directory,
+                                                'src/fastqc/fastqc')))
+    return dependencies
 
 
-def install_dependency_fastqc(buildout, bin_folder):
-    """Make symbolic links to Fastqc"""
+def dependency_manifest_path(buildout):
+    """Return the path of the manifest of the linked dependencies"""
     buildout_directory = buildout['buildout']['directory']
-    fastqc_folder = os.path.join(buildout_directory, 'src/fastqc')
-    fastqc_binary = 'fastqc'
-    source = os.path.join(fastqc_folder, fastqc_binary)
-    os.chmod(source, 0755)
-    target = os.path.join(bin_folder, fastqc_binary)
-    os.symlink(source, target)
-    if not os.path.exists(target):
-        raise AttributeError(target)
+    return os.path.join(buildout_directory, 'var/pipeline/dependencies.json')
+
+
+def is_symlink(path):
+    """Check with one lstat whether there is a symbolic link at the path"""
+    try:
+        return stat.S_ISLNK(os.lstat(path).st_mode)
+    except OSError:
+        return False
+
+
+def link_dependencies(buildout, bin_folder, dependencies):
+    """
+    Make symbolic links to the dependencies in the bin folder. All the
+    missing binaries are reported at once.
+
+    The source and identity of every linked binary are kept in
+    var/pipeline/dependencies.json. Links whose binary has not changed
+    since are only checked with one lstat.
+    """
+    entries = {}
+    missing = []
+    for name, source in dependencies:
+        identity = fingerprint.file_identity(source)
+        if identity is None:
+            missing.append("%s: %s" % (name, source))
+            continue
+        entries[name] = {'source': source, 'identity': identity}
+    if missing:
+        raise AttributeError("Dependencies not found:\n%s" %
+                             "\n".join(missing))
+    # Fastqc is patched for the configured Perl
+    entries['fastqc']['perl'] = buildout['settings'].get('perl')
+    path = dependency_manifest_path(buildout)
+    manifest = sync.read_manifest(path) or {}
+    installed = manifest.get('links', {})
+    for name, entry in sorted(entries.items()):
+        target = os.path.join(bin_folder, name)
+        if installed.get(name) == entry and is_symlink(target):
+            continue
+        make_symlink(entry['source'], target)
+        if name == 'fastqc':
+            install_fastqc(buildout, target, entry)
+    # Remove the links to binaries that are gone
+    for name in installed:
+        target = os.path.join(bin_folder, name)
+        if not name in entries and is_symlink(target):
+            os.remove(target)
+    sync.write_manifest(path, {'version': sync.MANIFEST_VERSION,
+                               'links': entries})
+
+
+def install_fastqc(buildout, target, entry):
+    """
+    Make Fastqc executable and patch it for the configured Perl. Patching
+    changes the binary, so its identity is taken again.
+    """
+    os.chmod(entry['source'], 0755)
     patch_perl_script(buildout, target)
-    if not os.path.exists(target):
-        raise AttributeError("Fastqc binary not found: %s" % target)
+    entry['identity'] = fingerprint.file_identity(entry['source'])
 
 
 def parse_read_length(value):
@@ -453,89 +812,247 @@ def parse_integer(value):
         raise AttributeError("%s error: %s" % (value, value))
 
 
-def get_pipeline_script_command(accession, pipeline, options):
+def compile_command(pipeline, buildout=None, options=None):
     """
-    Assemble the command line options for the start and clean scripts.
+    Return the template of the command line for the start and clean
+    scripts. The options of the pipeline profile are checked and filled in,
+    while the options of the accession and the part are left as
+    placeholders. Many parts share a few profiles, so with the buildout and
+    the options of the part, the template is only compiled once per
+    profile.
     """
+    profile = None
+    if buildout is not None:
+        profile = (options.get('pipeline'),) + tuple(
+            [pipeline.get(name) for name in PART_OPTIONS])
+        command = COMMAND_TEMPLATES.get(buildout, profile)
+        if command is not None:
+            return command
+
+    def option(name, value):
+        """Return the option, escaped for filling in the placeholders"""
+        return (" -%s %s" % (name, value)).replace('%', '%%')
+
     command = "#!/bin/bash\n"
     command += "bin/start_RNAseq_pipeline.3.0.pl"
-    command += " -species '%s'" % accession['species']
-    command += " -genome %s" % pipeline['GENOMESEQ']
-    command += " -annotation %s" % pipeline['ANNOTATION']
-    command += " -project %s" % pipeline['PROJECTID']
-    command += " -experiment %s" % options['experiment_id']
-    command += " -template %s" % pipeline['TEMPLATE']
-    command += " -cellline '%s'" % accession['cell']
-    command += " -rnafrac %s" % accession['rnaExtract']
-    command += " -compartment %s" % accession['localization']
-    command += " -qualities %s" % accession['qualities']
+    command += " -species '%(species)s'"
+    command += option('genome', pipeline['GENOMESEQ'])
+    command += option('annotation', pipeline['ANNOTATION'])
+    command += option('project', pipeline['PROJECTID'])
+    command += " -experiment %(experiment)s"
+    command += option('template', pipeline['TEMPLATE'])
+    command += " -cellline '%(cell)s'"
+    command += " -rnafrac %(rnaExtract)s"
+    command += " -compartment %(localization)s"
+    command += " -qualities %(qualities)s"
     if 'CLUSTER' in pipeline:
         if str(pipeline['CLUSTER']).strip() == '':
             raise AttributeError("CLUSTER has not been specified")
         else:
-            command += " -cluster %s" % pipeline['CLUSTER']
-    command += " -database %s" % pipeline['DB']
-    command += " -commondb %s" % pipeline['COMMONDB']
+            command += option('cluster', pipeline['CLUSTER'])
+    command += option('database', pipeline['DB'])
+    command += option('commondb', pipeline['COMMONDB'])
     if 'HOST' in pipeline:
-        command += " -host %s" % pipeline['HOST']
-    command += " -mapper %s" % pipeline['MAPPER']
-    if 'description' in options:
-        command += " -run_description '%s'" % options['description']
+        command += option('host', pipeline['HOST'])
+    command += option('mapper', pipeline['MAPPER'])
+    command += "%(run_description)s"
     if 'PREPROCESS' in pipeline:
-        command += " -preprocess '%s'" % pipeline['PREPROCESS']
-    key = 'readType'
-    if key in accession:
-        value = parse_read_length(accession[key])
-        command += " -readlength %s" % value
+        command += option('preprocess', "'%s'" % pipeline['PREPROCESS'])
+    command += "%(readlength)s"
     key = 'FLUXMEM'
     if key in pipeline:
         value = parse_flux_mem(pipeline[key])
-        command += " -fluxmem %sG" % value
-    key = 'replicate'
-    if key in accession:
-        value = parse_integer(accession[key])
-        command += " -bioreplicate %s" % value
+        command += option('fluxmem', "%sG" % value)
+    command += "%(bioreplicate)s"
     key = 'THREADS'
     if key in pipeline:
         value = parse_integer(pipeline[key])
-        command += " -threads %s" % pipeline['THREADS']
+        command += option('threads', pipeline['THREADS'])
     key = 'MISMATCHES'
     if key in pipeline:
         value = parse_integer(pipeline[key])
-        command += " -mismatches %s" % value
+        command += option('mismatches', value)
     key = 'PREPROCESS_TRIM_LENGTH'
     if key in pipeline:
         value = parse_integer(pipeline[key])
-        command += " -preprocess_trim_length %s" % value
+        command += option('preprocess_trim_length', value)
     key = 'MIN_RECURSIVE_MAPPING_TRIM_LENGTH'
     if key in pipeline:
         value = parse_integer(pipeline[key])
-        command += " -trimlength %s" % value
+        command += option('trimlength', value)
     key = 'MAXINTRONLENGTH'
     if key in pipeline:
         value = parse_integer(pipeline[key])
-        command += " -maxintronlength %s" % value
+        command += option('maxintronlength', value)
+    if profile is not None:
+        COMMAND_TEMPLATES.set(buildout, profile, command)
     return command
 
 
-def install_pipeline_scripts(options, buildout, accession):
+def command_values(accession, options):
     """
-    Install the start, execute and clean shell scripts
+    Return the options of the accession and the part to fill into the
+    compiled command template.
+    """
+    values = {'species': accession['species'],
+              'experiment': options['experiment_id'],
+              'cell': accession['cell'],
+              'rnaExtract': accession['rnaExtract'],
+              'localization': accession['localization'],
+              'qualities': accession['qualities'],
+              'run_description': '',
+              'readlength': '',
+              'bioreplicate': ''}
+    if 'description' in options:
+        values['run_description'] = " -run_description '%s'" % \
+            options['description']
+    key = 'readType'
+    if key in accession:
+        value = parse_read_length(accession[key])
+        values['readlength'] = " -readlength %s" % value
+    key = 'replicate'
+    if key in accession:
+        value = parse_integer(accession[key])
+        values['bioreplicate'] = " -bioreplicate %s" % value
+    return values
+
+
+def get_pipeline_script_command(accession, pipeline, options,
+                                buildout=None):
+    """
+    Assemble the command line options for the start and clean scripts.
+    """
+    return compile_command(pipeline, buildout, options) % \
+        command_values(accession, options)
+
+
+def check_read_samples(buildout, accession):
+    """
+    Sample the first reads of each read file if the check_reads setting is
+    given, and compare the read lengths and pairing with the readType and
+    paired attributes of the accession. With check_reads = warn, problems
+    are printed, with check_reads = fail, they are an error.
+    """
+    settings = buildout['settings']
+    check_reads = settings.get('check_reads', '')
+    if not check_reads:
+        return
+    if not check_reads in ['warn', 'fail']:
+        raise AttributeError("Unknown check_reads setting: %s" % check_reads)
+    accession = parse_accession(accession)
+    records = int(parse_integer(settings.get('sample_records', '10000')))
+    file_locations = [file_location.strip() for file_location
+                      in accession.get_lines('file_location')]
+    file_locations = [file_location for file_location in file_locations
+                      if os.path.exists(file_location)]
+    samples = sample.sample_files(file_locations,
+                                  records,
+                                  get_cache_path(buildout, 'sample_cache'))
+    problems = []
+    read_type = accession.get('readType', '')
+    if read_type:
+        read_length = int(parse_read_length(read_type))
+        for file_location in file_locations:
+            length = sample.get_read_length(samples[file_location])
+            if length is not None and length != read_length:
+                template = "readType is %s, but the reads of %s are %s long"
+                problems.append(template % (read_type, file_location, length))
+    paired = accession.get('paired', None)
+    if 'x' in read_type.split('D')[0] and paired in ['0', '1']:
+        mates = read_type.split('x')[0]
+        if (mates == '2') != (paired == '1'):
+            template = "readType is %s, but paired is %s"
+            problems.append(template % (read_type, paired))
+    if accession.get('type', None) == 'bam' and paired in ['0', '1']:
+        for file_location in file_locations:
+            if samples[file_location]['paired'] != (paired == '1'):
+                template = "paired is %s, but the reads of %s are %s"
+                found = 'single end'
+                if samples[file_location]['paired']:
+                    found = 'paired'
+                problems.append(template % (paired, file_location, found))
+    elif paired == '1':
+        problems.extend(check_mate_counts(accession, samples))
+    if problems:
+        message = "Reads of accession %s do not match:\n%s"
+        message = message % (accession.name, "\n".join(problems))
+        if check_reads == 'fail':
+            raise AttributeError(message)
+        print "Warning! %s" % message
+    return samples
+
+
+def check_mate_counts(accession, samples):
+    """
+    The two mates of a pair need to have the same number of reads. Exact
+    counts have to be equal, estimated counts must not differ by more than a
+    fifth.
+    """
+    try:
+        reads = accession.reads
+    except AttributeError:
+        # Inconsistent labels are reported by check_read_labels
+        return []
+    pairs = {}
+    for read in reads:
+        location = read.location.strip()
+        if location in samples:
+            pairs.setdefault(read.pair_id, []).append(samples[location])
+    problems = []
+    for pair_id, pair_samples in sorted(pairs.items()):
+        if len(pair_samples) != 2:
+            continue
+        counts = [mate['estimated_reads'] for mate in pair_samples]
+        if pair_samples[0]['exact'] and pair_samples[1]['exact']:
+            different = counts[0] != counts[1]
+        else:
+            different = abs(counts[0] - counts[1]) > max(counts) / 5
+        if different:
+            template = "The mates of pair %s have %s and %s reads"
+            problems.append(template % (pair_id, counts[0], counts[1]))
+    return problems
+
+
+def get_pipeline(options, buildout):
+    """
+    Return the pipeline options of the part: the defaults of the pipeline
+    section, updated with the profile given in the pipeline option. The
+    merged profiles are cached by the name of the profile.
     """
+    name = options.get('pipeline')
+    pipeline = PROFILES.get(buildout, name)
+    if pipeline is not None:
+        # The parts may change their own copy
+        return pipeline.copy()
 
     # The default pipeline section is called "pipeline"
-    pipeline = {}
+    defaults = None
     if 'pipeline' in buildout:
-        pipeline = buildout['pipeline'].copy()
+        defaults = buildout['pipeline']
 
     # If the accession has a pipeline attribute, this overrides the defaults
     # of the pipeline section
+    profile = None
     if 'pipeline' in options:
-        if options['pipeline'] in buildout:
-            pipeline.update(buildout[options['pipeline']].copy())
-        else:
+        try:
+            profile = get_section(buildout, options['pipeline'])
+        except KeyError:
             # The advertised pipeline configuration is not there
             raise AttributeError
+    pipeline = {}
+    if defaults is not None:
+        pipeline.update(defaults.items())
+    if profile is not None:
+        pipeline.update(profile.items())
+    PROFILES.set(buildout, name, pipeline)
+    return pipeline.copy()
+
+
+def install_pipeline_scripts(options, buildout, accession, part_plan):
+    """
+    Install the start, execute and clean shell scripts
+    """
+    pipeline = get_pipeline(options, buildout)
 
     buildout_directory = buildout['buildout']['directory']
     bam = os.path.join(buildout_directory, 'src/pipeline/template.bam.txt')
@@ -557,118 +1074,139 @@ def install_pipeline_scripts(options, buildout, accession):
         else:
             raise AttributeError("Undefined TEMPLATE parameter")
 
-    command = get_pipeline_script_command(accession, pipeline, options)
+    # Make sure the reads are what the accession says they are
+    samples = check_read_samples(buildout, accession)
+
+    # Estimate FLUXMEM and THREADS given as auto from the size of the input
+    sizing_lines = sizing.size_pipeline(buildout, accession, pipeline,
+                                        samples)
+
+    command = get_pipeline_script_command(accession, pipeline, options,
+                                          buildout)
+    if sizing_lines:
+        shebang, command = command.split('\n', 1)
+        command = '\n'.join([shebang] + sizing_lines + [command])
 
     target = os.path.join(options['location'], 'start.sh')
-    start_file = open(target, 'w')
-    start_file.write(command)
-    start_file.close()
-    os.chmod(target, 0755)
+    part_plan.write(target, command, 0755)
 
     target = os.path.join(options['location'], 'clean.sh')
     command += " -clean"
-    clean_file = open(target, 'w')
-    clean_file.write(command)
-    clean_file.close()
-    os.chmod(target, 0755)
+    part_plan.write(target, command, 0755)
 
     command = "#!/bin/bash\n"
     command += "bin/execute_RNAseq_pipeline3.0.pl all |tee -a pipeline.log"
     target = os.path.join(options['location'], 'execute.sh')
-    execute_file = open(target, 'w')
-    execute_file.write(command)
-    execute_file.close()
-    os.chmod(target, 0755)
+    part_plan.write(target, command, 0755)
 
 
 def quick(options, buildout):
     """
     This is the recipe for running the pipeline quickly without specifying
     any meta data, for a given species.
+
+    The read files are searched in the folder and its subfolders, and are
+    paired and grouped by sample by their names. With the reads of more
+    than one sample, every sample gets its own run in a folder of the part.
     """
-    options = {'accession': 'Run',
-               'location': options['location'],
-               }
-    fastqs = quick_fastqs()
-    gtfs = quick_gtf()
-    fas = quick_fa()
-    species = quick_species(gtfs, fas)
+    # The folder is only searched once for all the input files
+    paths = list(discover.walk_files(os.getcwd(), QUICK_SUFFIXES))
+    fastqs = quick_fastqs(paths)
+    gtfs = quick_gtf(paths)
+    fas = quick_fa(paths)
+    # The species is recognized by the content of the genome and annotation,
+    # or else by the file names of the genomes known from the start
+    species = detect_species(buildout, fas[0], gtfs[0])
+    if species is None:
+        species = quick_species(gtfs, fas)
     if species is None:
         template = "Genome and annotation files don't match: %s %s"
         raise AttributeError(template % (gtfs, fas))
 
     buildout_directory = buildout['buildout']['directory']
 
-    accession = {'file_location': '\n'.join(fastqs),
-                 'species': species,
-                 'readType': '76',
-                 'cell': 'Unknown',
-                 'rnaExtract': 'Unknown',
-                 'localization': 'Unknown',
-                 'qualities': 'phred',
-                 'pair_id': '\n'.join([str(i) for i in range(len(fastqs))]),
-                 'mate_id': '\n'.join([str(i) for i in range(len(fastqs))]),
-                 'label': '\n'.join(['Run' for i in range(len(fastqs))]),
-                 'paired': '0',
-                 'accession': 'Run'
-                 }
-
     template = os.path.join(buildout_directory, 'src/pipeline/template3.0.txt')
 
-    pipeline = {'GENOMESEQ': gtfs[0],
-                'ANNOTATION': fas[0],
+    pipeline = {'GENOMESEQ': fas[0],
+                'ANNOTATION': gtfs[0],
                 'PROJECTID': 'Quick',
                 'TEMPLATE': template,
-                'THREADS': 1,
+                'THREADS': '1',
                 'DB': 'Quick_RNAseqPipeline',
                 'COMMONDB': 'Quick_RNAseqPipelineCommon',
                 'MAPPER': 'GEM',
                 'MISMATCHES': '2',
                 }
-    buildout = {'Run': accession,
-                'buildout': {'directory': buildout_directory},
-                'settings': buildout['settings'].copy(),
-                'pipeline': pipeline
-                }
-    main(options, buildout)
+    quick_buildout = {'buildout': {'directory': buildout_directory},
+                      'settings': buildout['settings'].copy(),
+                      'pipeline': pipeline
+                      }
+    samples = discover.group_reads(fastqs)
+    for name, reads in sorted(samples.items()):
+        if len(samples) == 1:
+            run_options = {'accession': 'Run',
+                           'location': options['location']}
+        else:
+            run_options = {'accession': 'Run/%s' % name,
+                           'location': os.path.join(options['location'],
+                                                    name)}
+            if not os.path.exists(run_options['location']):
+                os.makedirs(run_options['location'])
+        quick_buildout[run_options['accession']] = quick_accession(
+            buildout, run_options['accession'], reads, species)
+        main(run_options, quick_buildout)
 
 
-def quick_fastqs():
-    """Return list of .fastq files found"""
-    filenames = glob.glob("*.fastq.gz")
-    cwd = os.getcwd()
-    fastqs = []
-    for filename in filenames:
-        fastqs.append(os.path.join(cwd, filename))
+def quick_accession(buildout, name, reads, species):
+    """
+    Return the accession of the reads of a sample. The read length is
+    taken from the first reads of the files.
+    """
+    locations = [location for _, _, location in reads['reads']]
+    samples = sample.sample_files(locations, 1000,
+                                  get_cache_path(buildout, 'sample_cache'))
+    lengths = [sample.get_read_length(samples[location])
+               for location in locations]
+    lengths = [length for length in lengths if length is not None]
+    read_type = str(max(lengths or [76]))
+    if reads['paired']:
+        read_type = '2x%s' % read_type
+    label = name.split('/')[-1]
+    return {'file_location': '\n'.join(locations),
+            'species': species,
+            'readType': read_type,
+            'cell': 'Unknown',
+            'rnaExtract': 'Unknown',
+            'localization': 'Unknown',
+            'qualities': 'phred',
+            'pair_id': '\n'.join([pair_id for pair_id, _, _
+                                  in reads['reads']]),
+            'mate_id': '\n'.join([mate_id for _, mate_id, _
+                                  in reads['reads']]),
+            'label': '\n'.join([label] * len(locations)),
+            'paired': reads['paired'] and '1' or '0',
+            'type': 'fastq',
+            'accession': name
+            }
+
+
+def quick_fastqs(paths):
+    """Return list of .fastq files found in the folder and its subfolders"""
+    fastqs = [path for path in paths
+              if path.endswith(discover.READ_SUFFIXES)]
     if len(fastqs) == 0:
         raise AttributeError("Please drop *.fastq.gz files into this folder")
     return fastqs
 
 
-def quick_gtf():
+def quick_gtf(paths):
     """Return list of .gtf files found"""
-    filenames = glob.glob("*.gtf")
-    cwd = os.getcwd()
-    gtfs = []
-    for filename in filenames:
-        gtfs.append(os.path.join(cwd, filename))
-    if len(gtfs) != 1:
-        template = "Please provide just one genome file. Found: %s"
-        raise AttributeError(template % gtfs)
-    return gtfs
-
-
-def quick_fa():
+    return [discover.find_file(paths, ('.gtf',), 'annotation')]
+
+
+def quick_fa(paths):
     """Return list of .fa files found"""
-    fas = glob.glob("*.fa")
-    cwd = os.getcwd()
-    filenames = []
-    for filename in filenames:
-        fas.append(os.path.join(cwd, filename))
-    if len(fas) != 1:
-        template = "Please provide just one annotation file. Found: %s"
-        raise AttributeError(template % fas)
-    return fas
+    return [discover.find_file(paths, ('.fa',), 'genome')]
 
 
 def quick_species(gtfs, fas):
@@ -687,6 +1225,99 @@ def quick_species(gtfs, fas):
     return species
 
 
+def collapse_accession(accession):
+    """
+    Only the file related attributes of an accession have one line per file.
+    """
+    for key, value in accession.items():
+        if not key in ['pair_id',
+                       'mate_id',
+                       'label',
+                       'file_location',
+                       'file_type']:
+            if '\n' in value:
+                # Collapse the redundant values to make labeling easier
+                accession[key] = value.split('\n')[0]
+
+
+def prepare_part(options, buildout, accession, dry_run=False):
+    """
+    Prepare the part itself, once the shared folders in var/pipeline have
+    been installed. This only touches the part and its results folder, so
+    many parts can be prepared at the same time.
+
+    The links and files of the part are first planned, and only the
+    differences with what is on disk are applied. With dry_run, the
+    differences are printed instead. Returns the differences.
+    """
+    buildout_directory = buildout['buildout']['directory']
+    part_plan = plan.Plan()
+
+    bin_folder = os.path.join(buildout_directory, 'var/pipeline/bin')
+    timing.step('bin_link', install_bin_folder, options, bin_folder,
+                part_plan)
+
+    # The lib folder is copied to var/pipeline
+    lib_folder = os.path.join(buildout_directory, 'var/pipeline/lib')
+    timing.step('lib_link', install_lib_folder, options, lib_folder,
+                part_plan)
+
+    experiment_id = options['experiment_id']
+    results_folder = os.path.join(buildout_directory, 'var/%s' % experiment_id)
+    timing.step('results', install_results_folder, options, results_folder,
+                part_plan)
+
+    gemindices_folder = os.path.join(buildout_directory, 'var/GEMIndices')
+    if buildout['settings'].get('gemindices_registry', ''):
+        # The index of the genome is shared with all parts and projects
+        pipeline = get_pipeline(options, buildout)
+        gemindices_folder = timing.step('gemindex', gemindex.register_index,
+                                        buildout, pipeline,
+                                        options['location'], not dry_run)
+    timing.step('gemindices', install_gemindices_folder, options,
+                gemindices_folder, part_plan)
+
+    if buildout['settings'].get('staging_cache', ''):
+        # Remote or slow read files are copied to the local staging cache,
+        # and the part only sees the staged files from here on
+        accession = timing.step('staging', staging.stage_accession, buildout,
+                                accession, options['location'], dry_run)
+
+    # The integrity and the mates are checked on the read files themselves
+    read_files = accession
+    if buildout['settings'].get('shard_size', ''):
+        # Large read files are split into shards that are mapped in parallel
+        accession = timing.step('shards', shard.shard_accession, buildout,
+                                accession, options['location'], dry_run)
+
+    timing.step('read_folder', install_read_folder, options, accession,
+                part_plan)
+
+    timing.step('validate_reads', validate_read_files, buildout, read_files)
+
+    timing.step('scripts', install_pipeline_scripts, options, buildout,
+                accession, part_plan)
+
+    # Check the read labels are consistent with the paired information
+    timing.step('read_labels', check_read_labels, accession, experiment_id)
+
+    # Check that the mates of every pair belong together
+    timing.step('mates', verify_read_mates, buildout, read_files)
+
+    # Install the read list file defining the labels of the reads
+    timing.step('read_list', install_read_list, options, accession,
+                part_plan)
+
+    changes = timing.step('diff', part_plan.changes)
+    if dry_run:
+        print "Plan for %s:" % options['location']
+        for line in plan.describe(changes) or ["nothing to do"]:
+            print "    %s" % line
+        return changes
+    timing.step('apply', part_plan.apply, changes)
+    return changes
+
+
 def main(options, buildout):
     """
     This method is called for each part and does the following:
@@ -708,10 +1339,13 @@ def main(options, buildout):
 
         * Create a fresh link in the part to the var/pipeline/lib folder
     """
+    # Fingerprint of the part before anything gets changed in the options
+    installed_part = part_fingerprint(options, buildout)
     # Without an accession, the part can not be created, because no read files
-    # can be linked to
+    # can be linked to. The accession is looked up in the compiled accession
+    # database if it is not in the buildout.
     try:
-        accession = buildout[options['accession']]
+        accession = get_section(buildout, options['accession'])
     except KeyError:
         if buildout['runs']['parts'] in ['Run']:
             quick(options, buildout)
@@ -719,49 +1353,49 @@ def main(options, buildout):
         print "Accession not found", options['accession']
         return
 
-    for key, value in accession.items():
-        if not key in ['pair_id',
-                       'mate_id',
-                       'label',
-                       'file_location',
-                       'file_type']:
-            if '\n' in value:
-                # Collapse the redundant values to make labeling easier
-                accession[key] = value.split('\n')[0]
+    collapse_accession(accession)
+    # The file related attributes are only split once
+    accession = parse_accession(accession, options['accession'])
 
     # The part name is also the experiment id. As it is not given in the
     # options, we need to extract it from the current location. Sigh.
     options['experiment_id'] = os.path.split(options['location'])[-1]
 
-    buildout_directory = buildout['buildout']['directory']
+    # With the dry_run option or GRAPE_DRY_RUN, only print the plan
+    dry_run = plan.is_dry_run(options)
 
-    bin_folder = os.path.join(buildout_directory, 'var/pipeline/bin')
-    install_bin_folder(options, buildout, bin_folder)
-
-    # The lib folder is copied to var/pipeline
-    lib_folder = os.path.join(buildout_directory, 'var/pipeline/lib')
-    install_lib_folder(options, buildout, lib_folder)
-
-    experiment_id = options['experiment_id']
-    results_folder = os.path.join(buildout_directory, 'var/%s' % experiment_id)
-    install_results_folder(options, results_folder)
-
-    gemindices_folder = os.path.join(buildout_directory, 'var/GEMIndices')
-    install_gemindices_folder(options, gemindices_folder)
-
-    install_read_folder(options, accession)
-
-    if not INSTALLATION_STATE.get_reinstall(bin_folder):
-        install_dependencies(buildout, bin_folder)
-
-    install_pipeline_scripts(options, buildout, accession)
-
-    # Check the read labels are consistent with the paired information
-    check_read_labels(accession, experiment_id)
-
-    # Install the read list file defining the labels of the reads
-    install_read_list(options, accession)
-
-    # As a last step, set the lib and bin folder to the reinstalled state
-    INSTALLATION_STATE.set_reinstall(lib_folder)
-    INSTALLATION_STATE.set_reinstall(bin_folder)
+    # Time the steps if the timing option or GRAPE_TIMING is set
+    timer = timing.start(options)
+    try:
+        # The bin and lib folders are installed in var/pipeline once
+        if not dry_run:
+            timing.step('shared', install_shared_folders, buildout)
+
+        prepare_part(options, buildout, accession, dry_run)
+
+        # Keep the shared GEM indices within their size budget
+        settings = buildout['settings']
+        if not dry_run and settings.get('gemindices_registry', '') and \
+                settings.get('gemindices_budget', ''):
+            timing.step('evict', gemindex.evict_once, buildout)
+        # Keep the shard cache within its size budget
+        if not dry_run and settings.get('shard_budget', ''):
+            timing.step('evict_shards', shard.evict_once, buildout)
+        # Keep the staging cache within its size budget
+        if not dry_run and settings.get('staging_cache', '') and \
+                settings.get('staging_budget', ''):
+            timing.step('evict_staging', staging.evict_once, buildout,
+                        shard.sharded_sources(buildout))
+    finally:
+        timing.stop(timer)
+    if dry_run:
+        return
+    if timer is not None:
+        report = timer.report()
+        timing.save_part_report(options['location'], report)
+        timing.add_to_summary(options['location'], report)
+        timing.save_summary(buildout)
+
+    # Remember what has been installed for the next buildout run
+    INSTALLATION_STATE.set_fingerprint(options['location'], installed_part)
+    INSTALLATION_STATE.save()
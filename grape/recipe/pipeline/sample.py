@@ -0,0 +1,244 @@
+"""
+Streaming samples of read files.
+
+Only the first records of a fastq.gz or bam file are decompressed, to find
+out the read lengths and to estimate the total number of reads from the
+share of the compressed file that was needed for the sample. The samples are
+cached by file identity, so every file is only sampled once.
+"""
+
+import zlib
+import struct
+
+from grape.recipe.pipeline.cache import FileCache
+from grape.recipe.pipeline.cache import identity_key
+
+# Secondary and supplementary alignments do not count as reads
+BAM_SKIP_FLAGS = 0x100 | 0x800
+
+BAM_PAIRED_FLAG = 0x1
+
+CHUNK_SIZE = 64 * 1024
+
+
+class CountingFile(object):
+    """
+    A file wrapper counting the number of bytes read from the file.
+    """
+
+    def __init__(self, path):
+        """Open the file for reading"""
+        self.raw = open(path, 'rb')
+        self.count = 0
+
+    def read(self, size=-1):
+        """Read from the file and count the bytes"""
+        data = self.raw.read(size)
+        self.count += len(data)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+
+class GzipReader(object):
+    """
+    Read a gzip file, counting the compressed bytes that were decompressed.
+    Files made of several gzip members, like BGZF files, are read through.
+    """
+
+    def __init__(self, path):
+        """Open the file for reading"""
+        self.raw = open(path, 'rb')
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.pending = ''
+        self.buffer = ''
+        self.position = 0
+        self.compressed = 0
+        self.decompressed = 0
+
+    def fill(self):
+        """
+        Decompress the next chunk of the file into the buffer. Returns False
+        at the end of the file.
+        """
+        data = ''
+        while not data:
+            if not self.pending:
+                self.pending = self.raw.read(CHUNK_SIZE)
+                if not self.pending:
+                    return False
+            data = self.decompressor.decompress(self.pending)
+            rest = self.decompressor.unused_data
+            if rest:
+                # The end of a gzip member, with the next one in the rest
+                self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            self.compressed += len(self.pending) - len(rest)
+            self.pending = rest
+        self.decompressed += len(data)
+        self.buffer = self.buffer[self.position:] + data
+        self.position = 0
+        return True
+
+    def readline(self):
+        """Return the next line, or an empty string at the end"""
+        end = self.buffer.find('\n', self.position)
+        while end < 0 and self.fill():
+            end = self.buffer.find('\n', self.position)
+        if end < 0:
+            end = len(self.buffer) - 1
+        line = self.buffer[self.position:end + 1]
+        self.position = end + 1
+        return line
+
+    def read(self, size):
+        """Return the next size bytes, or less at the end"""
+        while len(self.buffer) - self.position < size and self.fill():
+            pass
+        data = self.buffer[self.position:self.position + size]
+        self.position += len(data)
+        return data
+
+    def consumed_bytes(self):
+        """
+        Return the number of compressed bytes needed for what has been read.
+        The file is decompressed a chunk at a time, so the compressed bytes
+        are scaled down by the share of the decompressed data that has been
+        returned. Without this, small samples underestimate the reads.
+        """
+        if self.decompressed <= 0:
+            return self.compressed
+        returned = self.decompressed - (len(self.buffer) - self.position)
+        return self.compressed * float(returned) / self.decompressed
+
+    def close(self):
+        """Close the file"""
+        self.raw.close()
+
+
+def new_sample():
+    """Return an empty sample"""
+    return {'records': 0, 'lengths': {}, 'paired': False}
+
+
+def add_length(sample, length):
+    """Count a read of the given length in the sample"""
+    length = str(length)
+    sample['lengths'][length] = sample['lengths'].get(length, 0) + 1
+    sample['records'] += 1
+
+
+def finish_sample(sample, read_file, complete):
+    """
+    Estimate the total number of reads. If the whole file has been read,
+    the number of reads is exact.
+    """
+    read_file.raw.seek(0, 2)
+    size = read_file.raw.tell()
+    sample['exact'] = complete
+    consumed = read_file.consumed_bytes()
+    if complete or consumed <= 0:
+        sample['estimated_reads'] = sample['records']
+    else:
+        ratio = float(size) / consumed
+        sample['estimated_reads'] = int(sample['records'] * ratio)
+    return sample
+
+
+def sample_fastq(path, records):
+    """Sample the first records of a gzipped fastq file"""
+    sample = new_sample()
+    read_file = GzipReader(path)
+    complete = False
+    try:
+        while sample['records'] < records:
+            header = read_file.readline()
+            if not header:
+                complete = True
+                break
+            sequence = read_file.readline()
+            read_file.readline()
+            read_file.readline()
+            add_length(sample, len(sequence.rstrip('\r\n')))
+        sample = finish_sample(sample, read_file, complete)
+    finally:
+        read_file.close()
+    return sample
+
+
+def read_exactly(read_file, size):
+    """Read exactly size bytes, or return None at the end of the file"""
+    data = read_file.read(size)
+    if len(data) < size:
+        return None
+    return data
+
+
+def sample_bam(path, records):
+    """Sample the first records of a bam file"""
+    sample = new_sample()
+    read_file = GzipReader(path)
+    complete = False
+    try:
+        if read_exactly(read_file, 4) != 'BAM\x01':
+            raise AttributeError("Not a bam file: %s" % path)
+        l_text = struct.unpack('<i', read_file.read(4))[0]
+        read_file.read(l_text)
+        n_ref = struct.unpack('<i', read_file.read(4))[0]
+        for _ in range(n_ref):
+            l_name = struct.unpack('<i', read_file.read(4))[0]
+            read_file.read(l_name + 4)
+        while sample['records'] < records:
+            block_size = read_exactly(read_file, 4)
+            if block_size is None:
+                complete = True
+                break
+            block = read_file.read(struct.unpack('<i', block_size)[0])
+            flag_nc, l_seq = struct.unpack('<Ii', block[12:20])
+            flag = flag_nc >> 16
+            if flag & BAM_SKIP_FLAGS:
+                continue
+            if flag & BAM_PAIRED_FLAG:
+                sample['paired'] = True
+            add_length(sample, l_seq)
+        sample = finish_sample(sample, read_file, complete)
+    finally:
+        read_file.close()
+    return sample
+
+
+def sample_file(path, records):
+    """Sample a bam or a fastq.gz file"""
+    if path.endswith('.bam'):
+        return sample_bam(path, records)
+    return sample_fastq(path, records)
+
+
+def get_read_length(sample):
+    """
+    Return the read length of a sample. Reads may have been trimmed, so this
+    is the longest read.
+    """
+    if not sample['lengths']:
+        return None
+    return max([int(length) for length in sample['lengths']])
+
+
+def sample_files(paths, records, cache_path):
+    """
+    Return the samples of the first records of the files, keyed by path.
+    """
+    cache = FileCache(cache_path)
+    kind = 'sample:%s' % records
+    samples = {}
+    try:
+        for path in paths:
+            key = identity_key(path)
+            sample = cache.get(key, kind)
+            if sample is None:
+                sample = sample_file(path, records)
+                cache.set(key, kind, path, sample)
+            samples[path] = sample
+    finally:
+        cache.close()
+    return samples
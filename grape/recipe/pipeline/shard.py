@@ -0,0 +1,387 @@
+"""
+Sharding of large read files for parallel mapping.
+
+Every read file becomes one line of the read.list.txt file of a part, and
+one mapping job of the pipeline, so a 40 GB lane maps for a very long time
+in a single job. With the shard_size setting, read files larger than the
+shard size are split into shards of about that size:
+
+    [settings]
+    shard_size = 4G
+    shard_cache = /scratch/grape/shards
+    shard_workers = 4
+    shard_budget = 500G
+
+The shards only break between records, and the two mates of a pair are
+split in lockstep, so the n-th shard of the first mate has the mates of the
+reads in the n-th shard of the second mate. Every shard becomes its own
+pair in the read.list.txt file, with the pair and mate ids of the read
+file followed by the number of the shard, and the same label:
+
+    testA.r1_shard001.fastq  testA_shard1  testA_shard1.1  Test
+    testA.r2_shard001.fastq  testA_shard1  testA_shard1.2  Test
+
+The shards of every read file or pair are kept in their own folder of the
+shard cache, which is var/pipeline/shards by default. They are used again
+as long as the read files and the shard size stay the same:
+
+    /scratch/grape/shards/0123456789abcdef/
+        entry.json
+        .lock
+        testA.r1_shard001.fastq.gz
+        testA.r2_shard001.fastq.gz
+
+The entry records the read files the shards were split from, and the parts
+using the shards. With the shard_budget setting, the least recently used
+shards are removed when the cache is over its size budget. Shards that parts
+still link to are never removed, and neither are the staged read files they
+were split from.
+"""
+
+import io
+import os
+import gzip
+import json
+import time
+import hashlib
+from multiprocessing.pool import ThreadPool
+
+from grape.recipe.pipeline import lru
+from grape.recipe.pipeline.sample import CountingFile
+from grape.recipe.pipeline.cache import identity_key
+from grape.recipe.pipeline.lock import FolderLock
+from grape.recipe.pipeline.lock import lock_folder
+from grape.recipe.pipeline.staging import read_entry
+from grape.recipe.pipeline.staging import write_entry
+from grape.recipe.pipeline.staging import live_parts as linking_parts
+from grape.recipe.pipeline.discover import READ_SUFFIXES
+from grape.recipe.pipeline.accession import parse_accession
+
+CHUNK_SIZE = 1024 * 1024
+
+# The shards are only read once by the mapper, so they are compressed fast
+COMPRESS_LEVEL = 1
+
+
+def get_shard_cache(buildout):
+    """Return the folder of the shard cache of the buildout"""
+    settings = buildout['settings']
+    if 'shard_cache' in settings:
+        return settings['shard_cache']
+    buildout_directory = buildout['buildout']['directory']
+    return os.path.join(buildout_directory, 'var/pipeline/shards')
+
+
+def shard_folder(cache, locations, shard_size):
+    """Return the folder of the shards of the read files in the cache"""
+    key = json.dumps([list(locations), shard_size])
+    return os.path.join(cache, hashlib.md5(key).hexdigest()[:16])
+
+
+def shard_names(location, shards):
+    """Return the file names of the shards of a read file"""
+    name = os.path.basename(location)
+    for suffix in READ_SUFFIXES:
+        if name.endswith(suffix):
+            stem = name[:-len(suffix)]
+            return ["%s_shard%03d%s" % (stem, index + 1, suffix)
+                    for index in range(shards)]
+    raise AttributeError("Only fastq.gz files can be sharded: %s" % location)
+
+
+def count_shards(locations, shard_size):
+    """Return the number of shards for the read files of a pair"""
+    size = max([os.path.getsize(location) for location in locations])
+    return max(1, -(-size // shard_size))
+
+
+def read_record(read_file, location):
+    """Return the four lines of the next fastq record, or None at the end"""
+    header = read_file.readline()
+    if not header:
+        return None
+    lines = [header, read_file.readline(), read_file.readline(),
+             read_file.readline()]
+    if not header.startswith('@') or not lines[3]:
+        raise AttributeError("Not a complete fastq record in %s: %s" %
+                             (location, header.strip()))
+    return ''.join(lines)
+
+
+def split_reads(locations, folder, shards):
+    """
+    Split the read files of a pair in lockstep into at most the given
+    number of shards in the folder. The shards break where the first read
+    file has been read up to the next share of its compressed size.
+
+    Returns the file names of the shards, as one list per shard with the
+    names for every read file.
+    """
+    sources = [CountingFile(location) for location in locations]
+    readers = [io.BufferedReader(gzip.GzipFile(fileobj=source, mode='rb'),
+                                 CHUNK_SIZE) for source in sources]
+    names = [shard_names(location, shards) for location in locations]
+    size = os.path.getsize(locations[0])
+    written = []
+    outputs = []
+    try:
+        while True:
+            records = [read_record(reader, location)
+                       for reader, location in zip(readers, locations)]
+            if None in records:
+                if [record for record in records if record is not None]:
+                    raise AttributeError("The mates do not have the same "
+                                         "number of records: %s" %
+                                         " ".join(locations))
+                break
+            if not written or (len(written) < shards and
+                               sources[0].count * shards >=
+                               size * len(written)):
+                for output in outputs:
+                    output.close()
+                shard = [mate_names[len(written)] for mate_names in names]
+                outputs = [gzip.open(os.path.join(folder, name + '.part'),
+                                     'wb', COMPRESS_LEVEL) for name in shard]
+                written.append(shard)
+            for output, record in zip(outputs, records):
+                output.write(record)
+    finally:
+        for output in outputs:
+            output.close()
+        for reader in readers:
+            reader.close()
+        for source in sources:
+            source.close()
+    for shard in written:
+        for name in shard:
+            path = os.path.join(folder, name)
+            os.rename(path + '.part', path)
+    return written
+
+
+def is_complete(entry, folder, identity):
+    """Return True if the shards in the folder can be used as they are"""
+    if entry is None or entry.get('status') != 'complete':
+        return False
+    if entry.get('identity') != identity:
+        return False
+    for shard in entry['shards']:
+        for name in shard:
+            if not os.path.exists(os.path.join(folder, name)):
+                return False
+    return True
+
+
+def remove_shards(folder):
+    """Remove the shards left over in the folder"""
+    for name in os.listdir(folder):
+        if name.endswith(READ_SUFFIXES) or name.endswith('.part'):
+            os.remove(os.path.join(folder, name))
+
+
+def shard_reads(cache, locations, shard_size, part_location=None,
+                dry_run=False):
+    """
+    Return the paths of the shards of the read files of a pair, or of a
+    single read file, as one list per shard. The read files are split if
+    they have not been split before, and the part is recorded as a user of
+    the shards. With dry_run, nothing is split, and None is returned if the
+    shards are not there yet.
+    """
+    folder = shard_folder(cache, locations, shard_size)
+    identity = identity_key(*locations)
+    if dry_run:
+        entry = read_entry(folder)
+        if not is_complete(entry, folder, identity):
+            return None
+    else:
+        lock = lock_folder(folder)
+        try:
+            entry = read_entry(folder)
+            if not is_complete(entry, folder, identity):
+                print "Sharding %s" % " ".join(locations)
+                parts = (entry or {}).get('parts', [])
+                remove_shards(folder)
+                # The read files are in use while they are being split
+                entry = {'locations': list(locations),
+                         'parts': parts,
+                         'status': 'sharding'}
+                write_entry(folder, entry)
+                shards = count_shards(locations, shard_size)
+                entry.update({'identity': identity,
+                              'shard_size': shard_size,
+                              'shards': split_reads(locations, folder,
+                                                    shards),
+                              'status': 'complete'})
+            if part_location is not None:
+                entry.setdefault('parts', [])
+                if not part_location in entry['parts']:
+                    entry['parts'].append(part_location)
+                    entry['parts'].sort()
+            entry['last_used'] = time.time()
+            write_entry(folder, entry)
+        finally:
+            lock.release()
+    return [[str(os.path.join(folder, name)) for name in shard]
+            for shard in entry['shards']]
+
+
+def shard_labels(read, index):
+    """
+    Return the pair and mate ids of the shard of a read file. The mate id
+    keeps what it adds to the pair id, like the mate number.
+    """
+    pair_id = read.pair_id.strip()
+    mate_id = read.mate_id.strip()
+    shard_pair_id = "%s_shard%s" % (pair_id, index + 1)
+    if mate_id.startswith(pair_id):
+        return shard_pair_id, shard_pair_id + mate_id[len(pair_id):]
+    return shard_pair_id, "%s_shard%s" % (mate_id, index + 1)
+
+
+def group_pairs(accession):
+    """
+    Return the reads of the accession grouped into pairs, or into single
+    reads if the accession is not paired, in the order of the accession.
+    """
+    groups = []
+    pairs = {}
+    for read in accession.reads:
+        if accession.get('paired') == '1':
+            key = read.pair_id.strip()
+        else:
+            key = read.mate_id.strip()
+        if not key in pairs:
+            pairs[key] = []
+            groups.append(pairs[key])
+        pairs[key].append(read)
+    return groups
+
+
+def shard_accession(buildout, accession, part_location, dry_run=False):
+    """
+    Split the read files of the accession that are larger than the
+    shard_size setting, in parallel, for the part. With dry_run, nothing is
+    split.
+
+    Returns the accession with the shards in place of the read files.
+    """
+    settings = buildout['settings']
+    shard_size = lru.parse_size(settings['shard_size'])
+    workers = int(settings.get('shard_workers', '4'))
+    cache = get_shard_cache(buildout)
+    accession = parse_accession(accession)
+    if accession.get('type') == 'bam':
+        return accession
+    jobs = []
+    for group in group_pairs(accession):
+        locations = tuple([read.location.strip() for read in group])
+        # Missing files are reported when the read folder is installed
+        if not [location for location in locations
+                if not os.path.exists(location)]:
+            if count_shards(locations, shard_size) > 1:
+                jobs.append(locations)
+    if not jobs:
+        return accession
+
+    def shard(locations):
+        """Shard one pair"""
+        return shard_reads(cache, locations, shard_size, part_location,
+                           dry_run)
+
+    pool = ThreadPool(max(1, min(workers, len(jobs))))
+    try:
+        sharded = dict(zip(jobs, pool.map(shard, jobs, chunksize=1)))
+    finally:
+        pool.close()
+        pool.join()
+
+    lines = dict([(attribute, []) for attribute
+                  in ['file_location', 'pair_id', 'mate_id', 'label']])
+    for group in group_pairs(accession):
+        locations = tuple([read.location.strip() for read in group])
+        shards = sharded.get(locations)
+        if shards is None:
+            if locations in sharded:
+                print "Would shard %s" % " ".join(locations)
+            for read in group:
+                lines['file_location'].append(read.location)
+                lines['pair_id'].append(read.pair_id)
+                lines['mate_id'].append(read.mate_id)
+                lines['label'].append(read.label)
+            continue
+        for index, paths in enumerate(shards):
+            for read, path in zip(group, paths):
+                pair_id, mate_id = shard_labels(read, index)
+                lines['file_location'].append(path)
+                lines['pair_id'].append(pair_id)
+                lines['mate_id'].append(mate_id)
+                lines['label'].append(read.label)
+    section = dict(accession.items())
+    for attribute, values in lines.items():
+        section[attribute] = '\n'.join(values)
+    return parse_accession(section, accession.name)
+
+
+def live_parts(folder, entry):
+    """Return the parts whose readData folder still links to a shard"""
+    parts = set()
+    for shard in entry.get('shards', []):
+        for name in shard:
+            parts.update(linking_parts(os.path.join(folder, name), entry))
+    return sorted(parts)
+
+
+def live_sources(cache):
+    """
+    Return the read files that the shards parts still link to were split
+    from, or that are being split right now.
+    """
+    sources = set()
+    for folder in lru.locked_folders(cache):
+        try:
+            lock = FolderLock(folder, wait=False)
+        except IOError:
+            # Being split right now
+            entry = read_entry(folder) or {}
+            sources.update(entry.get('locations', []))
+            continue
+        try:
+            entry = read_entry(folder) or {}
+            if live_parts(folder, entry):
+                sources.update(entry.get('locations', []))
+        finally:
+            lock.release()
+    return sources
+
+
+def sharded_sources(buildout):
+    """
+    Return the read files that the shards in use of the buildout were split
+    from. Without the shard_size setting, nothing is sharded.
+    """
+    if not buildout['settings'].get('shard_size', ''):
+        return set()
+    return live_sources(get_shard_cache(buildout))
+
+
+def evict_shards(cache, budget, dry_run=False):
+    """
+    Remove the least recently used shards until the cache is within the
+    budget in bytes. Shards that parts link to, or that are being split,
+    are never removed.
+
+    Returns the entries of the removed shards.
+    """
+    return lru.evict_folders(cache, budget, read_entry, write_entry,
+                             live_parts, dry_run)
+
+
+def evict_once(buildout):
+    """
+    Keep the shard cache within the shard_budget setting. This is done once
+    per buildout run.
+    """
+    return lru.evict_once(get_shard_cache(buildout),
+                          buildout['settings']['shard_budget'], evict_shards,
+                          'shards')
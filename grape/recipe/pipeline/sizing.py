@@ -0,0 +1,185 @@
+"""
+Automatic sizing of the FLUXMEM and THREADS pipeline options.
+
+Pipeline profiles are usually tuned for the largest experiment, so small
+experiments ask for more memory than they need, and large ones run out of
+it. With FLUXMEM = auto or THREADS = auto in a profile, the values are
+estimated for every part from the size of its input:
+
+    reads       The read counts of the sampled read files if check_reads is
+                given, or else an estimate from the size of the read files
+    annotation  The size of the annotation file
+
+The Flux Capacitor needs a base amount of memory, memory for the annotation
+it keeps in memory, and memory growing with the number of reads. The mapper
+gets one thread for every ten million reads. The estimates are kept within
+the floors and caps of the settings, where the caps default to the memory
+and cores of the machine preparing the part:
+
+    fluxmem_floor   4G
+    fluxmem_cap     The memory of the machine
+    threads_floor   1
+    threads_cap     The cores of the machine
+
+The chosen values and how they were found are written as comments into the
+start.sh script of the part, from where they are read by grape-job-array and
+grape-run-parts.
+"""
+
+import os
+import re
+import multiprocessing
+
+from grape.recipe.pipeline.accession import parse_accession
+
+AUTO = 'auto'
+
+GIGABYTE = 1024 * 1024 * 1024
+
+# Compressed bytes of a read in a fastq.gz or bam file of 2x76 reads
+BYTES_PER_READ = 60
+
+BASE_MEMORY = 2
+
+READS_PER_GIGABYTE = 25 * 1000 * 1000
+
+# The parsed annotation takes about ten times the size of the file
+ANNOTATION_FACTOR = 10
+
+READS_PER_THREAD = 10 * 1000 * 1000
+
+SIZING_LINE = re.compile(r'^# (FLUXMEM|THREADS) = (\d+)G?: ')
+
+
+def machine_memory():
+    """Return the memory of the machine in gigabytes, or None"""
+    try:
+        meminfo = open('/proc/meminfo')
+    except IOError:
+        return None
+    try:
+        for line in meminfo:
+            if line.startswith('MemTotal:'):
+                return int(line.split()[1]) // (1024 * 1024)
+    finally:
+        meminfo.close()
+    return None
+
+
+def is_auto(pipeline):
+    """Check whether FLUXMEM or THREADS of the pipeline are sized here"""
+    return pipeline.get('FLUXMEM', '') == AUTO or \
+        pipeline.get('THREADS', '') == AUTO
+
+
+def get_limits(settings):
+    """
+    Return the floor and cap of the memory in gigabytes, and of the
+    threads, from the settings or the resources of the machine.
+    """
+    # Import here, as prepare depends on this module
+    from grape.recipe.pipeline.prepare import parse_flux_mem
+    from grape.recipe.pipeline.prepare import parse_integer
+    memory_floor = int(parse_flux_mem(settings.get('fluxmem_floor', '4G')))
+    if 'fluxmem_cap' in settings:
+        memory_cap = int(parse_flux_mem(settings['fluxmem_cap']))
+    else:
+        memory_cap = machine_memory() or memory_floor
+    threads_floor = int(parse_integer(settings.get('threads_floor', '1')))
+    if 'threads_cap' in settings:
+        threads_cap = int(parse_integer(settings['threads_cap']))
+    else:
+        threads_cap = multiprocessing.cpu_count()
+    if memory_cap < memory_floor or threads_cap < threads_floor:
+        raise AttributeError("The caps of FLUXMEM and THREADS need to be at "
+                             "least their floors")
+    return (memory_floor, memory_cap), (threads_floor, threads_cap)
+
+
+def count_reads(file_locations, samples=None):
+    """
+    Return the number of reads of the read files, how they were found, and
+    the total size of the files. The samples of check_reads are used when
+    there are any, and the size of the files otherwise.
+    """
+    size = 0
+    for file_location in file_locations:
+        if os.path.exists(file_location):
+            size += os.path.getsize(file_location)
+    if samples and all(file_location in samples
+                       for file_location in file_locations):
+        reads = sum(samples[file_location]['estimated_reads']
+                    for file_location in file_locations)
+        return reads, "counted in the samples of the read files", size
+    reads = size // BYTES_PER_READ
+    return reads, "estimated from %.1f GB of read files" % (
+        float(size) / GIGABYTE), size
+
+
+def clamp(value, limits):
+    """Keep the value within the floor and cap, and say if it was changed"""
+    floor, cap = limits
+    if value < floor:
+        return floor, ", raised to the floor of %s" % floor
+    if value > cap:
+        return cap, ", lowered to the cap of %s" % cap
+    return value, ""
+
+
+def size_pipeline(buildout, accession, pipeline, samples=None):
+    """
+    Replace the auto FLUXMEM and THREADS options of the pipeline with the
+    estimated values. Returns the comment lines explaining the values.
+    """
+    if not is_auto(pipeline):
+        return []
+    memory_limits, thread_limits = get_limits(buildout['settings'])
+    accession = parse_accession(accession)
+    file_locations = [file_location.strip() for file_location
+                      in accession.get_lines('file_location')]
+    reads, source, _ = count_reads(file_locations, samples)
+    lines = ["# Sized for %s reads, %s" % (reads, source)]
+
+    if pipeline.get('FLUXMEM', '') == AUTO:
+        annotation = pipeline.get('ANNOTATION', '')
+        annotation_size = 0
+        if os.path.exists(annotation):
+            annotation_size = os.path.getsize(annotation)
+        read_memory = -(-reads // READS_PER_GIGABYTE)
+        annotation_memory = -(-annotation_size * ANNOTATION_FACTOR //
+                              GIGABYTE)
+        memory, limited = clamp(BASE_MEMORY + read_memory + annotation_memory,
+                                memory_limits)
+        pipeline['FLUXMEM'] = "%sG" % memory
+        lines.append("# FLUXMEM = %sG: %sG base + %sG for the reads + %sG "
+                     "for %.1f GB of annotation%s" %
+                     (memory, BASE_MEMORY, read_memory, annotation_memory,
+                      float(annotation_size) / GIGABYTE, limited))
+
+    if pipeline.get('THREADS', '') == AUTO:
+        threads, limited = clamp(-(-reads // READS_PER_THREAD),
+                                 thread_limits)
+        pipeline['THREADS'] = str(threads)
+        lines.append("# THREADS = %s: one thread per %s reads%s" %
+                     (threads, READS_PER_THREAD, limited))
+    return lines
+
+
+def read_sizing(location):
+    """
+    Return the FLUXMEM and THREADS values written into the start.sh script
+    of a part, as a dictionary of integers.
+    """
+    path = os.path.join(location, 'start.sh')
+    if not os.path.exists(path):
+        return {}
+    sizing = {}
+    start = open(path)
+    try:
+        for line in start:
+            match = SIZING_LINE.match(line)
+            if match is not None:
+                sizing[match.group(1)] = int(match.group(2))
+    finally:
+        start.close()
+    return sizing
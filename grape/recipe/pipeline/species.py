@@ -0,0 +1,234 @@
+"""
+Species detection for quick mode by the content of the genome and
+annotation.
+
+Quick mode used to recognize the species only by a few known file names.
+Instead, the genome and annotation files are now recognized by fingerprints
+of cheap features read from the start of the files:
+
+    genome      The names of the sequences, and the bases other than N, in
+                the first million bases, however the lines are wrapped
+    annotation  The sequence names, features and positions of the first
+                records in the first megabyte
+
+The fingerprints of the known genomes and annotations are kept in a species
+registry, which is var/pipeline/species.json by default, or given by the
+species_registry setting. New species are registered with the
+grape-species script, from files known to belong to the species:
+
+    bin/grape-species -r species.json register "Mus musculus" \
+        M.musculus.genome.mm9.main.fa mm9_ucsc_UCSC_genes.gtf
+
+The fingerprints are cached by file identity, so every file is only read
+once.
+"""
+
+import os
+import sys
+import json
+import hashlib
+import optparse
+
+from grape.recipe.pipeline.cache import FileCache
+from grape.recipe.pipeline.cache import identity_key
+from grape.recipe.pipeline.cache import get_cache_path
+from grape.recipe.pipeline.jsonfile import write_json
+
+HEAD_SIZE = 1024 * 1024
+
+GENOME_BASES = 1024 * 1024
+
+ANNOTATION_RECORDS = 100
+
+KINDS = ('genomes', 'annotations')
+
+
+def read_head_lines(path):
+    """
+    Return the complete lines in the first megabyte of the file. A line cut
+    off at the end of the megabyte is left out.
+    """
+    head_file = open(path, 'rb')
+    try:
+        head = head_file.read(HEAD_SIZE)
+    finally:
+        head_file.close()
+    lines = head.split('\n')
+    if len(head) == HEAD_SIZE:
+        lines = lines[:-1]
+    return [line.rstrip('\r') for line in lines]
+
+
+def genome_features(path):
+    """
+    Return the sequence names and the digest of the bases in the first
+    GENOME_BASES bases of a genome. The bases are counted rather than the
+    bytes, so that the features do not depend on the line width.
+    """
+    names = []
+    bases = hashlib.md5()
+    remaining = GENOME_BASES
+    header = False
+    line_start = True
+    genome_file = open(path, 'rb')
+    try:
+        while remaining > 0:
+            # Some genomes are not wrapped at all, so long lines are read in
+            # pieces
+            piece = genome_file.readline(HEAD_SIZE)
+            if not piece:
+                break
+            if line_start:
+                header = piece.startswith('>')
+                if header:
+                    names.append((piece[1:].split() or [''])[0])
+            if not header:
+                # Line widths and masking differ between copies of a genome
+                sequence = piece.strip()[:remaining]
+                remaining -= len(sequence)
+                bases.update(sequence.upper().replace('N', ''))
+            line_start = piece.endswith('\n')
+    finally:
+        genome_file.close()
+    return [names, bases.hexdigest()]
+
+
+def annotation_features(path):
+    """Return the first records of an annotation"""
+    records = []
+    for line in read_head_lines(path):
+        if not line or line.startswith('#'):
+            continue
+        fields = line.split('\t')
+        if len(fields) < 9:
+            continue
+        # Sequence name, feature, start, end and strand
+        records.append([fields[0], fields[2], fields[3], fields[4],
+                        fields[6]])
+        if len(records) == ANNOTATION_RECORDS:
+            break
+    return records
+
+
+def file_fingerprint(path, kind, cache_path=None):
+    """
+    Return the fingerprint of a genome or annotation file, cached by file
+    identity if a cache is given.
+    """
+    if kind == 'genomes':
+        features = genome_features
+    else:
+        features = annotation_features
+    if cache_path is None:
+        return hashlib.md5(repr(features(path))).hexdigest()
+    cache = FileCache(cache_path)
+    try:
+        key = identity_key(path)
+        result = cache.get(key, 'species:%s' % kind)
+        if result is None:
+            result = hashlib.md5(repr(features(path))).hexdigest()
+            cache.set(key, 'species:%s' % kind, path, result)
+    finally:
+        cache.close()
+    return str(result)
+
+
+def load_registry(path):
+    """Return the species registry, which is empty if there is none"""
+    if not os.path.exists(path):
+        return {'species': {}}
+    registry_file = open(path)
+    try:
+        return json.load(registry_file)
+    finally:
+        registry_file.close()
+
+
+def save_registry(path, registry):
+    """Write the species registry, replacing it in one rename"""
+    write_json(path, registry)
+
+
+def register_species(path, species, genome, annotation, cache_path=None):
+    """Add the fingerprints of a genome and an annotation of a species"""
+    registry = load_registry(path)
+    entry = registry['species'].setdefault(species, {'genomes': [],
+                                                     'annotations': []})
+    for kind, file_path in zip(KINDS, [genome, annotation]):
+        value = file_fingerprint(file_path, kind, cache_path)
+        if not value in entry[kind]:
+            entry[kind].append(value)
+    save_registry(path, registry)
+    return entry
+
+
+def match_species(registry, genome, annotation, cache_path=None):
+    """
+    Return the species of which both the genome and the annotation are
+    registered, or None.
+    """
+    fingerprints = [file_fingerprint(genome, 'genomes', cache_path),
+                    file_fingerprint(annotation, 'annotations', cache_path)]
+    for species, entry in sorted(registry['species'].items()):
+        if fingerprints[0] in entry['genomes'] and \
+                fingerprints[1] in entry['annotations']:
+            return str(species)
+    return None
+
+
+def get_registry_path(buildout):
+    """Return the path of the species registry of the buildout"""
+    settings = buildout['settings']
+    if 'species_registry' in settings:
+        return settings['species_registry']
+    buildout_directory = buildout['buildout']['directory']
+    return os.path.join(buildout_directory, 'var/pipeline/species.json')
+
+
+def detect_species(buildout, genome, annotation):
+    """
+    Return the species of the genome and annotation from the species
+    registry of the buildout, or None if they are not registered.
+    """
+    path = get_registry_path(buildout)
+    if not os.path.exists(path):
+        return None
+    return match_species(load_registry(path), genome, annotation,
+                         get_cache_path(buildout, 'species_cache'))
+
+
+def main(args=None):
+    """
+    Entry point of the grape-species console script.
+    """
+    usage = ("%prog -r REGISTRY register SPECIES GENOME ANNOTATION\n"
+             "       %prog -r REGISTRY match GENOME ANNOTATION\n"
+             "       %prog -r REGISTRY list")
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option('-r', '--registry', dest='registry',
+                      help="The species registry file")
+    options, args = parser.parse_args(args)
+    if options.registry is None or not args:
+        parser.error("Give the registry and a command")
+    if args[0] == 'register' and len(args) == 4:
+        register_species(options.registry, args[1], args[2], args[3])
+        print "Registered %s" % args[1]
+    elif args[0] == 'match' and len(args) == 3:
+        species = match_species(load_registry(options.registry), args[1],
+                                args[2])
+        if species is None:
+            print "Unknown species"
+            return 1
+        print species
+    elif args[0] == 'list' and len(args) == 1:
+        registry = load_registry(options.registry)
+        for species, entry in sorted(registry['species'].items()):
+            print "%s\t%s genomes\t%s annotations" % (
+                species, len(entry['genomes']), len(entry['annotations']))
+    else:
+        parser.error("Unknown command: %s" % " ".join(args))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
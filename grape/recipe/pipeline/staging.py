@@ -0,0 +1,354 @@
+"""
+Local staging cache for remote or slow read files.
+
+Read files are linked into the readData folder of every part where they
+are. Files on http servers can not be linked to, and files on slow network
+file systems make every step of the pipeline slow. With a staging cache,
+these files are first copied to a local folder:
+
+    [settings]
+    staging_cache = /scratch/grape/staging
+    stage_reads = remote
+    staging_workers = 4
+    staging_budget = 2T
+
+With stage_reads = remote, only http and https locations are staged, with
+stage_reads = all, every read file is. Every staged file gets its own
+folder, keyed by its location, which is shared by all the parts and
+projects using the cache:
+
+    /scratch/grape/staging/0123456789abcdef/
+        entry.json
+        .lock
+        reads_1.fastq.gz
+
+The files of a part are transferred in parallel. A transfer goes to a .part
+file first, so an interrupted transfer is resumed where it stopped, using a
+range request for http. The entry records the identity of the file being
+transferred, and the .part file is discarded when the file has changed.
+When the accession has an md5sum attribute with one line per file, the
+transferred files are checked against it.
+
+With the staging_budget setting, the least recently used files are removed
+when the cache is over its size budget. Files that parts still link to are
+never removed, and neither are files that parts link to the shards of.
+"""
+
+import os
+import json
+import time
+import urllib2
+import hashlib
+import urlparse
+from multiprocessing.pool import ThreadPool
+
+from grape.recipe.pipeline import lru
+from grape.recipe.pipeline.cache import identity_key
+from grape.recipe.pipeline.lock import lock_folder
+from grape.recipe.pipeline.jsonfile import write_json
+from grape.recipe.pipeline.accession import parse_accession
+
+REMOTE_PREFIXES = ('http://', 'https://')
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def is_remote(location):
+    """Return True if the location is on an http server"""
+    return location.startswith(REMOTE_PREFIXES)
+
+
+def needs_staging(settings, location):
+    """Return True if the read file has to be staged"""
+    if is_remote(location):
+        return True
+    return settings.get('stage_reads', 'remote') == 'all'
+
+
+def location_filename(location):
+    """Return the file name of a path or url"""
+    if is_remote(location):
+        location = urlparse.urlparse(location).path
+    return os.path.basename(location)
+
+
+def entry_folder(cache, location):
+    """Return the folder of the staged file in the cache"""
+    return os.path.join(cache, hashlib.md5(location).hexdigest()[:16])
+
+
+def staged_path(cache, location):
+    """Return the path of the staged file in the cache"""
+    return os.path.join(entry_folder(cache, location),
+                        location_filename(location))
+
+
+def read_entry(folder):
+    """Return the metadata of a staged file, or None if there is none"""
+    path = os.path.join(folder, 'entry.json')
+    if not os.path.exists(path):
+        return None
+    entry_file = open(path)
+    try:
+        return json.load(entry_file)
+    finally:
+        entry_file.close()
+
+
+def write_entry(folder, entry):
+    """Write the metadata of a staged file, replacing it in one rename"""
+    write_json(os.path.join(folder, 'entry.json'), entry)
+
+
+def open_source(location, offset):
+    """
+    Open the read file at the offset. The server may not support ranges,
+    in which case the file is read from the start.
+
+    Returns the stream, the offset it starts at, and the total size of the
+    file, which may be None for servers that do not tell.
+    """
+    if not is_remote(location):
+        total = os.path.getsize(location)
+        if offset > total:
+            offset = 0
+        stream = open(location, 'rb')
+        stream.seek(offset)
+        return stream, offset, total
+    request = urllib2.Request(location)
+    if offset:
+        request.add_header('Range', 'bytes=%s-' % offset)
+    try:
+        stream = urllib2.urlopen(request)
+    except urllib2.HTTPError, error:
+        if error.code != 416:
+            raise AttributeError("Can not download %s: %s" % (location,
+                                                              error))
+        # The partial file is already complete, or bigger than the file
+        stream = urllib2.urlopen(urllib2.Request(location))
+    headers = stream.info()
+    if stream.getcode() == 206:
+        # Content-Range: bytes 100-999/1000
+        total = headers.get('Content-Range', '').split('/')[-1]
+    else:
+        offset = 0
+        total = headers.get('Content-Length', '')
+    if total.isdigit():
+        return stream, offset, int(total)
+    return stream, offset, None
+
+
+def transfer_file(location, path, md5sum=None):
+    """
+    Transfer the read file to the path, resuming a partial transfer, and
+    check the size and the md5sum if it is given.
+
+    Returns the md5sum of the transferred file.
+    """
+    partial = path + '.part'
+    offset = 0
+    digest = hashlib.md5()
+    if os.path.exists(partial):
+        partial_file = open(partial, 'rb')
+        try:
+            for chunk in iter(lambda: partial_file.read(CHUNK_SIZE), ''):
+                digest.update(chunk)
+                offset += len(chunk)
+        finally:
+            partial_file.close()
+    stream, start, total = open_source(location, offset)
+    try:
+        if start != offset:
+            # Start again from scratch
+            digest = hashlib.md5()
+            partial_file = open(partial, 'wb')
+        else:
+            partial_file = open(partial, 'ab')
+        try:
+            for chunk in iter(lambda: stream.read(CHUNK_SIZE), ''):
+                digest.update(chunk)
+                partial_file.write(chunk)
+        finally:
+            partial_file.close()
+    finally:
+        stream.close()
+    size = os.path.getsize(partial)
+    if total is not None and size != total:
+        # The partial file is kept, and the next transfer resumes it
+        raise AttributeError("Incomplete transfer of %s: %s of %s bytes" %
+                             (location, size, total))
+    if md5sum and digest.hexdigest() != md5sum:
+        os.remove(partial)
+        raise AttributeError("Wrong md5sum for %s: %s instead of %s" %
+                             (location, digest.hexdigest(), md5sum))
+    os.rename(partial, path)
+    return digest.hexdigest()
+
+
+def source_identity(location):
+    """
+    Return the identity of a local read file, so that changed files are
+    staged again. Files on http servers are expected to stay the same.
+    """
+    if is_remote(location):
+        return None
+    return identity_key(location)
+
+
+def is_complete(entry, path, identity, md5sum):
+    """Return True if the staged file can be used as it is"""
+    if entry is None or entry.get('status') != 'complete':
+        return False
+    if not os.path.exists(path):
+        return False
+    if entry.get('identity') != identity:
+        return False
+    return not md5sum or entry.get('md5sum') == md5sum
+
+
+def stage_file(cache, location, part_location, md5sum=None):
+    """
+    Return the path of the staged read file, transferring it if needed.
+    The part is recorded as a user of the file.
+    """
+    folder = entry_folder(cache, location)
+    path = staged_path(cache, location)
+    identity = source_identity(location)
+    lock = lock_folder(folder)
+    try:
+        entry = read_entry(folder)
+        if entry is None:
+            entry = {'location': location,
+                     'status': 'registered',
+                     'parts': []}
+        if not is_complete(entry, path, identity, md5sum):
+            print "Staging %s" % location
+            partial = path + '.part'
+            if os.path.exists(partial) and \
+                    (entry.get('status') != 'partial' or
+                     entry.get('identity') != identity):
+                # Left over by a transfer of another version of the file
+                os.remove(partial)
+            entry['identity'] = identity
+            entry['status'] = 'partial'
+            write_entry(folder, entry)
+            started = time.time()
+            entry['md5sum'] = transfer_file(location, path, md5sum)
+            entry['size'] = os.path.getsize(path)
+            entry['transfer_seconds'] = time.time() - started
+            entry['status'] = 'complete'
+        if not part_location in entry['parts']:
+            entry['parts'].append(part_location)
+            entry['parts'].sort()
+        entry['last_used'] = time.time()
+        write_entry(folder, entry)
+    finally:
+        lock.release()
+    return path
+
+
+def get_md5sums(accession):
+    """
+    Return the md5sum of every file location, if the accession has an
+    md5sum attribute with one line per file.
+    """
+    locations = accession.get_lines('file_location')
+    md5sums = accession.get('md5sum', '').split('\n')
+    if len(md5sums) != len(locations):
+        md5sums = [''] * len(locations)
+    return dict(zip([location.strip() for location in locations],
+                    [md5sum.strip() for md5sum in md5sums]))
+
+
+def stage_accession(buildout, accession, part_location, dry_run=False):
+    """
+    Stage the read files of the accession that need staging, in parallel.
+    With dry_run, nothing is transferred.
+
+    Returns the accession with the file locations of the staged files.
+    """
+    settings = buildout['settings']
+    cache = settings['staging_cache']
+    workers = int(settings.get('staging_workers', '4'))
+    accession = parse_accession(accession)
+    md5sums = get_md5sums(accession)
+    locations = [location.strip() for location
+                 in accession.get_lines('file_location')]
+    remote = sorted(set([location for location in locations
+                         if needs_staging(settings, location)]))
+    if not remote:
+        return accession
+
+    def stage(location):
+        """Stage one file"""
+        return stage_file(cache, location, part_location, md5sums[location])
+
+    if dry_run:
+        paths = [staged_path(cache, location) for location in remote]
+    else:
+        pool = ThreadPool(max(1, min(workers, len(remote))))
+        try:
+            paths = pool.map(stage, remote, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    staged = dict(zip(remote, paths))
+    section = dict(accession.items())
+    section['file_location'] = '\n'.join([staged.get(location, location)
+                                          for location in locations])
+    return parse_accession(section, accession.name)
+
+
+def live_parts(path, entry):
+    """Return the parts whose readData folder still links to the file"""
+    parts = []
+    for location in entry.get('parts', []):
+        link = os.path.join(location, 'readData', os.path.basename(path))
+        try:
+            if os.readlink(link) == path:
+                parts.append(location)
+        except OSError:
+            pass
+    return parts
+
+
+def staged_file(folder, entry):
+    """Return the path of the staged file in the folder of its entry"""
+    return os.path.join(folder, location_filename(entry.get('location', '')))
+
+
+def evict_staged(cache, budget, dry_run=False, sharded=()):
+    """
+    Remove the least recently used files until the cache is within the
+    budget in bytes. Files that parts link to, that are being transferred,
+    or that are among the sharded files in use, are never removed.
+
+    Returns the entries of the removed files.
+    """
+
+    def linking_parts(folder, entry):
+        """Return the parts that link to the staged file"""
+        return live_parts(staged_file(folder, entry), entry)
+
+    def is_sharded(folder, entry):
+        """Check whether parts link to the shards of the staged file"""
+        return staged_file(folder, entry) in sharded
+
+    return lru.evict_folders(cache, budget, read_entry, write_entry,
+                             linking_parts, dry_run, is_sharded)
+
+
+def evict_once(buildout, sharded=()):
+    """
+    Keep the staging cache within the staging_budget setting. This is done
+    once per buildout run. With sharding, parts link to the shards of the
+    staged files instead, so the sharded files are kept as well.
+    """
+    settings = buildout['settings']
+
+    def evict(cache, budget):
+        """Evict the staging cache"""
+        return evict_staged(cache, budget, sharded=sharded)
+
+    return lru.evict_once(settings['staging_cache'],
+                          settings['staging_budget'], evict, 'staged file')
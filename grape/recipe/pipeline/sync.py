@@ -0,0 +1,280 @@
+"""
+Incremental installation of a source folder into a target folder.
+
+Instead of removing the target folder and copying the whole source folder
+again, a manifest of what was installed last time is kept next to the target
+folder. For every file the manifest records the size, modification time and
+content hash of the source, and the size and modification time of the
+installed copy, so that only the files that actually changed need to be
+copied, patched or deleted:
+
+    var/pipeline/bin
+    var/pipeline/bin.manifest
+"""
+
+import os
+import shutil
+import hashlib
+import json
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from grape.recipe.pipeline.jsonfile import write_json
+
+MANIFEST_VERSION = 1
+
+COPY_MODES = ('copy', 'hardlink', 'reflink')
+
+# The Linux ioctl for cloning a file on copy-on-write file systems
+FICLONE = 0x40049409
+
+
+def manifest_path(target):
+    """Return the path of the manifest kept for the target folder"""
+    return "%s.manifest" % target.rstrip(os.sep)
+
+
+def file_hash(path):
+    """Return the md5 hex digest of the content of a file"""
+    digest = hashlib.md5()
+    source = open(path, 'rb')
+    try:
+        chunk = source.read(65536)
+        while chunk:
+            digest.update(chunk)
+            chunk = source.read(65536)
+    finally:
+        source.close()
+    return digest.hexdigest()
+
+
+def reflink_file(source, target):
+    """
+    Clone the source into the target, sharing the data blocks on file
+    systems that support copy-on-write, like Btrfs or XFS.
+    """
+    if fcntl is None:
+        raise OSError("Reflinks are not supported on this platform")
+    source_file = open(source, 'rb')
+    try:
+        try:
+            target_file = open(target, 'wb')
+        except IOError as error:
+            raise OSError("Can not reflink %s to %s: %s" %
+                          (source, target, error))
+        try:
+            fcntl.ioctl(target_file.fileno(), FICLONE, source_file.fileno())
+        except (IOError, OSError) as error:
+            target_file.close()
+            # Only the target made here is removed
+            os.remove(target)
+            raise OSError("Can not reflink %s to %s: %s" %
+                          (source, target, error))
+        target_file.close()
+    finally:
+        source_file.close()
+    shutil.copystat(source, target)
+
+
+def copy_file(source, target, mode='copy'):
+    """
+    Install the source file at the target using the given copy mode:
+
+    copy: make a full copy
+    hardlink: make a hard link to the source file
+    reflink: make a copy-on-write clone of the source file
+
+    When the file system does not support the copy mode, for example when
+    the source and target are on different devices, a full copy is made.
+    """
+    if not mode in COPY_MODES:
+        raise AttributeError("Unknown copy mode: %s" % mode)
+    if mode == 'hardlink':
+        try:
+            os.link(source, target)
+            return
+        except OSError:
+            pass
+    elif mode == 'reflink':
+        try:
+            reflink_file(source, target)
+            return
+        except OSError:
+            pass
+    shutil.copy2(source, target)
+
+
+def copy_tree(source, target, mode='copy', own_copy=None):
+    """
+    Like shutil.copytree, but installing the files with the given copy mode.
+
+    own_copy is an optional function taking the relative path of a file. The
+    files for which it returns True always get a full copy, because they are
+    going to be modified after copying.
+    """
+    for dirpath, dirnames, filenames in os.walk(source, followlinks=True):
+        dirnames.sort()
+        relative = os.path.relpath(dirpath, source)
+        folder = os.path.normpath(os.path.join(target, relative))
+        os.makedirs(folder)
+        for filename in sorted(filenames):
+            relative_path = os.path.normpath(os.path.join(relative, filename))
+            file_mode = mode
+            if own_copy is not None and own_copy(relative_path):
+                file_mode = 'copy'
+            copy_file(os.path.join(dirpath, filename),
+                      os.path.join(folder, filename),
+                      file_mode)
+
+
+def read_manifest(path):
+    """
+    Read a manifest. A missing or unreadable manifest is the same as an empty
+    one, which forces a full installation.
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        manifest_file = open(path, 'r')
+        try:
+            manifest = json.load(manifest_file)
+        finally:
+            manifest_file.close()
+    except (IOError, ValueError):
+        return None
+    if manifest.get('version') != MANIFEST_VERSION:
+        return None
+    return manifest
+
+
+def write_manifest(path, manifest):
+    """Write the manifest to a temporary file and move it into place"""
+    write_json(path, manifest)
+
+
+def walk_files(folder):
+    """
+    Yield the paths of all files in the folder relative to the folder.
+    Symbolic links are followed like shutil.copytree does when copying.
+    """
+    for dirpath, dirnames, filenames in os.walk(folder, followlinks=True):
+        dirnames.sort()
+        relative = os.path.relpath(dirpath, folder)
+        for filename in sorted(filenames):
+            if relative == os.curdir:
+                yield filename
+            else:
+                yield os.path.join(relative, filename)
+
+
+def remove_empty_folders(target, relative_path):
+    """Remove the folders of a deleted file as long as they are empty"""
+    folder = os.path.dirname(relative_path)
+    while folder:
+        try:
+            os.rmdir(os.path.join(target, folder))
+        except OSError:
+            return
+        folder = os.path.dirname(folder)
+
+
+def target_unchanged(target_path, entry):
+    """Check whether the installed copy is still the one that was installed"""
+    try:
+        stat = os.lstat(target_path)
+    except OSError:
+        return False
+    return [stat.st_size, stat.st_mtime] == entry[3:5]
+
+
+def sync_folder(source, target, stamp='', patch=None, mode='copy',
+                own_copy=None):
+    """
+    Bring the target folder up to date with the source folder.
+
+    stamp is stored in the manifest; when it changes, all files are installed
+    again, and the files that are gone from the source are still removed.
+    This is used for settings that influence the installed files, like
+    the Perl version written into the shebangs.
+
+    patch is an optional function taking a list of (relative path, installed
+    path) tuples of the files that have just been copied. It can modify the
+    installed copies.
+
+    mode and own_copy decide how the files are installed, as for copy_tree.
+
+    Returns a dictionary with the lists of copied, deleted and unchanged
+    relative paths.
+    """
+    path = manifest_path(target)
+    manifest = read_manifest(path)
+    if manifest is None or not os.path.isdir(target):
+        # Nothing is known about the contents of the target, so start afresh
+        shutil.rmtree(target, ignore_errors=True)
+        old_files = {}
+        restamped = False
+    else:
+        old_files = manifest['files']
+        restamped = manifest.get('stamp') != stamp
+    if not os.path.isdir(target):
+        os.makedirs(target)
+
+    report = {'copied': [], 'deleted': [], 'unchanged': []}
+    files = {}
+    for relative_path in walk_files(source):
+        source_path = os.path.join(source, relative_path)
+        target_path = os.path.join(target, relative_path)
+        stat = os.stat(source_path)
+        entry = old_files.get(relative_path)
+        if entry is not None and not restamped and \
+                target_unchanged(target_path, entry):
+            if entry[0:2] == [stat.st_size, stat.st_mtime]:
+                files[relative_path] = entry
+                report['unchanged'].append(relative_path)
+                continue
+            content_hash = file_hash(source_path)
+            if entry[2] == content_hash:
+                # Only touched, so just remember the new modification time
+                files[relative_path] = [stat.st_size,
+                                        stat.st_mtime,
+                                        content_hash] + entry[3:5]
+                report['unchanged'].append(relative_path)
+                continue
+        else:
+            content_hash = file_hash(source_path)
+        folder = os.path.dirname(target_path)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        if os.path.lexists(target_path):
+            os.remove(target_path)
+        file_mode = mode
+        if own_copy is not None and own_copy(relative_path):
+            file_mode = 'copy'
+        copy_file(source_path, target_path, file_mode)
+        files[relative_path] = [stat.st_size, stat.st_mtime, content_hash]
+        report['copied'].append(relative_path)
+
+    if patch is not None and report['copied']:
+        patch([(relative_path, os.path.join(target, relative_path))
+               for relative_path in report['copied']])
+    for relative_path in report['copied']:
+        # Remember the installed copy as it is after patching
+        target_stat = os.lstat(os.path.join(target, relative_path))
+        files[relative_path].extend([target_stat.st_size,
+                                     target_stat.st_mtime])
+
+    for relative_path in sorted(old_files):
+        if relative_path in files:
+            continue
+        target_path = os.path.join(target, relative_path)
+        if os.path.lexists(target_path):
+            os.remove(target_path)
+        remove_empty_folders(target, relative_path)
+        report['deleted'].append(relative_path)
+
+    write_manifest(path, {'version': MANIFEST_VERSION,
+                          'stamp': stamp,
+                          'files': files})
+    return report
@@ -0,0 +1,21 @@
+"""
+Fixtures shared by the tests of quick mode, built on the synthetic
+buildouts of the benchmark
+"""
+
+from grape.recipe.pipeline import benchmark
+from grape.recipe.pipeline.benchmark import write_reads
+from grape.recipe.pipeline.benchmark import quick_part
+from grape.recipe.pipeline.benchmark import QUICK_GENOME
+from grape.recipe.pipeline.benchmark import QUICK_ANNOTATION
+
+__all__ = ['make_quick_buildout', 'write_reads', 'quick_part',
+           'QUICK_GENOME', 'QUICK_ANNOTATION']
+
+
+def make_quick_buildout(folder, files=4):
+    """
+    Write a buildout for quick mode with the given number of lane files,
+    and only one script and module in src/pipeline to keep it fast.
+    """
+    return benchmark.make_quick_buildout(folder, files, 1, 1)
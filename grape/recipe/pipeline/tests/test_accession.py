@@ -0,0 +1,71 @@
+"""
+Test for accession.py
+"""
+
+import unittest
+
+from grape.recipe.pipeline.accession import Accession
+from grape.recipe.pipeline.accession import parse_accession
+
+
+ACCESSION = {'file_location': '/data/testA.r2.fastq.gz\n'
+                              '/data/testA.r1.fastq.gz',
+             'pair_id': 'testA\ntestA',
+             'mate_id': 'testA.2\ntestA.1',
+             'label': 'Test\nTest',
+             'paired': '1'}
+
+
+class AccessionTests(unittest.TestCase):
+    """
+    Test the Accession class in accession.py
+    """
+
+    def test_reads(self):
+        """
+        There is one record per read file
+        """
+        accession = Accession(ACCESSION, 'TestRun')
+        reads = accession.reads
+        self.failUnless(len(reads) == 2)
+        self.failUnless(reads[1].location == '/data/testA.r1.fastq.gz')
+        self.failUnless(reads[1].pair_id == 'testA')
+        self.failUnless(reads[1].mate_id == 'testA.1')
+        self.failUnless(reads[1].label == 'Test')
+        # The records are only built once
+        self.failUnless(accession.reads is reads)
+
+    def test_other_attributes(self):
+        """
+        The other attributes are looked up in the accession section
+        """
+        accession = Accession(ACCESSION, 'TestRun')
+        self.failUnless(accession['paired'] == '1')
+        self.failUnless('paired' in accession)
+        self.failIf('species' in accession)
+        self.failUnless(parse_accession(accession) is accession)
+
+    def test_missing_attribute(self):
+        """
+        A missing label attribute is an error
+        """
+        section = ACCESSION.copy()
+        del section['mate_id']
+        accession = Accession(section, 'TestRun')
+        self.failUnlessRaises(AttributeError, accession.get_reads)
+
+    def test_wrong_number_of_lines(self):
+        """
+        The label attributes need one line per read file
+        """
+        section = ACCESSION.copy()
+        section['label'] = 'Test'
+        accession = Accession(section, 'TestRun')
+        self.failUnlessRaises(AttributeError, accession.get_reads)
+
+
+def test_suite():
+    """
+    Run the test suite
+    """
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
@@ -0,0 +1,234 @@
+"""
+Test for accessiondb.py
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from grape.recipe.pipeline import accessiondb
+from grape.recipe.pipeline.accessiondb import AccessionDatabase
+from grape.recipe.pipeline.accessiondb import compile_database
+from grape.recipe.pipeline.accessiondb import get_section
+from grape.recipe.pipeline.accessiondb import get_database
+from grape.recipe.pipeline.prepare import main
+from grape.recipe.pipeline.tests.test_prepare import BuildoutTestCase
+from grape.recipe.pipeline.tests.test_prepare import BUILDOUT
+from grape.recipe.pipeline.tests.test_prepare import OPTIONS
+from grape.recipe.pipeline.tests.test_prepare import PATH
+
+ACCESSIONS = """
+[TestRun]
+species = Homo sapiens
+readType = 2x76
+type = fastq
+paired = 1
+cell = NHEK
+rnaExtract = LONGPOLYA
+localization = CELL
+qualities = solexa
+replicate = 1
+file_location = ${buildout:directory}/src/testdata/testA.r2.fastq.gz
+                ${buildout:directory}/src/testdata/testA.r1.fastq.gz
+pair_id = testA
+          testA
+mate_id = testA.2
+          testA.1
+label = Test
+        Test
+
+[OtherRun]
+species = Homo sapiens
+file_location =
+    /data/other.fastq.gz
+    ${buildout:directory}/../data/shared.fastq.gz
+"""
+
+PROFILES = """
+[TestProfile]
+THREADS = 4
+"""
+
+
+def write_source(path, content):
+    """Write a db.cfg file"""
+    source = open(path, 'w')
+    source.write(content)
+    source.close()
+
+
+class AccessionDatabaseTests(unittest.TestCase):
+    """
+    Test the AccessionDatabase class in accessiondb.py
+    """
+
+    def setUp(self):  # pylint: disable=C0103
+        self.folder = tempfile.mkdtemp('accessionDbTest')
+        self.path = os.path.join(self.folder, 'accessions.db')
+        self.sources = [os.path.join(self.folder, 'accessions.cfg'),
+                        os.path.join(self.folder, 'profiles.cfg')]
+        write_source(self.sources[0], ACCESSIONS)
+        write_source(self.sources[1], PROFILES)
+
+    def tearDown(self):  # pylint: disable=C0103
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def test_get(self):
+        """
+        Sections are fetched by name, with case sensitive option names and
+        the values as written.
+        """
+        database = AccessionDatabase(self.path, self.sources)
+        accession = database.get('TestRun')
+        self.failUnless(accession['readType'] == '2x76')
+        self.failUnless(accession['pair_id'] == 'testA\ntestA')
+        self.failUnless(accession['file_location'].startswith(
+            '${buildout:directory}/'))
+        self.failUnless(database.get('TestProfile') == {'THREADS': '4'})
+        self.failUnless(database.get('Missing') is None)
+        self.failUnless(database.names() == ['OtherRun', 'TestProfile',
+                                             'TestRun'])
+        database.close()
+
+    def test_compile_once(self):
+        """
+        The database is only compiled again when a source changes.
+        """
+        AccessionDatabase(self.path, self.sources).close()
+        identity = os.stat(self.path).st_ino
+        AccessionDatabase(self.path, self.sources).close()
+        self.failUnless(os.stat(self.path).st_ino == identity)
+        write_source(self.sources[1], PROFILES + "MAPPER = GEM\n")
+        database = AccessionDatabase(self.path, self.sources)
+        self.failUnless(database.get('TestProfile')['MAPPER'] == 'GEM')
+        database.close()
+
+    def test_accessions_using_file(self):
+        """
+        The accessions are found by the locations of their files.
+        """
+        compile_database(self.path, self.sources)
+        database = AccessionDatabase(self.path)
+        result = database.accessions_using_file('/data/other.fastq.gz')
+        self.failUnless(result == [('OtherRun', self.sources[0])])
+        self.failUnless(database.accessions_using_file('/data/x.gz') == [])
+        # References to the buildout directory are found given the directory
+        buildout_directory = os.path.join(self.folder, 'buildout')
+        result = database.accessions_using_file(
+            'src/testdata/testA.r1.fastq.gz', buildout_directory)
+        self.failUnless(result == [('TestRun', self.sources[0])])
+        result = database.accessions_using_file(
+            os.path.join(self.folder, 'data/shared.fastq.gz'),
+            buildout_directory)
+        self.failUnless(result == [('OtherRun', self.sources[0])])
+        database.close()
+
+    def test_leading_empty_line(self):
+        """
+        A value starting on the next line has no empty first line.
+        """
+        database = AccessionDatabase(self.path, self.sources)
+        self.failUnless(database.get('OtherRun')['file_location'] ==
+                        '/data/other.fastq.gz\n'
+                        '${buildout:directory}/../data/shared.fastq.gz')
+        database.close()
+
+    def test_unsupported(self):
+        """
+        The extension syntax of buildout is an error.
+        """
+        write_source(self.sources[1], PROFILES + "MAPPER += GEM\n")
+        self.failUnlessRaises(AttributeError, compile_database, self.path,
+                              self.sources)
+        write_source(self.sources[1], PROFILES + "<= OtherProfile\n")
+        self.failUnlessRaises(AttributeError, compile_database, self.path,
+                              self.sources)
+
+    def test_missing_database(self):
+        """
+        Without sources, the database has to exist.
+        """
+        self.failUnlessRaises(AttributeError, AccessionDatabase, self.path)
+
+
+class DatabaseBuildoutTests(BuildoutTestCase):
+    """
+    Test the preparation of parts with accessions from the database
+    """
+
+    def setUp(self):  # pylint: disable=C0103
+        BuildoutTestCase.setUp(self)
+        accessiondb.DATABASES.clear()
+
+    def prepare_buildout(self):
+        """
+        Move the accession from the buildout to the database
+        """
+        buildout = BuildoutTestCase.prepare_buildout(self)
+        del buildout['TestRun']
+        source = os.path.join(PATH, 'accessions.cfg')
+        write_source(source, ACCESSIONS)
+        buildout['settings']['accession_db'] = os.path.join(PATH,
+                                                            'accessions.db')
+        buildout['settings']['accession_db_sources'] = source
+        return buildout
+
+    def test_get_section(self):
+        """
+        References to other sections are substituted when fetching.
+        """
+        buildout = self.prepare_buildout()
+        accession = get_section(buildout, 'TestRun')
+        self.failUnless(accession['file_location'].startswith(PATH))
+        self.failUnless(get_section(buildout, 'pipeline') is
+                        buildout['pipeline'])
+        self.failUnlessRaises(KeyError, get_section, buildout, 'Missing')
+
+    def test_encoded_values(self):
+        """
+        The values of the sections are strings, like those of buildout.
+        """
+        buildout = self.prepare_buildout()
+        accession = get_section(buildout, 'TestRun')
+        for key, value in accession.items():
+            self.failUnless(type(key) is str)
+            self.failUnless(type(value) is str)
+
+    def test_forked_database(self):
+        """
+        A forked process opens the database again instead of sharing the
+        connection of its parent.
+        """
+        buildout = self.prepare_buildout()
+        database = get_database(buildout)
+        self.failUnless(get_database(buildout) is database)
+        child = os.fork()
+        if child == 0:
+            status = 1
+            try:
+                if get_database(buildout) is not database and \
+                        get_section(buildout, 'TestRun'):
+                    status = 0
+            finally:
+                os._exit(status)  # pylint: disable=W0212
+        _, status = os.waitpid(child, 0)
+        self.failUnless(status == 0)
+
+    def test_main(self):
+        """
+        The part is prepared with the accession from the database.
+        """
+        buildout = self.prepare_buildout()
+        main(OPTIONS.copy(), buildout)
+        read_list = os.path.join(OPTIONS['location'], 'read.list.txt')
+        self.failUnless(os.path.exists(read_list))
+        self.failIf('TestRun' in buildout)
+        self.failUnless('TestRun' in BUILDOUT)
+
+
+def test_suite():
+    """
+    Run the test suite
+    """
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
@@ -0,0 +1,89 @@
+"""
+Test for batch.py
+"""
+
+import os
+import unittest
+
+from grape.recipe.pipeline.batch import prepare_parts
+from grape.recipe.pipeline.prepare import INSTALLATION_STATE
+from grape.recipe.pipeline.prepare import is_up_to_date
+from grape.recipe.pipeline.tests.test_prepare import BuildoutTestCase
+from grape.recipe.pipeline.tests.test_prepare import BUILDOUT
+from grape.recipe.pipeline.tests.test_prepare import PATH
+
+
+def add_runs(buildout, names=('TestRun', 'OtherRun')):
+    """
+    Add the parts and the runs section to the buildout
+    """
+    buildout['buildout'] = {'directory': PATH,
+                            'parts-directory': os.path.join(PATH, 'parts')}
+    buildout['runs'] = {'parts': ' '.join(names)}
+    # The part and its accession are defined in the same section
+    for name in names:
+        buildout[name] = BUILDOUT['TestRun'].copy()
+        buildout[name]['recipe'] = 'grape.recipe.pipeline'
+        buildout[name]['accession'] = name
+    return buildout
+
+
+class PreparePartsTests(BuildoutTestCase):
+    """
+    Test the prepare_parts method in batch.py
+    """
+
+    def prepare_buildout(self):
+        """
+        Add a second part and the runs section to the buildout
+        """
+        return add_runs(BuildoutTestCase.prepare_buildout(self))
+
+    def test_prepare_parts(self):
+        """
+        All parts of the runs section are prepared over a process pool.
+        """
+        buildout = self.prepare_buildout()
+        locations = prepare_parts(buildout, processes=2)
+        self.failUnless(len(locations) == 2)
+        for location in locations:
+            self.failUnless(os.path.exists(os.path.join(location,
+                                                        'start.sh')))
+            self.failUnless(os.path.exists(os.path.join(location,
+                                                        'read.list.txt')))
+        self.failUnless(os.path.islink('var/pipeline/bin/flux'))
+        # The parts are up to date for the next buildout run
+        INSTALLATION_STATE.__init__()
+        options = dict(buildout['OtherRun'].items())
+        options['location'] = locations[1]
+        self.failUnless(is_up_to_date(options, buildout))
+
+    def test_up_to_date(self):
+        """
+        Parts that are up to date are skipped, and a dry run installs
+        nothing.
+        """
+        buildout = self.prepare_buildout()
+        locations = prepare_parts(buildout, processes=1, dry_run=True)
+        self.failUnless(len(locations) == 2)
+        self.failIf(os.path.exists('var/pipeline/bin'))
+        self.failIf(os.path.exists(os.path.join(locations[0], 'start.sh')))
+        prepare_parts(buildout, processes=1)
+        INSTALLATION_STATE.__init__()
+        self.failUnless(prepare_parts(buildout, processes=1) == [])
+
+    def test_missing_accession(self):
+        """
+        Parts without an accession are skipped.
+        """
+        buildout = self.prepare_buildout()
+        buildout['Missing'] = {'accession': 'MissingAccession'}
+        locations = prepare_parts(buildout, ['Missing'], 1)
+        self.failUnless(locations == [])
+
+
+def test_suite():
+    """
+    Run the test suite
+    """
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
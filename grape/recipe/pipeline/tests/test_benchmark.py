@@ -0,0 +1,100 @@
+"""
+Test for benchmark.py
+"""
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from grape.recipe.pipeline.benchmark import make_buildout
+from grape.recipe.pipeline.benchmark import run_benchmark
+from grape.recipe.pipeline.benchmark import compare_results
+from grape.recipe.pipeline.benchmark import find_baseline
+from grape.recipe.pipeline.benchmark import main
+
+
+class BenchmarkTests(unittest.TestCase):
+    """
+    Test the run_benchmark method in benchmark.py
+    """
+
+    def setUp(self):  # pylint: disable=C0103
+        self.folder = tempfile.mkdtemp('benchmarkTest')
+
+    def tearDown(self):  # pylint: disable=C0103
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def test_make_buildout(self):
+        """
+        The synthetic buildout has the parts, read files and sources.
+        """
+        buildout = make_buildout(self.folder, 3, 2, 150, 10)
+        self.failUnless(buildout['runs']['parts'].split() ==
+                        ['Run0000', 'Run0001', 'Run0002'])
+        accession = buildout[buildout['Run0001']['accession']]
+        for location in accession['file_location'].split('\n'):
+            self.failUnless(os.path.exists(location))
+        bin_folder = os.path.join(self.folder, 'src/pipeline/bin')
+        self.failUnless(sorted(os.listdir(bin_folder)) ==
+                        ['group0', 'group1'])
+
+    def test_run(self):
+        """
+        Every scenario prepares the parts and is measured.
+        """
+        results = run_benchmark(self.folder, 2, 2, 20, 5)
+        self.failUnless(sorted(results['scenarios']) ==
+                        ['install', 'quick', 'reinstall', 'update'])
+        for scenario in results['scenarios'].values():
+            self.failUnless(scenario['seconds'] > 0)
+            self.failUnless(scenario['peak_memory_mb'] > 0)
+        install = results['scenarios']['install']
+        self.failUnless(install['os_calls'] > 0)
+        self.failUnless(install['steps']['read_folder']['count'] == 2)
+        # Nothing has changed for the update
+        self.failIf('read_folder' in results['scenarios']['update']['steps'])
+        for name in ['Run0000', 'Run0001']:
+            part = os.path.join(self.folder, 'parts/parts', name)
+            self.failUnless(os.path.exists(os.path.join(part, 'start.sh')))
+        quick = os.path.join(self.folder, 'quick/parts/Run/start.sh')
+        self.failUnless(os.path.exists(quick))
+
+    def test_compare(self):
+        """
+        Scenarios slower than the threshold are regressions.
+        """
+        def run(version, seconds):
+            """Return the results of a run"""
+            scenario = {'seconds': seconds, 'os_calls': 10,
+                        'peak_memory_mb': 20.0}
+            return {'version': version, 'parameters': {'parts': 1},
+                    'scenarios': {'install': scenario}}
+        runs = [run('1.1.15', 1.0), run('1.1.16', 2.0)]
+        baseline = find_baseline(runs, run('1.1.16', 3.0))
+        self.failUnless(baseline['version'] == '1.1.15')
+        lines, regressions = compare_results(baseline, run('1.1.16', 3.0))
+        self.failUnless(len(lines) == 1)
+        self.failUnless(regressions == ['install'])
+        _, regressions = compare_results(baseline, run('1.1.16', 1.1))
+        self.failIf(regressions)
+
+    def test_main(self):
+        """
+        The results are appended to the output file.
+        """
+        output = os.path.join(self.folder, 'benchmarks.json')
+        # Timings this small are noise, so nothing counts as slower
+        args = ['-p', '1', '-f', '2', '-s', '5', '-l', '5', '-o', output,
+                '-d', self.folder, '-t', '1000', 'install']
+        self.failUnless(main(args) == 0)
+        self.failUnless(main(args + ['update']) == 0)
+        self.failUnless(len(json.load(open(output))) == 2)
+
+
+def test_suite():
+    """
+    Run the test suite
+    """
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
@@ -0,0 +1,112 @@
+"""
+Test for discover.py
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from grape.recipe.pipeline.discover import walk_files
+from grape.recipe.pipeline.discover import parse_read_name
+from grape.recipe.pipeline.discover import group_reads
+from grape.recipe.pipeline.discover import READ_SUFFIXES
+from grape.recipe.pipeline.tests.helpers import make_quick_buildout
+from grape.recipe.pipeline.tests.helpers import quick_part
+from grape.recipe.pipeline.tests.helpers import write_reads
+
+
+class DiscoverTests(unittest.TestCase):
+    """
+    Test the discovery of read files in discover.py
+    """
+
+    def setUp(self):  # pylint: disable=C0103
+        self.folder = tempfile.mkdtemp('discoverTest')
+
+    def tearDown(self):  # pylint: disable=C0103
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def touch(self, relative_path):
+        """Make an empty file in the folder and return its path"""
+        path = os.path.join(self.folder, relative_path)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        open(path, 'w').close()
+        return path
+
+    def test_walk_files(self):
+        """
+        Subfolders are searched, but not hidden folders, the folders of
+        buildout or links to folders.
+        """
+        expected = [self.touch('a.fastq.gz'),
+                    self.touch('lane1/b.fq.gz'),
+                    self.touch('lane1/deeper/c.fastq.gz')]
+        self.touch('lane1/notes.txt')
+        self.touch('.hidden/d.fastq.gz')
+        self.touch('parts/Run/readData/e.fastq.gz')
+        os.symlink(os.path.join(self.folder, 'lane1'),
+                   os.path.join(self.folder, 'link'))
+        self.failUnless(list(walk_files(self.folder, READ_SUFFIXES)) ==
+                        expected)
+
+    def test_parse_read_name(self):
+        """
+        The sample, the pair and the mate are taken from the file name.
+        """
+        sample, unit, mate = parse_read_name('/d/A_S1_L001_R2_001.fastq.gz')
+        self.failUnless((sample, unit, mate) ==
+                        ('A', '/d/A_S1_L001_001.fastq.gz', '2'))
+        self.failUnless(parse_read_name('/d/B.R1.fq.gz')[::2] == ('B', '1'))
+        self.failUnless(parse_read_name('/d/C_1.fastq.gz')[::2] == ('C', '1'))
+        self.failUnless(parse_read_name('/d/D.fastq.gz')[::2] == ('D', None))
+
+    def test_group_reads(self):
+        """
+        The lanes of a sample are grouped, and mates are paired.
+        """
+        paths = ['/d/L1/A_S1_L001_R1_001.fastq.gz',
+                 '/d/L1/A_S1_L001_R2_001.fastq.gz',
+                 '/d/L2/A_S1_L002_R1_001.fastq.gz',
+                 '/d/L2/A_S1_L002_R2_001.fastq.gz',
+                 '/d/B_1.fastq.gz',
+                 '/d/C.fastq.gz']
+        samples = group_reads(paths)
+        self.failUnless(sorted(samples) == ['A', 'B', 'C'])
+        self.failUnless(samples['A']['paired'])
+        self.failUnless(samples['A']['reads'] == [
+            ('A_1', 'A_1.1', paths[0]), ('A_1', 'A_1.2', paths[1]),
+            ('A_2', 'A_2.1', paths[2]), ('A_2', 'A_2.2', paths[3])])
+        # A mate without its partner is single end
+        self.failIf(samples['B']['paired'])
+        self.failUnless(samples['B']['reads'] == [('B_1', 'B_1', paths[4])])
+
+    def test_quick(self):
+        """
+        Quick mode prepares one paired run per sample.
+        """
+        buildout = make_quick_buildout(self.folder, 0)
+        for sample in ['SampleA', 'SampleB']:
+            for lane in [1, 2]:
+                for mate in [1, 2]:
+                    write_reads(os.path.join(
+                        self.folder, 'delivery/%s/L%s/%s_L00%s_R%s.fastq.gz'
+                        % (sample, lane, sample, lane, mate)))
+        quick_part(buildout)
+        for sample in ['SampleA', 'SampleB']:
+            part = os.path.join(self.folder, 'parts/Run', sample)
+            start = open(os.path.join(part, 'start.sh')).read()
+            self.failUnless(" -readlength 76 " in start, start)
+            self.failUnless(" -experiment %s " % sample in start)
+            self.failUnless(len(os.listdir(os.path.join(part,
+                                                        'readData'))) == 4)
+            read_list = open(os.path.join(part, 'read.list.txt')).read()
+            self.failUnless('%s_2.1' % sample in read_list)
+
+
+def test_suite():
+    """
+    Run the test suite
+    """
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
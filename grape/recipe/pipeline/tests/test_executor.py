@@ -0,0 +1,95 @@
+"""
+Test for executor.py
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from grape.recipe.pipeline.executor import Job
+from grape.recipe.pipeline.executor import pick_jobs
+from grape.recipe.pipeline.executor import run_jobs
+
+
+class PickJobsTests(unittest.TestCase):
+    """
+    Test the pick_jobs method in executor.py
+    """
+
+    def test_pick(self):
+        """
+        Jobs are taken in order, and smaller jobs fill the gaps.
+        """
+        jobs = [Job('/parts/A', 4, 16), Job('/parts/B', 8, 8),
+                Job('/parts/C', 2, 32), Job('/parts/D', 2, 8)]
+        picked = pick_jobs(jobs, 8, 32)
+        self.failUnless([job.name for job in picked] == ['A', 'D'])
+        picked = pick_jobs(jobs, 14, None)
+        self.failUnless([job.name for job in picked] == ['A', 'B', 'C'])
+
+    def test_fit(self):
+        """
+        Jobs bigger than the machine get the whole machine.
+        """
+        job = Job('/parts/A', 32, 64)
+        job.fit(8, 16)
+        self.failUnless((job.threads, job.memory) == (8, 16))
+
+
+class RunJobsTests(unittest.TestCase):
+    """
+    Test the run_jobs method in executor.py
+    """
+
+    def setUp(self):  # pylint: disable=C0103
+        self.folder = tempfile.mkdtemp('executorTest')
+
+    def tearDown(self):  # pylint: disable=C0103
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def get_jobs(self, count, threads):
+        """Return jobs for parts in the temporary folder"""
+        jobs = []
+        for index in range(count):
+            location = os.path.join(self.folder, 'Run%s' % index)
+            os.mkdir(location)
+            jobs.append(Job(location, threads, None))
+        return jobs
+
+    def test_run(self):
+        """
+        The output of every part is streamed with the part name, and the
+        number of parts running at the same time is limited by the cores.
+        """
+        jobs = self.get_jobs(3, 2)
+        output = StringIO()
+        command = "echo started; sleep 0.2; basename $PWD > done; exit 0"
+        summary = run_jobs(jobs, 4, None, command, output, 0.02)
+        lines = output.getvalue().splitlines()
+        for job in jobs:
+            self.failUnless("[%s] started" % job.name in lines)
+            self.failUnless(os.path.exists(os.path.join(job.location,
+                                                        'done')))
+        self.failUnless(len([line for line in lines
+                             if line.startswith('Finished')]) == 3)
+        self.failUnless(summary['parts'] == 3)
+        self.failUnless(set(summary['exit_codes'].values()) == set([0]))
+        # Only two of the parts fit at the same time
+        self.failUnless(summary['seconds'] >= 0.4)
+
+    def test_failure(self):
+        """
+        The exit codes of failed parts are reported.
+        """
+        jobs = self.get_jobs(1, 1)
+        summary = run_jobs(jobs, 1, None, "exit 3", StringIO(), 0.02)
+        self.failUnless(summary['exit_codes'] == {jobs[0].location: 3})
+
+
+def test_suite():
+    """
+    Run the test suite
+    """
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
@@ -0,0 +1,195 @@
+"""
+Test for gemindex.py
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import multiprocessing
+
+from grape.recipe.pipeline.gemindex import register_index
+from grape.recipe.pipeline.gemindex import read_metadata
+from grape.recipe.pipeline.gemindex import write_metadata
+from grape.recipe.pipeline.gemindex import evict_indices
+from grape.recipe.pipeline.prepare import main
+from grape.recipe.pipeline.tests.test_prepare import BuildoutTestCase
+from grape.recipe.pipeline.tests.test_prepare import OPTIONS
+
+COMMAND = "sleep 0.2; echo built >> %(folder)s/builds"
+
+
+def register_worker(job):
+    """Register the index in a separate process"""
+    buildout, pipeline, location = job
+    return register_index(buildout, pipeline, location)
+
+
+class RegistryTestCase(unittest.TestCase):
+    """
+    A registry in a temporary folder, with a genome
+    """
+
+    def setUp(self):  # pylint: disable=C0103
+        self.folder = tempfile.mkdtemp('gemIndexTest')
+        self.registry = os.path.join(self.folder, 'registry')
+        self.genome = self.write_genome('genome.fa')
+        self.buildout = {'settings': {'gemindices_registry': self.registry,
+                                      'gem_index_command': COMMAND,
+                                      'gem_version': '1.6'}}
+        self.pipeline = {'GENOMESEQ': self.genome, 'MAPPER': 'GEM'}
+
+    def tearDown(self):  # pylint: disable=C0103
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def write_genome(self, name):
+        """Write a small genome"""
+        path = os.path.join(self.folder, name)
+        genome = open(path, 'w')
+        genome.write('>chr1\nACGTACGT\n')
+        genome.close()
+        return path
+
+    def builds(self, folder):
+        """Return the number of times the index has been built"""
+        return len(open(os.path.join(folder, 'builds')).readlines())
+
+
+class RegisterIndexTests(RegistryTestCase):
+    """
+    Test the register_index method in gemindex.py
+    """
+
+    def test_register(self):
+        """
+        The index is built once, and reused for the same genome content.
+        """
+        folder = register_index(self.buildout, self.pipeline, '/parts/A')
+        self.failUnless(os.path.basename(folder).startswith('GEM-'))
+        copy = {'GENOMESEQ': self.write_genome('copy.fa'), 'MAPPER': 'GEM'}
+        self.failUnless(register_index(self.buildout, copy, '/parts/B') ==
+                        folder)
+        self.failUnless(self.builds(folder) == 1)
+        metadata = read_metadata(folder)
+        self.failUnless(metadata['status'] == 'complete')
+        self.failUnless(metadata['parts'] == ['/parts/A', '/parts/B'])
+        # Another mapper version needs another index
+        self.buildout['settings']['gem_version'] = '1.7'
+        self.failIf(register_index(self.buildout, self.pipeline,
+                                   '/parts/A') == folder)
+
+    def test_concurrent(self):
+        """
+        Parts registering at the same time wait for the one builder.
+        """
+        jobs = [(self.buildout, self.pipeline, '/parts/%s' % index)
+                for index in range(4)]
+        pool = multiprocessing.Pool(4)
+        try:
+            folders = pool.map(register_worker, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        self.failUnless(len(set(folders)) == 1, folders)
+        self.failUnless(self.builds(folders[0]) == 1)
+        self.failUnless(len(read_metadata(folders[0])['parts']) == 4)
+
+    def test_failed_build(self):
+        """
+        A failed build is an error, and is tried again next time.
+        """
+        self.buildout['settings']['gem_index_command'] = 'exit 1'
+        self.failUnlessRaises(AttributeError, register_index, self.buildout,
+                              self.pipeline, '/parts/A')
+        self.buildout['settings']['gem_index_command'] = COMMAND
+        folder = register_index(self.buildout, self.pipeline, '/parts/A')
+        self.failUnless(self.builds(folder) == 1)
+
+    def test_missing_genome(self):
+        """
+        The genome has to exist.
+        """
+        self.pipeline['GENOMESEQ'] = os.path.join(self.folder, 'missing.fa')
+        self.failUnlessRaises(AttributeError, register_index, self.buildout,
+                              self.pipeline, '/parts/A')
+
+
+class EvictIndicesTests(RegistryTestCase):
+    """
+    Test the evict_indices method in gemindex.py
+    """
+
+    def register(self, name, last_used, size):
+        """Register an index for a genome, used at the given time"""
+        pipeline = {'GENOMESEQ': self.write_genome(name), 'MAPPER': 'GEM'}
+        open(pipeline['GENOMESEQ'], 'a').write(name)
+        part = os.path.join(self.folder, name + '.part')
+        if not os.path.exists(part):
+            os.mkdir(part)
+        folder = register_index(self.buildout, pipeline, part)
+        open(os.path.join(folder, 'index.gem'), 'w').write('x' * size)
+        metadata = read_metadata(folder)
+        metadata['last_used'] = last_used
+        write_metadata(folder, metadata)
+        return folder, part
+
+    def test_evict(self):
+        """
+        The least recently used indices without links are removed.
+        """
+        self.buildout['settings']['gem_index_command'] = ''
+        old, _ = self.register('old.fa', 1, 1000)
+        linked, part = self.register('linked.fa', 2, 1000)
+        os.symlink(linked, os.path.join(part, 'GEMIndices'))
+        recent, _ = self.register('recent.fa', 3, 1000)
+        evictions = evict_indices(self.registry, 3000, dry_run=True)
+        self.failUnless([entry.path for entry in evictions] == [old])
+        self.failUnless(os.path.exists(old))
+        evictions = evict_indices(self.registry, 1500)
+        self.failUnless([entry.path for entry in evictions] == [old, recent])
+        self.failIf(os.path.exists(old))
+        self.failIf(os.path.exists(recent))
+        self.failUnless(os.path.exists(linked))
+        # An index that is used again is registered again
+        folder, _ = self.register('old.fa', 4, 10)
+        self.failUnless(folder == old)
+        self.failUnless(read_metadata(folder)['last_used'] == 4)
+
+    def test_last_used(self):
+        """
+        Registering a part updates the last use.
+        """
+        folder = register_index(self.buildout, self.pipeline, '/parts/A')
+        metadata = read_metadata(folder)
+        self.failUnless(metadata['last_used'] > 0)
+
+
+class MainRegistryTests(BuildoutTestCase):
+    """
+    Test linking parts to the registry in the main method
+    """
+
+    def test_main(self):
+        """
+        The GEMIndices link of the part points to the index in the registry.
+        """
+        buildout = self.prepare_buildout()
+        genome = os.path.abspath('src/testdata/genome.fa')
+        open(genome, 'w').write('>chr1\nACGT\n')
+        buildout['pipeline'] = buildout['pipeline'].copy()
+        buildout['pipeline']['GENOMESEQ'] = genome
+        registry = os.path.abspath('registry')
+        buildout['settings']['gemindices_registry'] = registry
+        main(OPTIONS.copy(), buildout)
+        link = os.path.join(OPTIONS['location'], 'GEMIndices')
+        self.failUnless(os.path.dirname(os.readlink(link)) == registry)
+        metadata = read_metadata(os.readlink(link))
+        self.failUnless(metadata['status'] == 'registered')
+        self.failUnless(metadata['parts'] == [OPTIONS['location']])
+
+
+def test_suite():
+    """
+    Run the test suite
+    """
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
@@ -0,0 +1,80 @@
+"""
+Test for jobarray.py
+"""
+
+import os
+import unittest
+
+from grape.recipe.pipeline.batch import prepare_parts
+from grape.recipe.pipeline.jobarray import write_job_arrays
+from grape.recipe.pipeline.jobarray import get_resources
+from grape.recipe.pipeline.tests.test_batch import add_runs
+from grape.recipe.pipeline.tests.test_prepare import BuildoutTestCase
+
+
+class JobArrayTests(BuildoutTestCase):
+    """
+    Test the write_job_arrays method in jobarray.py
+    """
+
+    def prepare_buildout(self):
+        """
+        Add three parts, two of them with a profile with more threads
+        """
+        buildout = BuildoutTestCase.prepare_buildout(self)
+        buildout = add_runs(buildout, ['TestRun', 'OtherRun', 'ThirdRun'])
+        buildout['ThreadsProfile'] = {'THREADS': '4'}
+        for name in ['OtherRun', 'ThirdRun']:
+            buildout[name]['pipeline'] = 'ThreadsProfile'
+        return buildout
+
+    def test_resources(self):
+        """
+        The resources come from the pipeline section and the profile.
+        """
+        buildout = self.prepare_buildout()
+        options = {'pipeline': 'ThreadsProfile'}
+        self.failUnless(get_resources(options, buildout) == (4, 16, 'mem_6'))
+        self.failUnless(get_resources({}, buildout) == (2, 16, 'mem_6'))
+
+    def test_slurm(self):
+        """
+        Parts with the same resources are in the same array.
+        """
+        buildout = self.prepare_buildout()
+        prepare_parts(buildout, processes=1)
+        submit = write_job_arrays(buildout, 'slurm')
+        self.failUnless(submit.endswith('var/pipeline/jobs/submit.slurm.sh'))
+        lines = open(submit).read().splitlines()
+        self.failUnless(len(lines) == 3)
+        folder = os.path.dirname(submit)
+        script = open(os.path.join(folder, 't4_m16G_mem_6.slurm.sh')).read()
+        self.failUnless('#SBATCH --array=1-2\n' in script)
+        self.failUnless('#SBATCH --cpus-per-task=4\n' in script)
+        self.failUnless('#SBATCH --partition=mem_6\n' in script)
+        tasks = open(os.path.join(folder, 't4_m16G_mem_6.tasks')).read()
+        self.failUnless(tasks.splitlines() ==
+                        [os.path.join(os.getcwd(), 'parts', name)
+                         for name in ['OtherRun', 'ThirdRun']])
+
+    def test_sge(self):
+        """
+        SGE requests the memory per slot.
+        """
+        buildout = self.prepare_buildout()
+        prepare_parts(buildout, processes=1)
+        submit = write_job_arrays(buildout, 'sge')
+        folder = os.path.dirname(submit)
+        script = open(os.path.join(folder, 't2_m16G_mem_6.sge.sh')).read()
+        self.failUnless('#$ -t 1-1\n' in script)
+        self.failUnless('#$ -pe smp 2\n' in script)
+        self.failUnless('#$ -l h_vmem=8G\n' in script)
+        self.failUnlessRaises(AttributeError, write_job_arrays, buildout,
+                              'lsf')
+
+
+def test_suite():
+    """
+    Run the test suite
+    """
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
@@ -0,0 +1,52 @@
+"""
+Test for lock.py
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from grape.recipe.pipeline.lock import lock_folder
+from grape.recipe.pipeline.lock import remove_folder
+
+
+class LockFolderTests(unittest.TestCase):
+    """
+    Test the lock_folder method in lock.py
+    """
+
+    def setUp(self):  # pylint: disable=C0103
+        self.folder = tempfile.mkdtemp('lockTest')
+        self.makedirs = os.makedirs
+
+    def tearDown(self):  # pylint: disable=C0103
+        os.makedirs = self.makedirs
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def test_removed(self):
+        """
+        A folder removed right after it was made is made again.
+        """
+        folder = os.path.join(self.folder, 'entry')
+        made = []
+
+        def makedirs(path):
+            """Make the folder, and let an evictor remove it the first time"""
+            self.makedirs(path)
+            made.append(path)
+            if len(made) == 1:
+                remove_folder(path)
+
+        os.makedirs = makedirs
+        lock = lock_folder(folder)
+        lock.release()
+        self.failUnless(made == [folder, folder])
+        self.failUnless(os.path.exists(os.path.join(folder, '.lock')))
+
+
+def test_suite():
+    """
+    Run the test suite
+    """
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
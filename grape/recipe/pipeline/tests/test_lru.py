@@ -0,0 +1,117 @@
+"""
+Test for lru.py
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from grape.recipe.pipeline.lru import Entry
+from grape.recipe.pipeline.lru import evict_folders
+from grape.recipe.pipeline.lru import evict_once
+from grape.recipe.pipeline.lru import parse_size
+from grape.recipe.pipeline.lru import select_evictions
+
+
+class LruTests(unittest.TestCase):
+    """
+    Test the sizes and the eviction order in lru.py
+    """
+
+    def test_parse_size(self):
+        """
+        Sizes are given in bytes or with a unit.
+        """
+        self.failUnless(parse_size('100') == 100)
+        self.failUnless(parse_size('2K') == 2048)
+        self.failUnless(parse_size('500G') == 500 * 1024 ** 3)
+        self.failUnless(parse_size('1tb') == 1024 ** 4)
+        self.failUnlessRaises(AttributeError, parse_size, 'much')
+
+    def test_select_evictions(self):
+        """
+        The least recently used entries go first, except referenced ones.
+        """
+        entries = [Entry('a', 10, 3), Entry('b', 10, 1, True),
+                   Entry('c', 10, 2), Entry('d', 10, 4)]
+        evictions = select_evictions(entries, 20)
+        self.failUnless([entry.path for entry in evictions] == ['c', 'a'])
+        self.failUnless(select_evictions(entries, 40) == [])
+        evictions = select_evictions(entries, 0)
+        self.failUnless([entry.path for entry in evictions] ==
+                        ['c', 'a', 'd'])
+
+
+class EvictFoldersTests(unittest.TestCase):
+    """
+    Test the eviction of caches made of locked folders in lru.py
+    """
+
+    def setUp(self):  # pylint: disable=C0103
+        self.cache = tempfile.mkdtemp('lruTest')
+        self.metadata = {}
+        for name, last_used in [('a', 1), ('b', 2), ('c', 3)]:
+            folder = os.path.join(self.cache, name)
+            os.mkdir(folder)
+            open(os.path.join(folder, '.lock'), 'w').close()
+            open(os.path.join(folder, 'data'), 'w').write('x' * 100)
+            self.metadata[folder] = {'last_used': last_used,
+                                     'parts': ['gone']}
+
+    def tearDown(self):  # pylint: disable=C0103
+        shutil.rmtree(self.cache, ignore_errors=True)
+
+    def read_metadata(self, folder):
+        """Return a copy of the metadata of the folder"""
+        return dict(self.metadata[folder])
+
+    def write_metadata(self, folder, metadata):
+        """Remember the metadata of the folder"""
+        self.metadata[folder] = metadata
+
+    def live_parts(self, folder, _):
+        """Only the parts of folder c are still there"""
+        if folder.endswith('c'):
+            return ['part']
+        return []
+
+    def in_use(self, folder, _):
+        """Folder a is in use"""
+        return folder.endswith('a')
+
+    def test_evict(self):
+        """
+        Folders without live parts that are not in use are removed, and the
+        parts that are gone are dropped from the metadata.
+        """
+        evictions = evict_folders(self.cache, 0, self.read_metadata,
+                                  self.write_metadata, self.live_parts,
+                                  in_use=self.in_use)
+        self.failUnless([entry.path for entry in evictions] ==
+                        [os.path.join(self.cache, 'b')])
+        self.failUnless(sorted(os.listdir(self.cache)) == ['a', 'c'])
+        self.failUnless(self.metadata[os.path.join(self.cache, 'a')]
+                        ['parts'] == [])
+
+    def test_once(self):
+        """
+        A cache is only evicted once per process.
+        """
+        calls = []
+
+        def evict(cache, budget):
+            """Remember the call"""
+            calls.append((cache, budget))
+            return []
+
+        evict_once(self.cache, '1K', evict, 'test')
+        evict_once(self.cache, '1K', evict, 'test')
+        self.failUnless(calls == [(self.cache, 1024)])
+
+
+def test_suite():
+    """
+    Run the test suite
+    """
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
@@ -0,0 +1,104 @@
+"""
+Test for mates.py
+"""
+
+import os
+import gzip
+import shutil
+import tempfile
+import unittest
+
+from grape.recipe.pipeline.mates import verify_pairs
+from grape.recipe.pipeline.mates import read_stem
+from grape.recipe.pipeline.prepare import verify_read_mates
+
+
+def write_mate(path, names, mate):
+    """Write a gzipped fastq file with the reads of one mate"""
+    output = gzip.open(path, 'wb')
+    for name in names:
+        output.write("@%s/%s\nACGT\n+\nIIII\n" % (name, mate))
+    output.close()
+
+
+class VerifyPairsTests(unittest.TestCase):
+    """
+    Test the verify_pairs method in mates.py
+    """
+
+    def setUp(self):  # pylint: disable=C0103
+        self.folder = tempfile.mkdtemp('matesTest')
+        self.cache = os.path.join(self.folder, 'mates.db')
+        self.names = ['read%s' % index for index in range(1000)]
+
+    def tearDown(self):  # pylint: disable=C0103
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def pair(self, name, first_names, second_names):
+        """Write the two mates of a pair and return their paths"""
+        first = os.path.join(self.folder, '%s_1.fastq.gz' % name)
+        second = os.path.join(self.folder, '%s_2.fastq.gz' % name)
+        write_mate(first, first_names, 1)
+        write_mate(second, second_names, 2)
+        return first, second
+
+    def test_read_stem(self):
+        """
+        The mate suffix and the comment are not part of the stem.
+        """
+        self.failUnless(read_stem('@HWI:1:2#0/1\n') == 'HWI:1:2#0')
+        self.failUnless(read_stem('@HWI:1:2 2:N:0\n') == 'HWI:1:2')
+
+    def test_verify(self):
+        """
+        Mates with other read names or other numbers of reads are found.
+        """
+        good = self.pair('good', self.names, self.names)
+        swapped = self.pair('swapped', self.names,
+                            self.names[:500] + ['other'] + self.names[501:])
+        short = self.pair('short', self.names, self.names[:-1])
+        errors = dict(verify_pairs([good, swapped, short], self.cache, 3))
+        self.failIf(good in errors)
+        self.failUnless('Record 501' in errors[swapped], errors)
+        self.failUnless('more than the 999 records' in errors[short], errors)
+
+    def test_cache(self):
+        """
+        Pairs are only verified once.
+        """
+        pair = self.pair('swapped', self.names, list(reversed(self.names)))
+        errors = verify_pairs([pair], self.cache)
+        self.failUnless(len(errors) == 1)
+        # The cached result is used as long as the files are the same
+        self.failUnless(verify_pairs([pair], self.cache) == errors)
+        write_mate(pair[1], self.names, 2)
+        self.failIf(verify_pairs([pair], self.cache))
+
+    def test_verify_read_mates(self):
+        """
+        With verify_mates = fail, mates that do not match are an error.
+        """
+        first, second = self.pair('swapped', self.names,
+                                  list(reversed(self.names)))
+        accession = {'file_location': '%s\n%s' % (first, second),
+                     'pair_id': 'pair\npair',
+                     'mate_id': 'pair.1\npair.2',
+                     'label': 'Test\nTest',
+                     'paired': '1',
+                     'type': 'fastq'}
+        buildout = {'settings': {'verify_mates': 'fail',
+                                 'mate_cache': self.cache}}
+        self.failUnlessRaises(AttributeError, verify_read_mates, buildout,
+                              accession)
+        buildout['settings']['verify_mates'] = 'warn'
+        verify_read_mates(buildout, accession)
+        buildout['settings']['verify_mates'] = 'never'
+        self.failUnlessRaises(AttributeError, verify_read_mates, buildout,
+                              accession)
+
+
+def test_suite():
+    """
+    Run the test suite
+    """
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
@@ -0,0 +1,160 @@
+"""
+Test for plan.py
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from grape.recipe.pipeline.plan import Plan
+from grape.recipe.pipeline.plan import describe
+from grape.recipe.pipeline.plan import reconcile_symlink
+from grape.recipe.pipeline.prepare import main
+from grape.recipe.pipeline.prepare import INSTALLATION_STATE
+from grape.recipe.pipeline.tests.test_prepare import BuildoutTestCase
+from grape.recipe.pipeline.tests.test_prepare import OPTIONS
+
+
+class PlanTests(unittest.TestCase):
+    """
+    Test the Plan class in plan.py
+    """
+
+    def setUp(self):  # pylint: disable=C0103
+        self.folder = tempfile.mkdtemp('planTest')
+        self.source = os.path.join(self.folder, 'source')
+        open(self.source, 'w').close()
+        self.reads = os.path.join(self.folder, 'reads')
+
+    def tearDown(self):  # pylint: disable=C0103
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def get_plan(self, content='echo'):
+        """Return the plan of a folder with a link and a script"""
+        plan = Plan()
+        plan.folder(self.reads)
+        plan.only(self.reads)
+        plan.symlink(os.path.join(self.reads, 'a'), self.source)
+        plan.write(os.path.join(self.folder, 'start.sh'), content, 0755)
+        return plan
+
+    def test_apply(self):
+        """
+        Only the differences with the disk are applied.
+        """
+        changes = self.get_plan().apply()
+        self.failUnless(len(changes) == 3)
+        self.failUnless(os.readlink(os.path.join(self.reads, 'a')) ==
+                        self.source)
+        start = os.path.join(self.folder, 'start.sh')
+        self.failUnless(open(start).read() == 'echo')
+        self.failUnless(os.stat(start).st_mode & 0777 == 0755)
+        self.failUnless(self.get_plan().changes() == [])
+        changes = self.get_plan('echo 2').changes()
+        self.failUnless(describe(changes) ==
+                        ["write %s (6 bytes)" % start])
+        os.chmod(start, 0644)
+        self.failUnless(len(self.get_plan().changes()) == 1)
+
+    def test_only(self):
+        """
+        Entries that are not planned are removed from the folder.
+        """
+        self.get_plan().apply()
+        stale = os.path.join(self.reads, 'b')
+        os.symlink(self.source, stale)
+        changes = self.get_plan().changes()
+        self.failUnless(changes == [('remove', stale, None)])
+        self.get_plan().apply(changes)
+        self.failIf(os.path.lexists(stale))
+
+    def test_check(self):
+        """
+        Links to missing sources are an error.
+        """
+        plan = Plan()
+        plan.symlink(os.path.join(self.folder, 'link'),
+                     os.path.join(self.folder, 'missing'))
+        self.failUnlessRaises(AttributeError, plan.apply)
+
+
+class ReconcileSymlinkTests(unittest.TestCase):
+    """
+    Test the reconcile_symlink method in plan.py
+    """
+
+    def setUp(self):  # pylint: disable=C0103
+        self.folder = tempfile.mkdtemp('reconcileTest')
+        self.link = os.path.join(self.folder, 'results')
+        self.sources = [os.path.join(self.folder, 'a'),
+                        os.path.join(self.folder, 'b')]
+        for source in self.sources:
+            os.mkdir(source)
+
+    def tearDown(self):  # pylint: disable=C0103
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def test_reconcile(self):
+        """
+        A link is only replaced when it points somewhere else, and no
+        temporary links are left behind.
+        """
+        self.failUnless(reconcile_symlink(self.link, self.sources[0]))
+        inode = os.lstat(self.link).st_ino
+        self.failIf(reconcile_symlink(self.link, self.sources[0]))
+        self.failUnless(os.lstat(self.link).st_ino == inode)
+        self.failUnless(reconcile_symlink(self.link, self.sources[1]))
+        self.failUnless(os.readlink(self.link) == self.sources[1])
+        self.failUnless(sorted(os.listdir(self.folder)) ==
+                        ['a', 'b', 'results'])
+
+    def test_replace_folder(self):
+        """
+        A real folder is replaced by the link.
+        """
+        os.mkdir(self.link)
+        self.failUnless(reconcile_symlink(self.link, self.sources[0]))
+        self.failUnless(os.path.islink(self.link))
+
+
+class MainPlanTests(BuildoutTestCase):
+    """
+    Test applying the plans of parts in the main method
+    """
+
+    def test_unchanged(self):
+        """
+        Preparing a part again leaves its links and files alone.
+        """
+        buildout = self.prepare_buildout()
+        main(OPTIONS.copy(), buildout)
+        start = os.path.join(OPTIONS['location'], 'start.sh')
+        read_folder = os.path.join(OPTIONS['location'], 'readData')
+        before = (os.stat(start).st_ino, os.lstat(read_folder).st_ino,
+                  sorted(os.listdir(read_folder)))
+        INSTALLATION_STATE.__init__()
+        main(OPTIONS.copy(), buildout)
+        after = (os.stat(start).st_ino, os.lstat(read_folder).st_ino,
+                 sorted(os.listdir(read_folder)))
+        self.failUnless(before == after)
+        self.failUnless(len(before[2]) == 4)
+
+    def test_dry_run(self):
+        """
+        With the dry_run option, nothing is written.
+        """
+        buildout = self.prepare_buildout()
+        options = OPTIONS.copy()
+        options['dry_run'] = 'true'
+        main(options, buildout)
+        self.failIf(os.path.exists(os.path.join(OPTIONS['location'],
+                                                'start.sh')))
+        self.failIf(os.path.exists('var/pipeline/bin'))
+
+
+def test_suite():
+    """
+    Run the test suite
+    """
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
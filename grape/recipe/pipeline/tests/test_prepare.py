@@ -3,6 +3,8 @@ Test for prepare.py
 """
 
 import os
+import gzip
+import json
 import unittest
 import shutil
 import tempfile
@@ -13,6 +15,17 @@ from grape.recipe.pipeline.prepare import CUFFLINKS_BINARIES
 from grape.recipe.pipeline.prepare import check_read_labels
 from grape.recipe.pipeline.prepare import parse_integer
 from grape.recipe.pipeline.prepare import parse_flux_mem
+from grape.recipe.pipeline.prepare import INSTALLATION_STATE
+from grape.recipe.pipeline.prepare import is_up_to_date
+from grape.recipe.pipeline.prepare import patch_perl_script
+from grape.recipe.pipeline.prepare import patch_perl_scripts
+from grape.recipe.pipeline.prepare import check_read_samples
+from grape.recipe.pipeline.prepare import get_pipeline
+from grape.recipe.pipeline.prepare import compile_command
+from grape.recipe.pipeline.prepare import ProfileCache
+from grape.recipe.pipeline.prepare import resolve_dependencies
+from grape.recipe.pipeline.prepare import link_dependencies
+from grape.recipe.pipeline.tests.test_sample import write_bam
 
 
 SANDBOX = tempfile.mkdtemp('buildoutSetUp')
@@ -94,12 +107,14 @@ SCRIPT = ['#!/bin/bash\nbin/start_RNAseq_pipeline.3.0.pl',
           '-maxintronlength', '50000']
 
 
-class MainTests(unittest.TestCase):
+class BuildoutTestCase(unittest.TestCase):
     """
-    Test the main method in prepare.py
+    Create a fresh buildout with all the sources and dependencies needed for
+    preparing parts.
     """
 
     def setUp(self):  # pylint: disable=C0103
+        INSTALLATION_STATE.__init__()
         shutil.rmtree(PATH, ignore_errors=True)
         os.mkdir(PATH)
         os.mkdir(os.path.join(PATH, 'bin'))
@@ -137,9 +152,10 @@ class MainTests(unittest.TestCase):
         path.close()
         os.mkdir(os.path.join(PATH, 'var'))
 
-    def test_main(self):
+    def prepare_buildout(self):
         """
-        Test the main method
+        Create the dependencies used by the main method and return the
+        buildout.
         """
         os.chdir(PATH)
         if os.path.exists('src/fastqc'):
@@ -164,9 +180,110 @@ class MainTests(unittest.TestCase):
                                 'overlap': overlap_path,
                                 'gem_folder': PATH,
                                 'nextgem_folder': PATH}
+        return buildout
+
+
+class MainTests(BuildoutTestCase):
+    """
+    Test the main method in prepare.py
+    """
+
+    def test_main(self):
+        """
+        Test the main method
+        """
+        buildout = self.prepare_buildout()
         result = main(OPTIONS.copy(), buildout)
         self.failUnless(result is None)
 
+    def test_main_bin_sync_manifest(self):
+        """
+        Test the main method twice with the manifest based bin folder sync.
+        """
+        buildout = self.prepare_buildout()
+        buildout['settings']['bin_sync'] = 'manifest'
+        script = open('src/pipeline/bin/run.pl', 'w')
+        script.write('#!/usr/bin/perl\nprint 1;\n')
+        script.close()
+        for _ in range(0, 2):
+            INSTALLATION_STATE.__init__()
+            main(OPTIONS.copy(), buildout)
+        script = open('var/pipeline/bin/run.pl', 'r')
+        self.failUnless(script.readline() == '#!/soft/bin/perl\n')
+        script.close()
+        self.failUnless(os.path.exists('var/pipeline/bin.manifest'))
+        self.failUnless(os.path.islink('var/pipeline/bin/flux'))
+
+    def test_is_up_to_date(self):
+        """
+        Test that a part is up to date in the next buildout run, unless its
+        accession or the shared folders change.
+        """
+        buildout = self.prepare_buildout()
+        buildout['TestRun'] = BUILDOUT['TestRun'].copy()
+        self.failIf(is_up_to_date(OPTIONS.copy(), buildout))
+        main(OPTIONS.copy(), buildout)
+        buildout['TestRun'] = BUILDOUT['TestRun'].copy()
+        # A new buildout run starts with a fresh installation state
+        INSTALLATION_STATE.__init__()
+        self.failUnless(is_up_to_date(OPTIONS.copy(), buildout))
+        buildout['TestRun']['cell'] = 'K562'
+        self.failIf(is_up_to_date(OPTIONS.copy(), buildout))
+        buildout['TestRun'] = BUILDOUT['TestRun'].copy()
+        script = open('src/pipeline/bin/new.pl', 'w')
+        script.write('#!/usr/bin/perl\n')
+        script.close()
+        INSTALLATION_STATE.__init__()
+        self.failIf(is_up_to_date(OPTIONS.copy(), buildout))
+
+
+class DependencyManifestTests(BuildoutTestCase):
+    """
+    Test linking the dependencies with the dependency manifest
+    """
+
+    def test_manifest(self):
+        """
+        Only the links that are missing or whose binary changed are made
+        again.
+        """
+        buildout = self.prepare_buildout()
+        main(OPTIONS.copy(), buildout)
+        manifest = json.load(open('var/pipeline/dependencies.json'))
+        self.failUnless(manifest['links']['flux']['source'] ==
+                        os.path.join(PATH, 'src/flux/bin/flux'))
+        bin_folder = os.path.join(PATH, 'var/pipeline/bin')
+        unchanged = os.lstat(os.path.join(bin_folder, 'cufflinks')).st_ino
+        os.remove(os.path.join(bin_folder, 'flux'))
+        os.rename('src/overlap/overlap', 'src/overlap/overlap.old')
+        buildout['settings']['overlap'] = os.path.join(
+            PATH, 'src/overlap/overlap.old')
+        link_dependencies(buildout, bin_folder,
+                          resolve_dependencies(buildout))
+        self.failUnless(os.path.islink(os.path.join(bin_folder, 'flux')))
+        self.failUnless(os.readlink(os.path.join(bin_folder, 'overlap')) ==
+                        buildout['settings']['overlap'])
+        self.failUnless(os.lstat(os.path.join(bin_folder,
+                                              'cufflinks')).st_ino ==
+                        unchanged)
+
+    def test_missing(self):
+        """
+        All the missing binaries are reported at once.
+        """
+        buildout = self.prepare_buildout()
+        os.remove('src/flux/bin/flux')
+        os.remove('src/cufflinks/cuffdiff')
+        bin_folder = os.path.join(PATH, 'var/pipeline/bin')
+        try:
+            link_dependencies(buildout, bin_folder,
+                              resolve_dependencies(buildout))
+        except AttributeError, error:
+            self.failUnless('flux' in str(error))
+            self.failUnless('cuffdiff' in str(error))
+        else:
+            self.fail("The missing binaries are not reported")
+
 
 class PipelineScriptTests(unittest.TestCase):
     """
@@ -241,6 +358,213 @@ class PipelineScriptTests(unittest.TestCase):
         self.failUnless(" -cluster dummy " in command)
 
 
+class PipelineProfileTests(unittest.TestCase):
+    """
+    Test the caching of the pipeline profiles and command templates.
+    """
+
+    def test_get_pipeline(self):
+        """
+        The merged profile is cached by the name of the profile for every
+        buildout, and every part gets its own copy.
+        """
+        buildout = {'pipeline': {'THREADS': '2', 'MAPPER': 'GEM'},
+                    'fast': {'THREADS': '8'}}
+        options = {'pipeline': 'fast'}
+        pipeline = get_pipeline(options, buildout)
+        self.failUnless(pipeline == {'THREADS': '8', 'MAPPER': 'GEM'})
+        pipeline['THREADS'] = '1'
+        self.failUnless(get_pipeline(options, buildout)['THREADS'] == '8')
+        self.failUnless(get_pipeline({}, buildout)['THREADS'] == '2')
+        other = {'pipeline': buildout['pipeline'],
+                 'fast': {'THREADS': '16'}}
+        self.failUnless(get_pipeline(options, other)['THREADS'] == '16')
+        self.failUnless(get_pipeline(options, buildout)['THREADS'] == '8')
+        self.failUnlessRaises(AttributeError, get_pipeline,
+                              {'pipeline': 'missing'}, buildout)
+
+    def test_compile_command(self):
+        """
+        The command template is compiled once per profile and sizing of the
+        part, and only the options of the accession and the part are filled
+        in.
+        """
+        buildout = {'pipeline': BUILDOUT['pipeline'].copy()}
+        pipeline = BUILDOUT['pipeline'].copy()
+        pipeline['PROJECTID'] = '100%'
+        options = {'experiment_id': 'TestRun'}
+        template = compile_command(pipeline, buildout, options)
+        self.failUnless(compile_command(pipeline.copy(), buildout,
+                                        options) is template)
+        self.failUnless("%(species)s" in template)
+        pipeline['THREADS'] = '7'
+        template = compile_command(pipeline, buildout, options)
+        self.failUnless(" -threads 7 " in template)
+        command = get_pipeline_script_command(BUILDOUT['TestRun'], pipeline,
+                                              options, buildout)
+        self.failUnless(" -project 100% " in command)
+        self.failUnless(" -species 'Homo sapiens' " in command)
+
+    def test_bounded(self):
+        """
+        Only the most recently used values are kept.
+        """
+        cache = ProfileCache(2)
+        buildout = {}
+        for name in ['a', 'b', 'c']:
+            cache.set(buildout, name, name.upper())
+            cache.get(buildout, 'a')
+        self.failUnless(cache.get(buildout, 'a') == 'A')
+        self.failUnless(cache.get(buildout, 'b') is None)
+        self.failUnless(cache.get(buildout, 'c') == 'C')
+        self.failUnless(cache.get({}, 'c') is None)
+
+
+class PerlScriptTests(unittest.TestCase):
+    """
+    Test patching the shebangs of Perl scripts.
+    """
+
+    def setUp(self):  # pylint: disable=C0103
+        self.folder = tempfile.mkdtemp('perlScripts')
+        self.buildout = {'settings': {'perl': '/soft/bin/perl',
+                                      'patch_threads': '2'}}
+
+    def tearDown(self):  # pylint: disable=C0103
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def write_script(self, name, content):
+        """Write a script into the folder and return its path"""
+        path = os.path.join(self.folder, name)
+        script = open(path, 'w')
+        script.write(content)
+        script.close()
+        os.chmod(path, 0755)
+        return path
+
+    def test_patch_perl_scripts(self):
+        """
+        Scripts are patched unless they already have the right shebang.
+        """
+        patched = self.write_script('a.pl', '#!/usr/bin/perl\nprint 1;\n')
+        skipped = self.write_script('b.pl', '#!/soft/bin/perl\nprint 2;\n')
+        report = patch_perl_scripts(self.buildout, [patched, skipped])
+        actions = dict([(path, action) for path, action, _ in report])
+        self.failUnless(actions == {patched: 'patched', skipped: 'skipped'})
+        script = open(patched, 'r')
+        self.failUnless(script.read() == '#!/soft/bin/perl\nprint 1;\n')
+        script.close()
+        self.failUnless(os.stat(patched).st_mode & 0777 == 0755)
+
+    def test_patch_through_symlink(self):
+        """
+        A symbolic link stays a link, and the script it points to is patched.
+        """
+        script = self.write_script('fastqc', '#!/usr/bin/perl\n')
+        link = os.path.join(self.folder, 'link')
+        os.symlink(script, link)
+        patch_perl_script(self.buildout, link)
+        self.failUnless(os.path.islink(link))
+        script = open(script, 'r')
+        self.failUnless(script.read() == '#!/soft/bin/perl\n')
+        script.close()
+
+    def test_no_perl_shebang(self):
+        """
+        Scripts that do not start with a Perl shebang are an error.
+        """
+        bad = self.write_script('c.pl', '#!/bin/bash\n')
+        good = self.write_script('d.pl', '#!/usr/bin/perl\n')
+        self.failUnlessRaises(AttributeError, patch_perl_scripts,
+                              self.buildout, [bad, good])
+
+
+class ReadSampleTests(unittest.TestCase):
+    """
+    Test comparing samples of the read files with the accession.
+    """
+
+    def setUp(self):  # pylint: disable=C0103
+        self.folder = tempfile.mkdtemp('readSamples')
+        self.buildout = {'buildout': {'directory': self.folder},
+                         'settings': {'check_reads': 'fail'}}
+        self.locations = []
+        for mate, count in [('1', 3), ('2', 3)]:
+            location = os.path.join(self.folder, 'test.r%s.fastq.gz' % mate)
+            read_file = gzip.open(location, 'wb')
+            read_file.write('@read\n%s\n+\n%s\n' % ('A' * 76, 'I' * 76) *
+                            count)
+            read_file.close()
+            self.locations.append(location)
+        self.accession = {'file_location': '\n'.join(self.locations),
+                          'pair_id': 'test\ntest',
+                          'mate_id': 'test.1\ntest.2',
+                          'label': 'Test\nTest',
+                          'readType': '2x76',
+                          'paired': '1',
+                          'type': 'fastq'}
+
+    def tearDown(self):  # pylint: disable=C0103
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def test_matching(self):
+        """
+        The reads match the readType and the paired attribute.
+        """
+        samples = check_read_samples(self.buildout, self.accession)
+        self.failUnless(len(samples) == 2)
+
+    def test_wrong_read_length(self):
+        """
+        A read length different from the readType is an error.
+        """
+        self.accession['readType'] = '2x100'
+        self.failUnlessRaises(AttributeError, check_read_samples,
+                              self.buildout, self.accession)
+
+    def test_wrong_paired(self):
+        """
+        A readType with two mates needs paired reads.
+        """
+        self.accession['paired'] = '0'
+        self.failUnlessRaises(AttributeError, check_read_samples,
+                              self.buildout, self.accession)
+
+    def test_bam_paired(self):
+        """
+        The message says whether the reads of a bam file are paired.
+        """
+        location = os.path.join(self.folder, 'test.bam')
+        write_bam(location, [76] * 3, flag=1)
+        self.accession = {'file_location': location,
+                          'readType': '76',
+                          'paired': '0',
+                          'type': 'bam'}
+        try:
+            check_read_samples(self.buildout, self.accession)
+        except AttributeError as error:
+            self.failUnless("paired is 0, but the reads of %s are paired" %
+                            location in str(error), str(error))
+        else:
+            self.fail("The paired reads are not reported")
+        write_bam(location, [76] * 3)
+        self.accession['paired'] = '1'
+        try:
+            check_read_samples(self.buildout, self.accession)
+        except AttributeError as error:
+            self.failUnless("are single end" in str(error), str(error))
+        else:
+            self.fail("The single end reads are not reported")
+
+    def test_warn(self):
+        """
+        With check_reads = warn, problems are only printed.
+        """
+        self.buildout['settings']['check_reads'] = 'warn'
+        self.accession['readType'] = '2x100'
+        check_read_samples(self.buildout, self.accession)
+
+
 class ReadLabelsTests(unittest.TestCase):
     """
     Test the check_read_labels method.
@@ -0,0 +1,128 @@
+"""
+Test for sample.py
+"""
+
+import os
+import gzip
+import struct
+import shutil
+import tempfile
+import unittest
+
+from grape.recipe.pipeline.sample import sample_file
+from grape.recipe.pipeline.sample import sample_files
+from grape.recipe.pipeline.sample import get_read_length
+
+
+def write_fastq(path, lengths):
+    """Write a gzipped fastq file with reads of the given lengths"""
+    output = gzip.open(path, 'wb')
+    for number, length in enumerate(lengths):
+        output.write('@read%s\n%s\n+\n%s\n' % (number, 'A' * length,
+                                               'I' * length))
+    output.close()
+
+
+def write_bam(path, lengths, flag=0):
+    """Write a bam file with unmapped reads of the given lengths"""
+    output = gzip.open(path, 'wb')
+    output.write('BAM\x01' + struct.pack('<ii', 0, 0))
+    for number, length in enumerate(lengths):
+        name = 'read%s\x00' % number
+        block = struct.pack('<iiIIiiii', -1, -1, len(name), flag << 16,
+                            length, -1, -1, 0)
+        block += name + '\x00' * ((length + 1) / 2) + 'I' * length
+        output.write(struct.pack('<i', len(block)) + block)
+    output.close()
+
+
+class SampleTests(unittest.TestCase):
+    """
+    Test sampling read files
+    """
+
+    def setUp(self):  # pylint: disable=C0103
+        self.folder = tempfile.mkdtemp('sampleTest')
+
+    def tearDown(self):  # pylint: disable=C0103
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def path(self, name):
+        """Return the path of a file in the folder"""
+        return os.path.join(self.folder, name)
+
+    def test_whole_fastq(self):
+        """
+        A small file is read completely, and the count is exact
+        """
+        path = self.path('test.fastq.gz')
+        write_fastq(path, [76, 76, 70])
+        sample = sample_file(path, 10)
+        self.failUnless(sample['exact'])
+        self.failUnless(sample['estimated_reads'] == 3)
+        self.failUnless(sample['lengths'] == {'76': 2, '70': 1})
+        self.failUnless(get_read_length(sample) == 76)
+
+    def test_estimate(self):
+        """
+        The number of reads is estimated from the first records
+        """
+        path = self.path('test.fastq.gz')
+        write_fastq(path, [50] * 100000)
+        sample = sample_file(path, 20000)
+        self.failIf(sample['exact'])
+        self.failUnless(sample['records'] == 20000)
+        estimate = sample['estimated_reads']
+        self.failUnless(50000 < estimate < 200000, estimate)
+
+    def test_small_estimate(self):
+        """
+        Small samples are not skewed by the read ahead of the gzip file
+        """
+        path = self.path('test.fastq.gz')
+        write_fastq(path, [50] * 100000)
+        for records in [10, 100]:
+            estimate = sample_file(path, records)['estimated_reads']
+            self.failUnless(80000 < estimate < 120000, estimate)
+
+    def test_members(self):
+        """
+        Files made of several gzip members, like BGZF files, are read
+        through
+        """
+        path = self.path('test.fastq.gz')
+        write_fastq(path, [76, 76])
+        content = open(path, 'rb').read()
+        open(path, 'wb').write(content * 3)
+        sample = sample_file(path, 10)
+        self.failUnless(sample['exact'])
+        self.failUnless(sample['records'] == 6)
+
+    def test_bam(self):
+        """
+        The read lengths and the paired flag are read from bam records
+        """
+        path = self.path('test.bam')
+        write_bam(path, [36, 36], flag=1)
+        sample = sample_file(path, 10)
+        self.failUnless(sample['lengths'] == {'36': 2})
+        self.failUnless(sample['paired'])
+
+    def test_cache(self):
+        """
+        Samples are cached by file identity
+        """
+        path = self.path('test.fastq.gz')
+        write_fastq(path, [76])
+        cache_path = self.path('sample.db')
+        samples = sample_files([path], 10, cache_path)
+        self.failUnless(samples[path]['records'] == 1)
+        samples = sample_files([path], 10, cache_path)
+        self.failUnless(samples[path]['lengths'] == {'76': 1})
+
+
+def test_suite():
+    """
+    Run the test suite
+    """
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
@@ -0,0 +1,261 @@
+"""
+Test for shard.py
+"""
+
+import os
+import gzip
+import random
+import shutil
+import tempfile
+import unittest
+
+from grape.recipe.pipeline.shard import shard_reads
+from grape.recipe.pipeline.shard import shard_accession
+from grape.recipe.pipeline.shard import shard_folder
+from grape.recipe.pipeline.shard import evict_shards
+from grape.recipe.pipeline.shard import live_sources
+from grape.recipe.pipeline.staging import evict_staged
+from grape.recipe.pipeline.staging import read_entry
+from grape.recipe.pipeline.staging import staged_path
+from grape.recipe.pipeline.prepare import main
+from grape.recipe.pipeline.tests.test_prepare import BuildoutTestCase
+from grape.recipe.pipeline.tests.test_prepare import OPTIONS
+from grape.recipe.pipeline.tests.test_prepare import FILE_LOCATIONS
+
+
+def write_mate(path, mate, records):
+    """Write a gzipped fastq file of random reads, the same for both mates"""
+    generator = random.Random(records)
+    output = gzip.open(path, 'wb')
+    for index in range(records):
+        sequence = ''.join([generator.choice('ACGT') for _ in range(76)])
+        output.write("@read%s/%s\n%s\n+\n%s\n" % (index, mate, sequence,
+                                                  'I' * 76))
+    output.close()
+
+
+def read_names(path):
+    """Return the read names of a gzipped fastq file"""
+    lines = gzip.open(path).read().splitlines()
+    return lines[::4]
+
+
+class ShardTestCase(unittest.TestCase):
+    """
+    A pair of read files and a shard cache in a temporary folder
+    """
+
+    def setUp(self):  # pylint: disable=C0103
+        self.folder = tempfile.mkdtemp('shardTest')
+        self.cache = os.path.join(self.folder, 'cache')
+        self.mates = [os.path.join(self.folder, 'reads_%s.fastq.gz' % mate)
+                      for mate in [1, 2]]
+        for mate, path in enumerate(self.mates):
+            write_mate(path, mate + 1, 2000)
+        self.shard_size = os.path.getsize(self.mates[0]) // 4 + 1
+
+    def tearDown(self):  # pylint: disable=C0103
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+
+class ShardReadsTests(ShardTestCase):
+    """
+    Test the shard_reads method in shard.py
+    """
+
+    def test_shard(self):
+        """
+        The mates are split in lockstep into record aligned shards, which
+        together have all the reads.
+        """
+        shards = shard_reads(self.cache, self.mates, self.shard_size)
+        self.failUnless(len(shards) == 4)
+        self.failUnless([os.path.basename(path) for path in shards[0]] ==
+                        ['reads_1_shard001.fastq.gz',
+                         'reads_2_shard001.fastq.gz'])
+        for mate, path in enumerate(self.mates):
+            content = ''.join([gzip.open(paths[mate]).read()
+                               for paths in shards])
+            self.failUnless(content == gzip.open(path).read())
+        for first, second in shards:
+            first_names = read_names(first)
+            self.failUnless(first_names)
+            self.failUnless([name[:-2] for name in first_names] ==
+                            [name[:-2] for name in read_names(second)])
+
+    def test_reuse(self):
+        """
+        The shards are used again until the read files change.
+        """
+        shards = shard_reads(self.cache, self.mates, self.shard_size)
+        modified = os.path.getmtime(shards[0][0])
+        os.utime(shards[0][0], (0, 0))
+        self.failUnless(shard_reads(self.cache, self.mates,
+                                    self.shard_size) == shards)
+        self.failUnless(os.path.getmtime(shards[0][0]) == 0)
+        # The dry run finds the shards as well
+        self.failUnless(shard_reads(self.cache, self.mates, self.shard_size,
+                                    dry_run=True) == shards)
+        for mate, path in enumerate(self.mates):
+            write_mate(path, mate + 1, 1000)
+        self.failUnless(shard_reads(self.cache, self.mates,
+                                    self.shard_size, dry_run=True) is None)
+        shards = shard_reads(self.cache, self.mates, self.shard_size)
+        self.failUnless(len(shards) in [2, 3])
+        self.failUnless(os.path.getmtime(shards[0][0]) >= modified)
+        # The shards of the old read files are gone
+        folder = shard_folder(self.cache, self.mates, self.shard_size)
+        self.failUnless(len([name for name in os.listdir(folder)
+                             if name.endswith('.gz')]) == 2 * len(shards))
+
+    def test_different_counts(self):
+        """
+        Mates with different numbers of records can not be sharded.
+        """
+        write_mate(self.mates[1], 2, 1999)
+        self.failUnlessRaises(AttributeError, shard_reads, self.cache,
+                              self.mates, self.shard_size)
+
+
+class ShardAccessionTests(ShardTestCase):
+    """
+    Test the shard_accession method in shard.py
+    """
+
+    def test_labels(self):
+        """
+        Every shard is a pair of its own, with the label of the read files.
+        Small read files are left alone.
+        """
+        small = os.path.join(self.folder, 'small.fastq.gz')
+        write_mate(small, 1, 10)
+        small_mate = os.path.join(self.folder, 'small_2.fastq.gz')
+        write_mate(small_mate, 2, 10)
+        accession = {'file_location': '\n'.join(self.mates +
+                                                [small, small_mate]),
+                     'pair_id': 'A\nA\nB\nB',
+                     'mate_id': 'A.1\nA.2\nB.1\nB.2',
+                     'label': 'Test\nTest\nTest\nTest',
+                     'paired': '1',
+                     'type': 'fastq'}
+        buildout = {'settings': {'shard_size': str(self.shard_size),
+                                 'shard_cache': self.cache}}
+        sharded = shard_accession(buildout, accession,
+                                  os.path.join(self.folder, 'part'))
+        self.failUnless(sharded.get_lines('pair_id') ==
+                        ['A_shard1', 'A_shard1', 'A_shard2', 'A_shard2',
+                         'A_shard3', 'A_shard3', 'A_shard4', 'A_shard4',
+                         'B', 'B'])
+        self.failUnless(sharded.get_lines('mate_id')[:4] ==
+                        ['A_shard1.1', 'A_shard1.2',
+                         'A_shard2.1', 'A_shard2.2'])
+        self.failUnless(set(sharded.get_lines('label')) == set(['Test']))
+        self.failUnless(sharded.get_lines('file_location')[-2:] ==
+                        [small, small_mate])
+        self.failUnless(sharded['paired'] == '1')
+
+
+class EvictShardsTests(ShardTestCase):
+    """
+    Test the evict_shards and live_sources methods in shard.py
+    """
+
+    def test_evict(self):
+        """
+        The shards that no part links to are removed, and the read files of
+        the others are in use.
+        """
+        parts = [os.path.join(self.folder, name) for name in ['a', 'b']]
+        for part in parts:
+            os.makedirs(os.path.join(part, 'readData'))
+        shards = shard_reads(self.cache, self.mates, self.shard_size,
+                             parts[0])
+        self.failUnless(shard_reads(self.cache, self.mates, self.shard_size,
+                                    parts[1]) == shards)
+        folder = shard_folder(self.cache, self.mates, self.shard_size)
+        self.failUnless(read_entry(folder)['parts'] == parts)
+        other = [os.path.join(self.folder, 'other_%s.fastq.gz' % mate)
+                 for mate in [1, 2]]
+        for mate, path in enumerate(other):
+            write_mate(path, mate + 1, 2000)
+        shard_reads(self.cache, other, self.shard_size, parts[0])
+        self.failUnless(live_sources(self.cache) == set())
+        path = shards[1][0]
+        os.symlink(path, os.path.join(parts[1], 'readData',
+                                      os.path.basename(path)))
+        self.failUnless(live_sources(self.cache) == set(self.mates))
+        evictions = evict_shards(self.cache, 0)
+        self.failUnless([entry.path for entry in evictions] ==
+                        [shard_folder(self.cache, other, self.shard_size)])
+        self.failUnless(os.path.exists(path))
+        self.failUnless(read_entry(folder)['parts'] == parts[1:])
+
+
+class MainShardTests(BuildoutTestCase):
+    """
+    Test sharding the read files in the main method
+    """
+
+    def test_main(self):
+        """
+        The read folder links to the shards, and the read list has a line
+        for each of them.
+        """
+        buildout = self.prepare_buildout()
+        for location in FILE_LOCATIONS:
+            write_mate(location, location[-10], 2000)
+        buildout['settings']['shard_size'] = str(
+            os.path.getsize(FILE_LOCATIONS[0]) // 2 + 1)
+        main(OPTIONS.copy(), buildout)
+        read_folder = os.path.join(OPTIONS['location'], 'readData')
+        self.failUnless(len(os.listdir(read_folder)) == 8)
+        self.failUnless(os.path.exists(os.path.join(
+            read_folder, 'testA.r1_shard002.fastq.gz')))
+        read_list = open(os.path.join(OPTIONS['location'],
+                                      'read.list.txt')).read().splitlines()
+        self.failUnless(read_list[:2] ==
+                        ['testA.r2_shard001.fastq\ttestA_shard1\t'
+                         'testA_shard1.2\tTest',
+                         'testA.r1_shard001.fastq\ttestA_shard1\t'
+                         'testA_shard1.1\tTest'])
+        self.failUnless(len(read_list) == 8)
+        self.failUnless(os.path.isdir(os.path.join(os.getcwd(),
+                                                   'var/pipeline/shards')))
+
+    def test_staging(self):
+        """
+        Staged files are not removed from the staging cache while the part
+        links to their shards.
+        """
+        buildout = self.prepare_buildout()
+        # Only the reads of testA are large enough to be sharded
+        for location in FILE_LOCATIONS[:2]:
+            write_mate(location, location[-10], 2000)
+        staging = os.path.join(os.getcwd(), 'var/pipeline/staging')
+        buildout['settings'].update({
+            'staging_cache': staging,
+            'stage_reads': 'all',
+            'staging_budget': '1',
+            'shard_size': str(os.path.getsize(FILE_LOCATIONS[0]) // 2 + 1)})
+        main(OPTIONS.copy(), buildout)
+        staged = [staged_path(staging, location)
+                  for location in FILE_LOCATIONS]
+        read_folder = os.path.join(OPTIONS['location'], 'readData')
+        self.failUnless(os.readlink(os.path.join(
+            read_folder, 'testB.r1.fastq.gz')) == staged[3])
+        self.failIf(os.path.exists(os.path.join(read_folder,
+                                                'testA.r1.fastq.gz')))
+        for path in staged:
+            self.failUnless(os.path.exists(path))
+        # Once the part is gone, the staged files can be removed
+        shutil.rmtree(read_folder)
+        shards = os.path.join(os.getcwd(), 'var/pipeline/shards')
+        evictions = evict_staged(staging, 1, sharded=live_sources(shards))
+        self.failUnless(len(evictions) == 4)
+
+
+def test_suite():
+    """
+    Run the test suite
+    """
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
@@ -0,0 +1,137 @@
+"""
+Test for sizing.py
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from grape.recipe.pipeline.sizing import size_pipeline
+from grape.recipe.pipeline.sizing import read_sizing
+from grape.recipe.pipeline.sizing import BYTES_PER_READ
+from grape.recipe.pipeline.prepare import main
+from grape.recipe.pipeline.jobarray import get_resources
+from grape.recipe.pipeline.tests.test_prepare import BuildoutTestCase
+from grape.recipe.pipeline.tests.test_prepare import OPTIONS
+
+SETTINGS = {'fluxmem_floor': '4G',
+            'fluxmem_cap': '32G',
+            'threads_floor': '1',
+            'threads_cap': '8'}
+
+
+class SizePipelineTests(unittest.TestCase):
+    """
+    Test the size_pipeline method in sizing.py
+    """
+
+    def setUp(self):  # pylint: disable=C0103
+        self.folder = tempfile.mkdtemp('sizingTest')
+        self.buildout = {'settings': SETTINGS.copy()}
+
+    def tearDown(self):  # pylint: disable=C0103
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def make_file(self, name, size):
+        """Make a sparse file of the given size and return its path"""
+        path = os.path.join(self.folder, name)
+        sparse = open(path, 'wb')
+        sparse.truncate(size)
+        sparse.close()
+        return path
+
+    def test_sizes(self):
+        """
+        The memory grows with the reads and the annotation, and the threads
+        with the reads.
+        """
+        reads = self.make_file('reads.fastq.gz', 50 * 1000 * 1000 *
+                               BYTES_PER_READ)
+        annotation = self.make_file('annotation.gtf', 300 * 1024 * 1024)
+        pipeline = {'FLUXMEM': 'auto',
+                    'THREADS': 'auto',
+                    'ANNOTATION': annotation}
+        lines = size_pipeline(self.buildout, {'file_location': reads},
+                              pipeline)
+        # 2G base, 2G for 50 million reads, 3G for the annotation
+        self.failUnless(pipeline['FLUXMEM'] == '7G', lines)
+        self.failUnless(pipeline['THREADS'] == '5')
+        self.failUnless(lines[0].startswith("# Sized for 50000000 reads, "
+                                            "estimated from 2.8 GB"))
+        self.failUnless(lines[1].startswith("# FLUXMEM = 7G: "))
+        self.failUnless(lines[2].startswith("# THREADS = 5: "))
+
+    def test_limits(self):
+        """
+        The estimates are kept within the floors and caps.
+        """
+        reads = self.make_file('reads.fastq.gz', 1000)
+        pipeline = {'FLUXMEM': 'auto', 'THREADS': 'auto'}
+        lines = size_pipeline(self.buildout, {'file_location': reads},
+                              pipeline)
+        self.failUnless(pipeline['FLUXMEM'] == '4G')
+        self.failUnless(pipeline['THREADS'] == '1')
+        self.failUnless(lines[1].endswith("raised to the floor of 4"))
+        samples = {reads: {'estimated_reads': 10 ** 10}}
+        pipeline = {'FLUXMEM': 'auto', 'THREADS': '2'}
+        lines = size_pipeline(self.buildout, {'file_location': reads},
+                              pipeline, samples)
+        self.failUnless(pipeline['FLUXMEM'] == '32G')
+        self.failUnless(pipeline['THREADS'] == '2')
+        self.failUnless(len(lines) == 2)
+        self.failUnless("counted in the samples" in lines[0])
+        self.failUnless(lines[1].endswith("lowered to the cap of 32"))
+
+    def test_not_auto(self):
+        """
+        Profiles without auto values are left alone.
+        """
+        pipeline = {'FLUXMEM': '16G', 'THREADS': '2'}
+        self.failUnless(size_pipeline(self.buildout, {}, pipeline) == [])
+        self.failUnless(pipeline == {'FLUXMEM': '16G', 'THREADS': '2'})
+
+    def test_wrong_limits(self):
+        """
+        A cap below its floor is an error.
+        """
+        self.buildout['settings']['threads_cap'] = '0'
+        pipeline = {'THREADS': 'auto'}
+        self.failUnlessRaises(AttributeError, size_pipeline, self.buildout,
+                              {'file_location': ''}, pipeline)
+
+
+class MainSizingTests(BuildoutTestCase):
+    """
+    Test automatic sizing in the main method
+    """
+
+    def test_main(self):
+        """
+        The estimated values and their reasons are in start.sh, and are
+        used for the resources of the part.
+        """
+        buildout = self.prepare_buildout()
+        buildout['pipeline']['FLUXMEM'] = 'auto'
+        buildout['pipeline']['THREADS'] = 'auto'
+        buildout['settings'].update(SETTINGS)
+        main(OPTIONS.copy(), buildout)
+        start = open(os.path.join(OPTIONS['location'], 'start.sh')).read()
+        lines = start.splitlines()
+        self.failUnless(lines[0] == '#!/bin/bash')
+        self.failUnless(lines[1].startswith('# Sized for 0 reads'))
+        self.failUnless(lines[2].startswith('# FLUXMEM = 4G: '))
+        self.failUnless(lines[3].startswith('# THREADS = 1: '))
+        self.failUnless(' -fluxmem 4G ' in lines[4])
+        self.failUnless(' -threads 1 ' in lines[4])
+        self.failUnless(read_sizing(OPTIONS['location']) ==
+                        {'FLUXMEM': 4, 'THREADS': 1})
+        self.failUnless(get_resources(OPTIONS.copy(), buildout) ==
+                        (1, 4, 'mem_6'))
+
+
+def test_suite():
+    """
+    Run the test suite
+    """
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
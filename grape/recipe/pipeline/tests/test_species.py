@@ -0,0 +1,130 @@
+"""
+Test for species.py
+"""
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from grape.recipe.pipeline.species import file_fingerprint
+from grape.recipe.pipeline.species import register_species
+from grape.recipe.pipeline.species import match_species
+from grape.recipe.pipeline.species import load_registry
+from grape.recipe.pipeline.species import HEAD_SIZE
+from grape.recipe.pipeline.tests.helpers import make_quick_buildout
+from grape.recipe.pipeline.tests.helpers import quick_part
+from grape.recipe.pipeline.tests.helpers import QUICK_GENOME
+from grape.recipe.pipeline.tests.helpers import QUICK_ANNOTATION
+
+GENOME = ">chr1 assembled\nNNNNNNNN\nACGTACGTAC\nGTTTGA\n>chr2\nCCCC\n"
+
+ANNOTATION = ('##description: test\n'
+              'chr1\tTEST\tgene\t11\t20\t.\t+\t.\tgene_id "g1";\n'
+              'chr1\tTEST\texon\t11\t15\t.\t+\t.\tgene_id "g1";\n')
+
+
+class SpeciesTests(unittest.TestCase):
+    """
+    Test the species registry in species.py
+    """
+
+    def setUp(self):  # pylint: disable=C0103
+        self.folder = tempfile.mkdtemp('speciesTest')
+        self.registry = os.path.join(self.folder, 'species.json')
+        self.cache = os.path.join(self.folder, 'species_cache.db')
+
+    def tearDown(self):  # pylint: disable=C0103
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def write(self, name, content):
+        """Write a file in the folder and return its path"""
+        path = os.path.join(self.folder, name)
+        open(path, 'w').write(content)
+        return path
+
+    def test_fingerprint(self):
+        """
+        Renamed and rewrapped copies of a genome have the same fingerprint.
+        """
+        genome = self.write('genome.fa', GENOME)
+        copy = self.write('copy.fa', GENOME.replace('ACGTACGTAC\nGTTTGA',
+                                                    'ACGTACGT\nACGTTTGA'))
+        other = self.write('other.fa', GENOME.replace('chr2', 'chrX'))
+        fingerprint = file_fingerprint(genome, 'genomes', self.cache)
+        self.failUnless(file_fingerprint(copy, 'genomes') == fingerprint)
+        self.failIf(file_fingerprint(other, 'genomes') == fingerprint)
+        annotation = self.write('annotation.gtf', ANNOTATION)
+        renamed = self.write('renamed.gtf', ANNOTATION.replace('test\n',
+                                                               'copy\n'))
+        self.failUnless(file_fingerprint(annotation, 'annotations') ==
+                        file_fingerprint(renamed, 'annotations', self.cache))
+
+    def test_line_width(self):
+        """
+        The fingerprint of a genome larger than the head of the file does
+        not depend on the width of its lines.
+        """
+        generator = random.Random(0)
+        sequence = ''.join([generator.choice('ACGT')
+                            for _ in range(HEAD_SIZE * 3 // 2)])
+        fingerprints = []
+        for width in [60, 80, len(sequence)]:
+            lines = [sequence[start:start + width]
+                     for start in range(0, len(sequence), width)]
+            genome = self.write('genome%s.fa' % width,
+                                '>chr1\n%s\n>chr2\nACGT\n' %
+                                '\n'.join(lines))
+            self.failUnless(os.path.getsize(genome) > HEAD_SIZE)
+            fingerprints.append(file_fingerprint(genome, 'genomes'))
+        self.failUnless(len(set(fingerprints)) == 1)
+
+    def test_match(self):
+        """
+        Both the genome and the annotation need to be registered.
+        """
+        genome = self.write('genome.fa', GENOME)
+        annotation = self.write('annotation.gtf', ANNOTATION)
+        other = self.write('other.gtf', ANNOTATION.replace('g1', 'g2')
+                           .replace('\t15\t', '\t16\t'))
+        register_species(self.registry, 'Mus musculus', genome, annotation)
+        registry = load_registry(self.registry)
+        self.failUnless(match_species(registry, genome, annotation,
+                                      self.cache) == 'Mus musculus')
+        self.failUnless(match_species(registry, genome, other) is None)
+        register_species(self.registry, 'Mus musculus', genome, other)
+        registry = load_registry(self.registry)
+        self.failUnless(match_species(registry, genome, other) ==
+                        'Mus musculus')
+        self.failUnless(len(registry['species']['Mus musculus']
+                            ['genomes']) == 1)
+
+    def test_quick(self):
+        """
+        Quick mode recognizes registered species by content, and falls back
+        to the known file names.
+        """
+        buildout = make_quick_buildout(os.path.join(self.folder, 'quick'),
+                                       2)
+        directory = buildout['buildout']['directory']
+        start = os.path.join(directory, 'parts/Run/start.sh')
+        quick_part(buildout)
+        self.failUnless("-species 'Homo sapiens'" in open(start).read())
+        genome = os.path.join(directory, 'genome.fa')
+        annotation = os.path.join(directory, 'annotation.gtf')
+        os.rename(os.path.join(directory, QUICK_GENOME), genome)
+        os.rename(os.path.join(directory, QUICK_ANNOTATION), annotation)
+        open(genome, 'w').write(GENOME)
+        open(annotation, 'w').write(ANNOTATION)
+        buildout['settings']['species_registry'] = self.registry
+        register_species(self.registry, 'Mus musculus', genome, annotation)
+        quick_part(buildout)
+        self.failUnless("-species 'Mus musculus'" in open(start).read())
+
+
+def test_suite():
+    """
+    Run the test suite
+    """
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
@@ -0,0 +1,325 @@
+"""
+Test for staging.py
+"""
+
+import os
+import shutil
+import hashlib
+import tempfile
+import unittest
+import threading
+import SocketServer
+import BaseHTTPServer
+
+from grape.recipe.pipeline.cache import identity_key
+from grape.recipe.pipeline.staging import stage_file
+from grape.recipe.pipeline.staging import stage_accession
+from grape.recipe.pipeline.staging import evict_staged
+from grape.recipe.pipeline.staging import read_entry
+from grape.recipe.pipeline.staging import write_entry
+from grape.recipe.pipeline.staging import staged_path
+from grape.recipe.pipeline.prepare import main
+from grape.recipe.pipeline.tests.test_prepare import BuildoutTestCase
+from grape.recipe.pipeline.tests.test_prepare import OPTIONS
+
+
+class ReadHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serve the files of the folder of the server, with range requests.
+    """
+
+    def do_GET(self):  # pylint: disable=C0103
+        """Send the file, or the requested range of it"""
+        server = self.server
+        path = os.path.join(server.folder, self.path.lstrip('/'))
+        server.requests.append((self.path, self.headers.get('Range')))
+        if not os.path.exists(path):
+            self.send_error(404)
+            return
+        content = open(path, 'rb').read()
+        start = 0
+        if self.headers.get('Range'):
+            start = int(self.headers['Range'].split('=')[1].rstrip('-'))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %s-%s/%s' %
+                             (start, len(content) - 1, len(content)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(content) - start))
+        self.end_headers()
+        if self.path in server.truncate:
+            # The connection breaks in the middle of the file
+            server.truncate.remove(self.path)
+            self.wfile.write(content[start:len(content) // 2])
+            return
+        self.wfile.write(content[start:])
+
+    def log_message(self, *args):
+        """Keep the test output clean"""
+        pass
+
+
+class ReadServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    A local http server standing in for a remote read file server.
+    """
+    daemon_threads = True
+
+    def __init__(self, folder):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           ReadHandler)
+        self.folder = folder
+        self.requests = []
+        self.truncate = set()
+
+
+class StagingTestCase(unittest.TestCase):
+    """
+    A staging cache and a local http server in a temporary folder
+    """
+
+    def setUp(self):  # pylint: disable=C0103
+        self.folder = tempfile.mkdtemp('stagingTest')
+        self.cache = os.path.join(self.folder, 'cache')
+        self.served = os.path.join(self.folder, 'served')
+        os.mkdir(self.served)
+        self.server = ReadServer(self.served)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.buildout = {'settings': {'staging_cache': self.cache}}
+
+    def tearDown(self):  # pylint: disable=C0103
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def serve(self, name, content):
+        """Serve a file and return its url"""
+        served = open(os.path.join(self.served, name), 'wb')
+        served.write(content)
+        served.close()
+        return "http://127.0.0.1:%s/%s" % (self.server.server_port, name)
+
+
+class StageFileTests(StagingTestCase):
+    """
+    Test the stage_file method in staging.py
+    """
+
+    def test_download(self):
+        """
+        A file is downloaded once, and shared by the parts.
+        """
+        url = self.serve('reads.fastq', 'ACGT' * 100)
+        path = stage_file(self.cache, url, '/parts/A')
+        self.failUnless(os.path.basename(path) == 'reads.fastq')
+        self.failUnless(open(path).read() == 'ACGT' * 100)
+        self.failUnless(stage_file(self.cache, url, '/parts/B') == path)
+        self.failUnless(len(self.server.requests) == 1)
+        entry = read_entry(os.path.dirname(path))
+        self.failUnless(entry['parts'] == ['/parts/A', '/parts/B'])
+        self.failUnless(entry['md5sum'] ==
+                        hashlib.md5('ACGT' * 100).hexdigest())
+
+    def test_resume(self):
+        """
+        An interrupted download is resumed where it stopped.
+        """
+        url = self.serve('reads.fastq', 'ACGT' * 100)
+        self.server.truncate.add('/reads.fastq')
+        self.failUnlessRaises(AttributeError, stage_file, self.cache, url,
+                              '/parts/A')
+        path = staged_path(self.cache, url)
+        self.failUnless(os.path.getsize(path + '.part') == 200)
+        self.failUnless(stage_file(self.cache, url, '/parts/A') == path)
+        self.failUnless(open(path).read() == 'ACGT' * 100)
+        self.failUnless(self.server.requests[-1] ==
+                        ('/reads.fastq', 'bytes=200-'))
+        self.failIf(os.path.exists(path + '.part'))
+
+    def test_md5sum(self):
+        """
+        A file that does not match its md5sum is an error, and is not kept.
+        """
+        url = self.serve('reads.fastq', 'ACGT' * 100)
+        self.failUnlessRaises(AttributeError, stage_file, self.cache, url,
+                              '/parts/A', hashlib.md5('ACGT').hexdigest())
+        path = staged_path(self.cache, url)
+        self.failIf(os.path.exists(path))
+        self.failIf(os.path.exists(path + '.part'))
+        md5sum = hashlib.md5('ACGT' * 100).hexdigest()
+        self.failUnless(stage_file(self.cache, url, '/parts/A', md5sum) ==
+                        path)
+
+    def test_local(self):
+        """
+        Local files are copied, and copied again when they change.
+        """
+        source = os.path.join(self.served, 'reads.fastq')
+        open(source, 'w').write('ACGT')
+        path = stage_file(self.cache, source, '/parts/A')
+        self.failUnless(open(path).read() == 'ACGT')
+        open(source, 'w').write('ACGTACGT')
+        stage_file(self.cache, source, '/parts/A')
+        self.failUnless(open(path).read() == 'ACGTACGT')
+
+    def test_local_changed(self):
+        """
+        A partial copy of a local file is discarded when the file changed.
+        """
+        source = os.path.join(self.served, 'reads.fastq')
+        open(source, 'w').write('ACGT')
+        path = staged_path(self.cache, source)
+        folder = os.path.dirname(path)
+        os.makedirs(folder)
+        open(path + '.part', 'w').write('AC')
+        write_entry(folder, {'location': source,
+                             'status': 'partial',
+                             'identity': 'changed',
+                             'parts': []})
+        stage_file(self.cache, source, '/parts/A')
+        self.failUnless(open(path).read() == 'ACGT')
+
+    def test_local_resume(self):
+        """
+        A partial copy of a local file that did not change is resumed.
+        """
+        source = os.path.join(self.served, 'reads.fastq')
+        open(source, 'w').write('ACGT')
+        path = staged_path(self.cache, source)
+        folder = os.path.dirname(path)
+        os.makedirs(folder)
+        open(path + '.part', 'w').write('XX')
+        write_entry(folder, {'location': source,
+                             'status': 'partial',
+                             'identity': identity_key(source),
+                             'parts': []})
+        stage_file(self.cache, source, '/parts/A')
+        self.failUnless(open(path).read() == 'XXGT')
+
+
+class StageAccessionTests(StagingTestCase):
+    """
+    Test the stage_accession method in staging.py
+    """
+
+    def test_stage(self):
+        """
+        The remote files are staged in parallel, and the accession gets
+        their staged locations.
+        """
+        local = os.path.join(self.served, 'local.fastq')
+        open(local, 'w').write('ACGT')
+        urls = [self.serve('reads%s.fastq' % index, 'ACGT' * index)
+                for index in range(1, 5)]
+        accession = {'file_location': '\n'.join(urls + [local]),
+                     'label': 'Test'}
+        staged = stage_accession(self.buildout, accession, '/parts/A')
+        locations = staged.get_lines('file_location')
+        self.failUnless(locations[-1] == local)
+        for url, location in zip(urls, locations):
+            self.failUnless(location == staged_path(self.cache, url))
+            self.failUnless(os.path.exists(location))
+        self.failUnless(staged['label'] == 'Test')
+        # All files are staged with stage_reads = all
+        self.buildout['settings']['stage_reads'] = 'all'
+        staged = stage_accession(self.buildout, accession, '/parts/A')
+        self.failUnless(staged.get_lines('file_location')[-1] ==
+                        staged_path(self.cache, local))
+
+    def test_dry_run(self):
+        """
+        Nothing is transferred on a dry run.
+        """
+        url = self.serve('reads.fastq', 'ACGT')
+        staged = stage_accession(self.buildout, {'file_location': url},
+                                 '/parts/A', dry_run=True)
+        self.failUnless(staged.get_lines('file_location') ==
+                        [staged_path(self.cache, url)])
+        self.failIf(self.server.requests)
+
+
+class EvictStagedTests(StagingTestCase):
+    """
+    Test the evict_staged method in staging.py
+    """
+
+    def stage(self, name, last_used, size):
+        """Stage a file for a part, used at the given time"""
+        url = self.serve(name, 'x' * size)
+        part = os.path.join(self.folder, name + '.part')
+        os.mkdir(part)
+        os.mkdir(os.path.join(part, 'readData'))
+        path = stage_file(self.cache, url, part)
+        entry = read_entry(os.path.dirname(path))
+        entry['last_used'] = last_used
+        write_entry(os.path.dirname(path), entry)
+        return path, part
+
+    def test_evict(self):
+        """
+        The least recently used files without links are removed.
+        """
+        old, _ = self.stage('old.fastq', 1, 1000)
+        linked, part = self.stage('linked.fastq', 2, 1000)
+        os.symlink(linked, os.path.join(part, 'readData/linked.fastq'))
+        recent, _ = self.stage('recent.fastq', 3, 1000)
+        evictions = evict_staged(self.cache, 3000, dry_run=True)
+        self.failUnless([entry.path for entry in evictions] ==
+                        [os.path.dirname(old)])
+        self.failUnless(os.path.exists(old))
+        evictions = evict_staged(self.cache, 1500)
+        self.failUnless([entry.path for entry in evictions] ==
+                        [os.path.dirname(old), os.path.dirname(recent)])
+        self.failIf(os.path.exists(old))
+        self.failIf(os.path.exists(recent))
+        self.failUnless(os.path.exists(linked))
+
+
+class MainStagingTests(BuildoutTestCase):
+    """
+    Test staging remote read files in the main method
+    """
+
+    def test_main(self):
+        """
+        The readData folder of the part links to the staged files.
+        """
+        folder = tempfile.mkdtemp('stagingTest')
+        server = ReadServer(folder)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            buildout = self.prepare_buildout()
+            accession = buildout['TestRun'].copy()
+            urls = []
+            for location in accession['file_location'].split('\n'):
+                name = os.path.basename(location)
+                open(os.path.join(folder, name), 'w').write(name)
+                urls.append("http://127.0.0.1:%s/%s" % (server.server_port,
+                                                        name))
+            accession['file_location'] = '\n'.join(urls)
+            buildout['TestRun'] = accession
+            cache = os.path.join(folder, 'cache')
+            buildout['settings']['staging_cache'] = cache
+            main(OPTIONS.copy(), buildout)
+            read_folder = os.path.join(OPTIONS['location'], 'readData')
+            self.failUnless(sorted(os.listdir(read_folder)) ==
+                            sorted([os.path.basename(url) for url in urls]))
+            for url in urls:
+                link = os.path.join(read_folder, os.path.basename(url))
+                self.failUnless(os.readlink(link) ==
+                                staged_path(cache, url))
+        finally:
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(folder, ignore_errors=True)
+
+
+def test_suite():
+    """
+    Run the test suite
+    """
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
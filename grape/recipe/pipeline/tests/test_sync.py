@@ -0,0 +1,212 @@
+"""
+Test for sync.py
+"""
+
+import os
+import unittest
+import shutil
+import tempfile
+
+from grape.recipe.pipeline.sync import sync_folder
+from grape.recipe.pipeline.sync import manifest_path
+from grape.recipe.pipeline.sync import copy_tree
+from grape.recipe.pipeline.sync import reflink_file
+
+
+def write_file(path, content):
+    """Write the content to the file at the given path"""
+    output = open(path, 'w')
+    output.write(content)
+    output.close()
+
+
+def read_file(path):
+    """Return the content of the file at the given path"""
+    source = open(path, 'r')
+    content = source.read()
+    source.close()
+    return content
+
+
+class SyncFolderTests(unittest.TestCase):
+    """
+    Test the sync_folder method in sync.py
+    """
+
+    def setUp(self):  # pylint: disable=C0103
+        self.sandbox = tempfile.mkdtemp('syncTest')
+        self.source = os.path.join(self.sandbox, 'src')
+        self.target = os.path.join(self.sandbox, 'bin')
+        os.makedirs(os.path.join(self.source, 'sub'))
+        write_file(os.path.join(self.source, 'a.pl'), '#!perl\nA\n')
+        write_file(os.path.join(self.source, 'sub/b.txt'), 'B\n')
+        self.patched = []
+
+    def tearDown(self):  # pylint: disable=C0103
+        shutil.rmtree(self.sandbox, ignore_errors=True)
+
+    def patch(self, copied):
+        """Remember the patched files and mark their content"""
+        for relative_path, target_path in copied:
+            self.patched.append(relative_path)
+            write_file(target_path, read_file(target_path) + 'patched\n')
+
+    def test_first_sync(self):
+        """
+        The first sync copies and patches everything and writes a manifest
+        """
+        report = sync_folder(self.source, self.target, 'perl', self.patch)
+        self.failUnless(sorted(report['copied']) == ['a.pl', 'sub/b.txt'])
+        self.failUnless(os.path.exists(manifest_path(self.target)))
+        content = read_file(os.path.join(self.target, 'a.pl'))
+        self.failUnless(content == '#!perl\nA\npatched\n')
+
+    def test_unchanged(self):
+        """
+        Nothing is copied or patched when nothing has changed
+        """
+        sync_folder(self.source, self.target, 'perl', self.patch)
+        self.patched = []
+        report = sync_folder(self.source, self.target, 'perl', self.patch)
+        self.failUnless(report['copied'] == [])
+        self.failUnless(report['deleted'] == [])
+        self.failUnless(self.patched == [])
+        # The patched copy is kept
+        content = read_file(os.path.join(self.target, 'a.pl'))
+        self.failUnless(content == '#!perl\nA\npatched\n')
+
+    def test_changed_and_deleted(self):
+        """
+        Changed files are copied again and deleted files are removed
+        """
+        sync_folder(self.source, self.target, 'perl', self.patch)
+        write_file(os.path.join(self.source, 'a.pl'), '#!perl\nAA\n')
+        os.utime(os.path.join(self.source, 'a.pl'), (0, 0))
+        os.remove(os.path.join(self.source, 'sub/b.txt'))
+        report = sync_folder(self.source, self.target, 'perl', self.patch)
+        self.failUnless(report['copied'] == ['a.pl'])
+        self.failUnless(report['deleted'] == ['sub/b.txt'])
+        self.failIf(os.path.exists(os.path.join(self.target, 'sub')))
+
+    def test_stamp_changed(self):
+        """
+        A changed stamp installs all files again
+        """
+        sync_folder(self.source, self.target, 'perl', self.patch)
+        report = sync_folder(self.source, self.target, 'other', self.patch)
+        self.failUnless(sorted(report['copied']) == ['a.pl', 'sub/b.txt'])
+
+    def test_stamp_changed_and_deleted(self):
+        """
+        Files deleted in the same run as a stamp change are removed too
+        """
+        sync_folder(self.source, self.target, 'perl', self.patch)
+        os.remove(os.path.join(self.source, 'sub/b.txt'))
+        report = sync_folder(self.source, self.target, 'other', self.patch)
+        self.failUnless(report['copied'] == ['a.pl'])
+        self.failUnless(report['deleted'] == ['sub/b.txt'])
+        self.failIf(os.path.exists(os.path.join(self.target, 'sub')))
+
+    def test_other_files_kept(self):
+        """
+        Files that were not installed from the source are left alone
+        """
+        sync_folder(self.source, self.target, 'perl')
+        write_file(os.path.join(self.target, 'flux'), '')
+        sync_folder(self.source, self.target, 'perl')
+        self.failUnless(os.path.exists(os.path.join(self.target, 'flux')))
+
+    def test_sync_hardlink(self):
+        """
+        Files are hard linked, except the ones that need their own copy
+        """
+        def own_copy(relative_path):
+            """Perl scripts get their own copy"""
+            return relative_path.endswith('.pl')
+
+        def patch(copied):
+            """Only patch the files that have their own copy"""
+            self.patch([(relative_path, target_path)
+                        for relative_path, target_path in copied
+                        if own_copy(relative_path)])
+
+        sync_folder(self.source, self.target, 'perl', patch,
+                    'hardlink', own_copy)
+        linked = os.path.join(self.target, 'sub/b.txt')
+        self.failUnless(os.stat(linked).st_nlink == 2)
+        # The patched copy did not modify the source
+        content = read_file(os.path.join(self.source, 'a.pl'))
+        self.failUnless(content == '#!perl\nA\n')
+        report = sync_folder(self.source, self.target, 'perl', patch,
+                             'hardlink', own_copy)
+        self.failUnless(report['copied'] == [])
+
+
+class CopyTreeTests(unittest.TestCase):
+    """
+    Test the copy_tree method in sync.py
+    """
+
+    def setUp(self):  # pylint: disable=C0103
+        self.sandbox = tempfile.mkdtemp('copyTreeTest')
+        self.source = os.path.join(self.sandbox, 'src')
+        os.makedirs(os.path.join(self.source, 'sub'))
+        os.makedirs(os.path.join(self.source, 'empty'))
+        write_file(os.path.join(self.source, 'a.pl'), 'A\n')
+        write_file(os.path.join(self.source, 'sub/b.txt'), 'B\n')
+
+    def tearDown(self):  # pylint: disable=C0103
+        shutil.rmtree(self.sandbox, ignore_errors=True)
+
+    def test_hardlink(self):
+        """
+        Hard links share the inode of the source, own copies do not
+        """
+        target = os.path.join(self.sandbox, 'lib')
+        copy_tree(self.source, target, 'hardlink',
+                  lambda relative_path: relative_path == 'a.pl')
+        source_stat = os.stat(os.path.join(self.source, 'sub/b.txt'))
+        target_stat = os.stat(os.path.join(target, 'sub/b.txt'))
+        self.failUnless(source_stat.st_ino == target_stat.st_ino)
+        source_stat = os.stat(os.path.join(self.source, 'a.pl'))
+        target_stat = os.stat(os.path.join(target, 'a.pl'))
+        self.failIf(source_stat.st_ino == target_stat.st_ino)
+        self.failUnless(os.path.isdir(os.path.join(target, 'empty')))
+
+    def test_reflink(self):
+        """
+        Reflinks fall back to a copy where the file system has no support
+        """
+        target = os.path.join(self.sandbox, 'lib')
+        copy_tree(self.source, target, 'reflink')
+        content = read_file(os.path.join(target, 'sub/b.txt'))
+        self.failUnless(content == 'B\n')
+
+    def test_reflink_error(self):
+        """
+        A target that can not be created is reported as it is
+        """
+        target = os.path.join(self.sandbox, 'missing/b.txt')
+        source = os.path.join(self.source, 'sub/b.txt')
+        try:
+            reflink_file(source, target)
+        except OSError as error:
+            self.failUnless(str(error).startswith('Can not reflink'))
+            self.failUnless('No such file or directory' in str(error))
+        else:
+            self.fail("The reflink did not fail")
+
+    def test_unknown_mode(self):
+        """
+        An unknown copy mode is an error
+        """
+        target = os.path.join(self.sandbox, 'lib')
+        self.failUnlessRaises(AttributeError, copy_tree, self.source,
+                              target, 'symlink')
+
+
+def test_suite():
+    """
+    Run the test suite
+    """
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
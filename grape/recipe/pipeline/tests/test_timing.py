@@ -0,0 +1,124 @@
+"""
+Test for timing.py
+"""
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import threading
+
+from grape.recipe.pipeline import timing
+from grape.recipe.pipeline.prepare import main
+from grape.recipe.pipeline.tests.test_prepare import BuildoutTestCase
+from grape.recipe.pipeline.tests.test_prepare import OPTIONS
+
+
+class TimingTests(unittest.TestCase):
+    """
+    Test the Timing class in timing.py
+    """
+
+    def setUp(self):  # pylint: disable=C0103
+        self.folder = tempfile.mkdtemp('timingTest')
+        self.source = os.path.join(self.folder, 'source')
+        source = open(self.source, 'w')
+        source.write('x' * 1000)
+        source.close()
+
+    def tearDown(self):  # pylint: disable=C0103
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def copy(self):
+        """A step copying a file, with a nested step"""
+        shutil.copy2(self.source, os.path.join(self.folder, 'target'))
+        timing.step('listing', os.listdir, self.folder)
+
+    def test_steps(self):
+        """
+        The steps record the operations and the bytes copied, and the file
+        system functions are restored afterwards.
+        """
+        stat = os.stat
+        timer = timing.start({'timing': 'true'})
+        try:
+            timing.step('copy', self.copy)
+        finally:
+            timing.stop(timer)
+        self.failUnless(os.stat is stat)
+        self.failUnless(shutil.copyfileobj is not timer.copyfileobj)
+        report = timer.report()
+        names = [record['name'] for record in report['steps']]
+        self.failUnless(names == ['copy/listing', 'copy'])
+        self.failUnless(report['steps'][0]['operations'] == 1)
+        self.failUnless(report['steps'][1]['operations'] > 1)
+        self.failUnless(report['steps'][1]['bytes_copied'] == 1000)
+        self.failUnless(report['bytes_copied'] == 1000)
+
+    def test_other_threads(self):
+        """
+        Only the operations of the thread being timed are counted.
+        """
+        timer = timing.start({'timing': 'true'})
+        try:
+            thread = threading.Thread(target=self.copy)
+            thread.start()
+            thread.join()
+        finally:
+            timing.stop(timer)
+        self.failUnless(os.path.exists(os.path.join(self.folder, 'target')))
+        report = timer.report()
+        self.failUnless(report['operations'] == 0)
+        self.failUnless(report['bytes_copied'] == 0)
+
+    def test_disabled(self):
+        """
+        Without the timing option, the steps are just called.
+        """
+        timer = timing.start({})
+        self.failUnless(timer is None)
+        self.failUnless(timing.step('listing', os.listdir, self.folder) ==
+                        ['source'])
+        timing.stop(timer)
+
+    def test_environment(self):
+        """
+        The timing can be switched on in the environment.
+        """
+        os.environ['GRAPE_TIMING'] = '1'
+        try:
+            self.failUnless(timing.is_enabled({}))
+        finally:
+            del os.environ['GRAPE_TIMING']
+        self.failIf(timing.is_enabled({}))
+
+
+class MainTimingTests(BuildoutTestCase):
+    """
+    Test the timing reports written by the main method
+    """
+
+    def test_main(self):
+        """
+        The report of the part and the summary of the run are written.
+        """
+        buildout = self.prepare_buildout()
+        options = OPTIONS.copy()
+        options['timing'] = 'true'
+        main(options, buildout)
+        report = json.load(open(os.path.join(options['location'],
+                                             'timing.json')))
+        names = [record['name'] for record in report['steps']]
+        self.failUnless('shared/dependencies/links' in names)
+        self.failUnless('read_list' in names)
+        summary = json.load(open('var/pipeline/timing.json'))
+        self.failUnless(options['location'] in summary['parts'])
+        self.failUnless(summary['steps']['scripts']['count'] >= 1)
+
+
+def test_suite():
+    """
+    Run the test suite
+    """
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
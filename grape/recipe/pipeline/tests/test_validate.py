@@ -0,0 +1,135 @@
+"""
+Test for validate.py
+"""
+
+import os
+import gzip
+import zlib
+import struct
+import shutil
+import tempfile
+import unittest
+
+from grape.recipe.pipeline.validate import validate_files
+from grape.recipe.pipeline.validate import BGZF_EOF
+from grape.recipe.pipeline.cache import FileCache
+from grape.recipe.pipeline.cache import identity_key
+
+
+def write_gzip(path, content):
+    """Write the content gzip compressed"""
+    output = gzip.open(path, 'wb')
+    output.write(content)
+    output.close()
+
+
+def write_bgzf(path, content, eof=True):
+    """Write the content in one BGZF block, with the end of file block"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    data = compressor.compress(content) + compressor.flush()
+    block_size = 18 + len(data) + 8
+    header = ('\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00' +
+              struct.pack('<H', block_size - 1))
+    trailer = struct.pack('<Ii', zlib.crc32(content), len(content))
+    output = open(path, 'wb')
+    output.write(header + data + trailer)
+    if eof:
+        output.write(BGZF_EOF)
+    output.close()
+
+
+def truncate(path):
+    """Cut off the second half of the file"""
+    content = open(path, 'rb').read()
+    open(path, 'wb').write(content[:len(content) / 2])
+
+
+class ValidateFilesTests(unittest.TestCase):
+    """
+    Test the validate_files method in validate.py
+    """
+
+    def setUp(self):  # pylint: disable=C0103
+        self.folder = tempfile.mkdtemp('validateTest')
+        self.cache = os.path.join(self.folder, 'validation.db')
+        self.content = '@read\nACGT\n+\nIIII\n' * 10000
+
+    def tearDown(self):  # pylint: disable=C0103
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def path(self, name):
+        """Return the path of a file in the folder"""
+        return os.path.join(self.folder, name)
+
+    def test_full(self):
+        """
+        A full check finds truncated gzip files
+        """
+        write_gzip(self.path('good.fastq.gz'), self.content)
+        write_gzip(self.path('bad.fastq.gz'), self.content)
+        truncate(self.path('bad.fastq.gz'))
+        paths = [self.path('good.fastq.gz'), self.path('bad.fastq.gz')]
+        errors = validate_files(paths, 'full', self.cache, 2)
+        self.failUnless([path for path, _ in errors] == paths[1:])
+
+    def test_eof(self):
+        """
+        The eof check finds BGZF files without the end of file block
+        """
+        write_bgzf(self.path('good.bam'), self.content)
+        write_bgzf(self.path('bad.bam'), self.content, eof=False)
+        paths = [self.path('good.bam'), self.path('bad.bam')]
+        errors = validate_files(paths, 'eof', self.cache)
+        self.failUnless([path for path, _ in errors] == paths[1:])
+        errors = validate_files(paths[:1], 'full', self.cache)
+        self.failUnless(errors == [])
+
+    def test_eof_plain(self):
+        """
+        The eof check finds plain gzip files cut off before their trailer
+        """
+        write_gzip(self.path('good.fastq.gz'), self.content)
+        write_gzip(self.path('bad.fastq.gz'), self.content)
+        truncate(self.path('bad.fastq.gz'))
+        open(self.path('short.fastq.gz'), 'wb').write(
+            open(self.path('good.fastq.gz'), 'rb').read()[:12])
+        paths = [self.path('good.fastq.gz'), self.path('bad.fastq.gz'),
+                 self.path('short.fastq.gz')]
+        errors = validate_files(paths, 'eof', self.cache)
+        self.failUnless([path for path, _ in errors] == paths[1:])
+        self.failUnless(errors[1][1] == "Truncated")
+
+    def test_not_gzip(self):
+        """
+        Files that are not gzip compressed are broken
+        """
+        open(self.path('plain.fastq.gz'), 'w').write(self.content)
+        errors = validate_files([self.path('plain.fastq.gz')], 'eof',
+                                self.cache)
+        self.failUnless(len(errors) == 1)
+
+    def test_cache(self):
+        """
+        The results are cached by file identity
+        """
+        path = self.path('good.fastq.gz')
+        write_gzip(path, self.content)
+        validate_files([path], 'full', self.cache)
+        cache = FileCache(self.cache)
+        result = cache.get(identity_key(path), 'validation:full')
+        cache.close()
+        self.failUnless(result == {'error': None})
+
+    def test_unknown_mode(self):
+        """
+        Only the eof and full checks are known
+        """
+        self.failUnlessRaises(AttributeError, validate_files, [], 'quick',
+                              self.cache)
+
+
+def test_suite():
+    """
+    Run the test suite
+    """
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
@@ -0,0 +1,203 @@
+"""
+Timing of the steps of preparing a part.
+
+The timing is switched on for a part with the timing option:
+
+    [TestRun]
+    recipe = grape.recipe.pipeline
+    accession = TestRun
+    timing = true
+
+or for all parts with the GRAPE_TIMING=1 environment variable. For every
+step, the wall time, the number of file system operations and the number of
+bytes copied are recorded. The report of a part is written to timing.json in
+the part, and the summary of all the parts of a buildout run to
+var/pipeline/timing.json.
+
+The file system operations are counted by wrapping the functions of the os
+module while a part is being prepared, so operations of libraries like
+shutil are counted as well. The wrapped functions are shared by the whole
+process, so only the calls made by the thread preparing the part are
+counted. The work of the thread pools of a step, like checking the read
+files, only shows in its wall time.
+"""
+
+import os
+import time
+import shutil
+import threading
+
+from grape.recipe.pipeline.jsonfile import write_json
+
+ENABLED_VALUES = ('1', 'true', 'yes', 'on')
+
+FILE_SYSTEM_FUNCTIONS = ('stat', 'lstat', 'listdir', 'mkdir', 'rmdir',
+                         'remove', 'unlink', 'rename', 'symlink', 'readlink',
+                         'link', 'chmod', 'utime', 'open')
+
+# The timing of the part being prepared in this process, if any
+ACTIVE = [None]
+
+# The parts prepared in this buildout run
+RUN_SUMMARY = {'started': time.time(), 'parts': {}, 'steps': {}}
+
+
+class Timing(object):
+    """
+    Records the steps of preparing one part.
+    """
+
+    def __init__(self):
+        """Start with no steps"""
+        self.started = time.time()
+        self.steps = []
+        self.path = []
+        self.operations = 0
+        self.bytes_copied = 0
+        self.originals = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def count(self, operations=0, size=0):
+        """Count file system operations and bytes copied"""
+        self.lock.acquire()
+        try:
+            self.operations += operations
+            self.bytes_copied += size
+        finally:
+            self.lock.release()
+
+    def counting(self, function):
+        """Wrap a file system function so that its calls are counted"""
+        def wrapper(*args, **kwargs):
+            """Count the call"""
+            if self.is_timed_thread():
+                self.count(operations=1)
+            return function(*args, **kwargs)
+        return wrapper
+
+    def is_timed_thread(self):
+        """Check whether the current thread is the one being timed"""
+        return threading.current_thread().ident == self.thread
+
+    def copyfileobj(self, source, target, length=16 * 1024):
+        """Like shutil.copyfileobj, counting the bytes copied"""
+        if not self.is_timed_thread():
+            original = self.originals[(shutil, 'copyfileobj')]
+            return original(source, target, length)
+        while True:
+            data = source.read(length)
+            if not data:
+                break
+            target.write(data)
+            self.count(size=len(data))
+
+    def install(self):
+        """Wrap the file system functions for the current thread"""
+        self.thread = threading.current_thread().ident
+        for name in FILE_SYSTEM_FUNCTIONS:
+            if hasattr(os, name):
+                self.originals[(os, name)] = getattr(os, name)
+                setattr(os, name, self.counting(getattr(os, name)))
+        self.originals[(shutil, 'copyfileobj')] = shutil.copyfileobj
+        shutil.copyfileobj = self.copyfileobj
+
+    def uninstall(self):
+        """Restore the file system functions"""
+        for (module, name), function in self.originals.items():
+            setattr(module, name, function)
+        self.originals = {}
+
+    def run_step(self, name, function, *args):
+        """Call the function as a step, and record it"""
+        self.path.append(name)
+        step_name = '/'.join(self.path)
+        start = time.time()
+        operations = self.operations
+        bytes_copied = self.bytes_copied
+        try:
+            return function(*args)
+        finally:
+            self.path.pop()
+            copied = self.bytes_copied - bytes_copied
+            self.steps.append({'name': step_name,
+                               'seconds': time.time() - start,
+                               'operations': self.operations - operations,
+                               'bytes_copied': copied})
+
+    def report(self):
+        """Return the report of the part"""
+        return {'started': self.started,
+                'seconds': time.time() - self.started,
+                'counted': 'the thread preparing the part',
+                'operations': self.operations,
+                'bytes_copied': self.bytes_copied,
+                'steps': self.steps}
+
+
+def is_enabled(options):
+    """Check whether the timing is switched on for the part"""
+    if options.get('timing', '').lower() in ENABLED_VALUES:
+        return True
+    return os.environ.get('GRAPE_TIMING', '').lower() in ENABLED_VALUES
+
+
+def start(options):
+    """
+    Start timing the preparation of the part, if it is switched on.
+    Returns the timing, or None.
+    """
+    if not is_enabled(options):
+        return None
+    timing = Timing()
+    timing.install()
+    ACTIVE[0] = timing
+    return timing
+
+
+def stop(timing):
+    """Stop timing"""
+    if timing is None:
+        return
+    timing.uninstall()
+    ACTIVE[0] = None
+
+
+def step(name, function, *args):
+    """
+    Call the function as a named step of the part being timed. Without
+    timing, the function is just called.
+    """
+    timing = ACTIVE[0]
+    if timing is None:
+        return function(*args)
+    return timing.run_step(name, function, *args)
+
+
+def add_to_summary(location, report):
+    """Add the report of a part to the summary of the buildout run"""
+    RUN_SUMMARY['parts'][location] = {
+        'seconds': report['seconds'],
+        'operations': report['operations'],
+        'bytes_copied': report['bytes_copied']}
+    for record in report['steps']:
+        total = RUN_SUMMARY['steps'].setdefault(record['name'],
+                                                {'count': 0,
+                                                 'seconds': 0.0,
+                                                 'operations': 0,
+                                                 'bytes_copied': 0})
+        total['count'] += 1
+        for key in ['seconds', 'operations', 'bytes_copied']:
+            total[key] += record[key]
+
+
+def save_part_report(location, report):
+    """Write the report of a part to timing.json in the part"""
+    write_json(os.path.join(location, 'timing.json'), report)
+
+
+def save_summary(buildout):
+    """Write the summary of the buildout run to var/pipeline/timing.json"""
+    buildout_directory = buildout['buildout']['directory']
+    path = os.path.join(buildout_directory, 'var/pipeline/timing.json')
+    write_json(path, RUN_SUMMARY)
@@ -0,0 +1,153 @@
+"""
+Integrity checks for read files.
+
+A truncated .fastq.gz or .bam file is otherwise only discovered when the
+mapping fails on the cluster. Both formats are gzip compressed (bam files
+use blocked gzip, BGZF), so they can be checked in two ways:
+
+    eof   Check the gzip header, and for BGZF files the end of file block
+          that is written as the last block of every complete file. Plain
+          gzip files have no such block, so their header and the trailer
+          of their last member are checked: the file needs to be long
+          enough for the trailer, and for files of up to 4 MB, the
+          uncompressed size in the trailer must be possible for the size
+          of the file. The size in the trailer is modulo 4 GB, so larger
+          files can have any size there. Only the full check catches every
+          truncated plain gzip file.
+
+    full  Decompress the whole file, which verifies the CRC and length of
+          every gzip member.
+
+The checks run over a pool of worker threads (zlib releases the interpreter
+lock while decompressing, and a thread pool also works inside the worker
+processes of grape-prepare-parts). The results are cached in a sidecar
+database so that every file is only checked once.
+"""
+
+import gzip
+import zlib
+import struct
+
+from grape.recipe.pipeline.cache import check_cached
+
+VALIDATION_MODES = ('eof', 'full')
+
+GZIP_MAGIC = '\x1f\x8b'
+
+BGZF_EOF = ('\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43'
+            '\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00')
+
+CHUNK_SIZE = 1024 * 1024
+
+# The smallest gzip member: a header, an empty deflate block and a trailer
+GZIP_MINIMUM = 20
+
+# Deflate can not compress more than this
+MAX_DEFLATE_RATIO = 1032
+
+
+def is_bgzf(header):
+    """Check whether the first bytes of a gzip file are a BGZF header"""
+    # The BGZF header has the FEXTRA flag and a BC subfield
+    return (len(header) >= 18 and
+            ord(header[3]) & 4 and
+            header[12:14] == 'BC')
+
+
+def check_trailer(read_file):
+    """
+    Check that a plain gzip file ends with a trailer whose uncompressed
+    size is possible. Returns an error message, or None.
+    """
+    read_file.seek(0, 2)
+    size = read_file.tell()
+    if size < GZIP_MINIMUM:
+        return "Truncated"
+    read_file.seek(-4, 2)
+    uncompressed = struct.unpack('<I', read_file.read(4))[0]
+    # The size in the trailer is modulo 4 GB, so only files that can not
+    # have more than that uncompressed can be checked
+    if size * MAX_DEFLATE_RATIO < 2 ** 32 and \
+            uncompressed > size * MAX_DEFLATE_RATIO:
+        return "Truncated, the trailer is not where it should be"
+    return None
+
+
+def check_eof(path):
+    """
+    Check the gzip header, and the BGZF end of file block or the trailer of
+    a plain gzip file. Returns an error message, or None if the file is
+    fine. Only check_full finds every truncated plain gzip file.
+    """
+    read_file = open(path, 'rb')
+    try:
+        header = read_file.read(18)
+        if header[0:2] != GZIP_MAGIC:
+            return "Not gzip compressed"
+        if not is_bgzf(header):
+            return check_trailer(read_file)
+        read_file.seek(0, 2)
+        if read_file.tell() < len(BGZF_EOF):
+            return "Truncated"
+        read_file.seek(-len(BGZF_EOF), 2)
+        if read_file.read() != BGZF_EOF:
+            return "Missing BGZF end of file block"
+    finally:
+        read_file.close()
+    return None
+
+
+def check_full(path):
+    """
+    Decompress the whole file. Returns an error message, or None if the
+    file is fine.
+    """
+    message = check_eof(path)
+    if message is not None:
+        return message
+    read_file = gzip.open(path, 'rb')
+    try:
+        try:
+            while read_file.read(CHUNK_SIZE):
+                pass
+        except (IOError, EOFError, struct.error, zlib.error) as error:
+            return "Corrupt gzip stream: %s" % error
+    finally:
+        read_file.close()
+    return None
+
+
+def check_file(path, mode):
+    """
+    Check one file, returning the error message and whether the result can
+    be cached. Files that can not be read are not cached.
+    """
+    try:
+        if mode == 'full':
+            return check_full(path), True
+        return check_eof(path), True
+    except IOError as error:
+        return str(error), False
+
+
+def validate_files(paths, mode, cache_path, workers=None):
+    """
+    Check the integrity of the files over a pool of workers. Files that
+    have been checked before are looked up in the cache. A full check also
+    counts for the eof check.
+
+    Returns a list of (path, error message) tuples for the broken files.
+    """
+    if not mode in VALIDATION_MODES:
+        raise AttributeError("Unknown read validation mode: %s" % mode)
+    kinds = ['validation:%s' % mode]
+    if mode == 'eof':
+        kinds.append('validation:full')
+
+    def check(job):
+        """Check the file of the job"""
+        return check_file(job[0], mode)
+
+    errors = check_cached(cache_path, [(path,) for path in paths], check,
+                          kinds, workers)
+    return [(job[0], error) for job, error in errors]
@@ -25,6 +25,15 @@ like the Illumina Body Map Project (HBM) and the ENCODE project."""
 entry_point = 'grape.recipe.pipeline:Recipe'
 entry_points = {"zc.buildout": [
                   "default = grape.recipe.pipeline:Recipe",
+               ],
+                "console_scripts": [
+                  "grape-prepare-parts = grape.recipe.pipeline.batch:main",
+                  "grape-accession-db = grape.recipe.pipeline.accessiondb:main",
+                  "grape-job-array = grape.recipe.pipeline.jobarray:main",
+                  "grape-run-parts = grape.recipe.pipeline.executor:main",
+                  "grape-gemindices = grape.recipe.pipeline.gemindex:main",
+                  "grape-benchmark = grape.recipe.pipeline.benchmark:main",
+                  "grape-species = grape.recipe.pipeline.species:main",
                ]}
 
 setup(name='grape.recipe.pipeline',